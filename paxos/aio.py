@@ -0,0 +1,781 @@
+'''
+This module provides asyncio based network transports for the nodes in this
+package, along with AsyncNode, which allows values to be proposed with
+'await'. Messages are encoded with the paxos.wire module.
+
+Persistence of Acceptor state remains the responsibility of the application.
+After each received datagram or frame has been delivered, the transport calls
+the 'persister' function supplied to it, if the node's persistance_required
+attribute is set. As persisted() may process requests that were deferred
+while persistence was pending, persisters must check persistance_required
+again after each call to persisted(). The default persister calls the
+node's persisted() method immediately, which is only appropriate for nodes
+whose state need not survive a crash. durable.BackgroundSaver.persist is a
+suitable replacement.
+'''
+import asyncio
+import socket
+import struct
+import uuid
+
+from paxos import practical, functional, multi, batching, wire
+
+
+def persist_immediately( node ):
+    # persisted() may process deferred requests that require persistence
+    while node.persistance_required:
+        node.persisted()
+
+
+class TransportMessenger (wire.WireMessenger):
+    '''
+    Base class for the transports in this module. Received data is delivered
+    to the node passed to attach() and the persister is called whenever the
+    node requires its Acceptor state to be saved.
+    '''
+
+    def __init__(self, messenger, node_uid, codec, loop, persister):
+        super(TransportMessenger, self).__init__(messenger, node_uid, codec)
+
+        self.loop      = loop if loop is not None else asyncio.get_event_loop()
+        self.persister = persister if persister is not None else persist_immediately
+        self.node      = None
+
+
+    def deliver(self, data):
+        '''
+        Dispatches the encoded messages in data to the attached node. A
+        malformed message is dropped along with the remainder of the data
+        but those preceding it have been delivered, so the persister is
+        still called if required.
+        '''
+        if self.node is None:
+            return
+
+        try:
+            self.codec.dispatch(self.node, data)
+        except wire.WireError:
+            pass # Malformed messages are dropped
+
+        if self.node.persistance_required:
+            self.persister(self.node)
+
+
+class UDPMessenger (TransportMessenger, asyncio.DatagramProtocol):
+    '''
+    This class implements functional.HeartbeatMessenger over UDP. Each
+    send_* call is encoded into a single datagram, schedule() is implemented
+    with loop.call_later() and, once a node is attached, poll_liveness() is
+    called every 'poll_interval' seconds, which defaults to the node's
+    liveness_window.
+
+    The 'peers' argument is a dictionary mapping the UID of every node,
+    including this one, to its (host, port) address. Broadcast messages are
+    sent to all peers, including this node. The dictionary is not copied and
+    the entry for this node is updated with the bound address once the
+    endpoint is created, so port 0 may be used to bind to an ephemeral port.
+    The sorted peer UIDs are interned by the default Codec.
+
+    Callbacks such as on_resolution() and on_leadership_change() are
+    delegated to the 'messenger' argument, which defaults to a
+    functional.HeartbeatMessenger that ignores them.
+
+    asyncio's datagram transports read a single datagram per event loop
+    iteration, so bursts of messages queue in the socket's receive buffer.
+    The buffer is enlarged to 'rcvbuf' bytes, subject to the operating
+    system's limit, to avoid losing messages under load.
+
+    Usage:
+
+        m = UDPMessenger('A', peers)
+        n = functional.HeartbeatNode(m, 'A', 2)
+        await m.listen()
+        m.attach(n)
+    '''
+
+    poll_interval = None
+    rcvbuf        = 4 * 1024 * 1024
+    closed        = False
+
+    def __init__(self, node_uid, peers, messenger=None, codec=None, loop=None,
+                 persister=None, poll_interval=None, rcvbuf=None):
+
+        if messenger is None:
+            messenger = functional.HeartbeatMessenger()
+
+        if codec is None:
+            codec = wire.Codec(sorted(peers.keys()))
+
+        super(UDPMessenger, self).__init__(messenger, node_uid, codec, loop, persister)
+
+        self.peers       = peers
+        self.transport   = None
+        self.poll_handle = None
+
+        if poll_interval: self.poll_interval = poll_interval
+        if rcvbuf:        self.rcvbuf        = rcvbuf
+
+
+    def listen(self):
+        '''
+        Returns an awaitable that creates the UDP endpoint bound to this
+        node's address
+        '''
+        return self.loop.create_datagram_endpoint(lambda: self,
+                                                  local_addr=self.peers[self.node_uid])
+
+
+    def attach(self, node):
+        '''
+        Delivers received messages to the node and starts polling its
+        liveness. If the node is already the leader, heartbeating begins.
+        '''
+        self.node = node
+
+        if self.poll_interval is None:
+            self.poll_interval = node.liveness_window
+
+        self.poll_handle = self.loop.call_later(self.poll_interval, self._poll)
+
+        if node.leader:
+            node.pulse()
+
+
+    def close(self):
+        self.closed = True
+
+        if self.poll_handle is not None:
+            self.poll_handle.cancel()
+            self.poll_handle = None
+
+        if self.transport is not None:
+            self.transport.close()
+
+
+    def _poll(self):
+        self.node.poll_liveness()
+        self.poll_handle = self.loop.call_later(self.poll_interval, self._poll)
+
+
+    # DatagramProtocol interface
+
+    def connection_made(self, transport):
+        self.transport              = transport
+        self.peers[ self.node_uid ] = transport.get_extra_info('sockname')[:2]
+
+        sock = transport.get_extra_info('socket')
+
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.close()
+
+
+    def datagram_received(self, data, addr):
+        self.deliver(data)
+
+
+    def error_received(self, exc):
+        # ICMP errors, such as those caused by sending to a node that is
+        # down, are ignored. Paxos tolerates message loss.
+        pass
+
+
+    # Messenger interface
+
+    def send_data(self, to_uid, data):
+        if self.transport is None:
+            return
+
+        if to_uid is None:
+            for addr in self.peers.values():
+                self.transport.sendto(data, addr)
+        else:
+            addr = self.peers.get(to_uid)
+            if addr is not None:
+                self.transport.sendto(data, addr)
+
+
+    def schedule(self, msec_delay, func_obj):
+        # Despite the argument name, HeartbeatNode passes its hb_period, which
+        # is expressed in seconds. Once closed, the leader's pulse() chain is
+        # allowed to lapse.
+        if not self.closed:
+            self.loop.call_later(msec_delay, func_obj)
+
+
+
+_frame_header = struct.Struct('>I')
+
+
+class FrameProtocol (asyncio.Protocol):
+    '''
+    Receives length-prefixed frames on an inbound connection accepted by a
+    TCPMessenger. Each frame is delivered as a memoryview of the receive
+    buffer, which is released once delivery completes. A frame longer than
+    the messenger's 'max_frame_size' cannot be skipped without buffering it,
+    so the connection is closed instead. The 'oversized' attribute counts
+    such frames.
+    '''
+
+    def __init__(self, messenger):
+        self.messenger = messenger
+        self.buffer    = bytearray()
+        self.transport = None
+        self.oversized = 0
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.messenger.inbound.add(self)
+
+
+    def connection_lost(self, exc):
+        self.messenger.inbound.discard(self)
+
+
+    def data_received(self, data):
+        buf    = self.buffer
+        offset = 0
+
+        buf.extend( data )
+
+        with memoryview(buf) as view:
+            while len(buf) - offset >= _frame_header.size:
+                length, = _frame_header.unpack_from(buf, offset)
+                start   = offset + _frame_header.size
+                end     = start + length
+
+                if length > self.messenger.max_frame_size:
+                    self.oversized += 1
+                    self.transport.close()
+                    break
+
+                if end > len(buf):
+                    break
+
+                frame = view[start:end]
+                try:
+                    self.messenger.deliver(frame)
+                finally:
+                    frame.release()
+
+                offset = end
+
+        if self.oversized:
+            self.buffer = bytearray()
+            return
+
+        try:
+            del buf[:offset]
+        except BufferError:
+            # A view of the buffer outlived its delivery, typically via the
+            # traceback of an exception raised by a send from within a recv_*
+            # method and retained by the transport. Continue with a copy.
+            self.buffer = buf[offset:]
+
+
+
+class PeerConnection (asyncio.Protocol):
+    '''
+    Maintains the outbound connection from a TCPMessenger to one of its
+    peers. The connection is re-established after 'reconnect_delay' seconds
+    when lost or refused, doubling the delay after each failed attempt up to
+    'max_reconnect_delay'. While disconnected, frames are queued until the
+    messenger's 'max_pending' bytes are pending, after which they are
+    dropped. Frames are also dropped while the connection is paused and its
+    write buffer holds 'max_pending' bytes, so that a peer that cannot keep
+    up with the rest of the quorum does not consume unbounded memory. Paxos
+    tolerates the loss of any message. The 'dropped' attribute counts the
+    frames dropped.
+
+    The transport's write buffer limits are set to the messenger's high and
+    low watermarks. The connection is 'writable' while connected and the
+    write buffer has not reached the high watermark.
+    '''
+
+    def __init__(self, messenger, peer_uid):
+        self.messenger     = messenger
+        self.peer_uid      = peer_uid
+        self.transport     = None
+        self.paused        = False
+        self.pending       = list()
+        self.pending_bytes = 0
+        self.delay         = messenger.reconnect_delay
+        self.retry_handle  = None
+        self.connect_task  = None
+        self.dropped       = 0
+
+        self.connect()
+
+
+    @property
+    def writable(self):
+        return self.transport is not None and not self.paused
+
+
+    def connect(self):
+        self.retry_handle = None
+
+        if self.messenger.closed:
+            return
+
+        host, port = self.messenger.peers[ self.peer_uid ]
+
+        self.connect_task = asyncio.ensure_future( self.messenger.loop.create_connection(lambda: self, host, port),
+                                                   loop = self.messenger.loop )
+        self.connect_task.add_done_callback( self._connect_done )
+
+
+    def _connect_done(self, task):
+        self.connect_task = None
+
+        if task.cancelled() or task.exception() is not None:
+            self._retry()
+
+
+    def _retry(self):
+        if self.messenger.closed or self.retry_handle is not None:
+            return
+
+        self.retry_handle = self.messenger.loop.call_later(self.delay, self.connect)
+        self.delay        = min(self.delay * 2, self.messenger.max_reconnect_delay)
+
+
+    def send(self, header, data):
+        if self.transport is not None and not self.transport.is_closing():
+            if self.paused and self.transport.get_write_buffer_size() >= self.messenger.max_pending:
+                self.dropped += 1
+            else:
+                self.transport.writelines( (header, data) )
+
+        elif self.pending_bytes < self.messenger.max_pending:
+            self.pending.append( header )
+            self.pending.append( data )
+            self.pending_bytes += len(header) + len(data)
+
+        else:
+            self.dropped += 1
+
+
+    def close(self):
+        if self.retry_handle is not None:
+            self.retry_handle.cancel()
+            self.retry_handle = None
+
+        if self.connect_task is not None:
+            self.connect_task.cancel()
+
+        if self.transport is not None:
+            self.transport.close()
+
+
+    # Protocol interface
+
+    def connection_made(self, transport):
+        if self.messenger.closed:
+            transport.close()
+            return
+
+        self.transport = transport
+        self.delay     = self.messenger.reconnect_delay
+
+        transport.set_write_buffer_limits(high = self.messenger.high_water,
+                                          low  = self.messenger.low_water)
+
+        if self.pending:
+            transport.writelines( self.pending )
+            self.pending       = list()
+            self.pending_bytes = 0
+
+        self.messenger.writability_changed()
+
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.paused    = False
+        self.messenger.writability_changed()
+        self._retry()
+
+
+    def data_received(self, data):
+        pass # Peers send on their own outbound connections
+
+
+    def pause_writing(self):
+        self.paused = True
+        self.messenger.writability_changed()
+
+
+    def resume_writing(self):
+        self.paused = False
+        self.messenger.writability_changed()
+
+
+
+class TCPMessenger (TransportMessenger):
+    '''
+    This class implements practical.Messenger over TCP. One persistent
+    outbound connection is maintained to each peer and frames encoded with
+    paxos.wire are sent over it with a 4-byte length prefix. Messages sent
+    to this node are delivered locally via loop.call_soon(). Lost
+    connections are re-established transparently; see PeerConnection.
+
+    The 'peers' argument is as for UDPMessenger: a dictionary mapping the UID
+    of every node, including this one, to its (host, port) address, which
+    is updated with the bound address when listen() is called. Unless a
+    'codec' is supplied, the sorted peer UIDs are interned by a wire.Codec
+    or, if the attached node is a multi.MultiPaxosNode, a wire.MultiCodec,
+    which can also carry the batches proposed by AsyncNode.
+
+    Write buffers are bounded by the 'high_water' and 'low_water' marks.
+    The messenger is 'throttled' while fewer than quorum_size nodes,
+    counting this one, have writable connections, as the leader cannot make
+    progress faster than a quorum can absorb its messages. While throttled,
+    send_accept() calls are encoded and deferred rather than added to the
+    write buffers of the slowest peers and are sent once the throttle lifts.
+    Once 'max_pending' bytes are deferred, further Accept! messages are
+    dropped and counted in the 'dropped' attribute, as for PeerConnection.
+    Applications proposing at high rates should await wait_writable()
+    before each proposal.
+
+    Inbound frames longer than 'max_frame_size' bytes cause the connection
+    they arrive on to be closed, so all nodes must use the same limit and
+    no encoded message may exceed it.
+
+    Usage:
+
+        m = TCPMessenger('A', peers)
+        n = practical.Node(m, 'A', 2)
+        await m.listen()
+        m.attach(n)
+    '''
+
+    high_water          = 1024 * 1024
+    low_water           = 256 * 1024
+    max_pending         = 16 * 1024 * 1024
+    max_frame_size      = 64 * 1024 * 1024
+    reconnect_delay     = 0.05
+    max_reconnect_delay = 2.0
+
+    def __init__(self, node_uid, peers, messenger=None, codec=None, loop=None,
+                 persister=None, high_water=None, low_water=None, reconnect_delay=None,
+                 max_frame_size=None):
+
+        if messenger is None:
+            messenger = practical.Messenger()
+
+        default_codec = codec is None
+
+        if default_codec:
+            codec = wire.Codec(sorted(peers.keys()))
+
+        super(TCPMessenger, self).__init__(messenger, node_uid, codec, loop, persister)
+
+        self.default_codec  = default_codec
+        self.peers          = peers
+        self.connections    = dict() # maps peer_uid => PeerConnection
+        self.inbound        = set()  # FrameProtocols of accepted connections
+        self.deferred       = list() # Accept! messages encoded while throttled
+        self.deferred_bytes = 0
+        self.dropped        = 0
+        self.waiters        = list()
+        self.server         = None
+        self.closed         = False
+
+        if high_water:      self.high_water      = high_water
+        if low_water:       self.low_water       = low_water
+        if reconnect_delay: self.reconnect_delay = reconnect_delay
+        if max_frame_size:  self.max_frame_size  = max_frame_size
+
+
+    def listen(self):
+        '''
+        Binds this node's address and returns an awaitable that starts
+        accepting connections from peers
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind( self.peers[self.node_uid] )
+        sock.listen( 128 )
+        sock.setblocking( False )
+
+        self.peers[ self.node_uid ] = sock.getsockname()[:2]
+
+        task = asyncio.ensure_future( self.loop.create_server(lambda: FrameProtocol(self), sock=sock),
+                                      loop = self.loop )
+        task.add_done_callback( self._listening )
+        return task
+
+
+    def _listening(self, task):
+        if not task.cancelled() and task.exception() is None:
+            self.server = task.result()
+            if self.closed:
+                self.server.close()
+
+
+    def attach(self, node):
+        '''
+        Delivers received messages to the node and connects to all peers
+        '''
+        self.node = node
+
+        if self.default_codec and isinstance(node, multi.MultiPaxosNode):
+            self.codec = wire.MultiCodec(sorted(self.peers.keys()))
+
+        for uid in self.peers.keys():
+            if uid != self.node_uid:
+                self.connection(uid)
+
+
+    def connection(self, peer_uid):
+        '''
+        Returns the PeerConnection for the peer, creating it if necessary
+        '''
+        c = self.connections.get(peer_uid)
+
+        if c is None:
+            c = self.connections[ peer_uid ] = PeerConnection(self, peer_uid)
+
+        return c
+
+
+    def close(self):
+        self.closed = True
+
+        if self.server is not None:
+            self.server.close()
+
+        for c in self.connections.values():
+            c.close()
+
+        for p in list(self.inbound):
+            p.transport.close()
+
+        for f in self.waiters:
+            f.cancel()
+
+        self.waiters = list()
+
+
+    @property
+    def throttled(self):
+        if self.node is None:
+            return False
+
+        writable = 1 + sum( 1 for c in self.connections.values() if c.writable )
+
+        return writable < self.node.quorum_size
+
+
+    def wait_writable(self):
+        '''
+        Returns a future that completes when the messenger is not throttled
+        '''
+        f = self.loop.create_future()
+
+        if self.throttled:
+            self.waiters.append( f )
+        else:
+            f.set_result( None )
+
+        return f
+
+
+    def writability_changed(self):
+        '''
+        Called by PeerConnections when they become writable or unwritable
+        '''
+        if self.throttled:
+            return
+
+        deferred, self.deferred = self.deferred, list()
+        self.deferred_bytes     = 0
+
+        for data in deferred:
+            self.send_data( None, data )
+
+        waiters, self.waiters = self.waiters, list()
+
+        for f in waiters:
+            if not f.done():
+                f.set_result( None )
+
+
+    # Messenger interface
+
+    def send_data(self, to_uid, data):
+        if self.closed:
+            return
+
+        header = _frame_header.pack( len(data) )
+
+        if to_uid is None:
+            for uid in self.peers.keys():
+                if uid != self.node_uid:
+                    self.connection(uid).send( header, data )
+            self.loop.call_soon( self.deliver, data )
+
+        elif to_uid == self.node_uid:
+            self.loop.call_soon( self.deliver, data )
+
+        elif to_uid in self.peers:
+            self.connection(to_uid).send( header, data )
+
+
+    def send_accept(self, *args):
+        if not self.throttled:
+            super(TCPMessenger, self).send_accept(*args)
+
+        elif self.deferred_bytes < self.max_pending:
+            data = self.codec.encode(self.node_uid, 'accept', args)
+            self.deferred.append( data )
+            self.deferred_bytes += len(data)
+
+        else:
+            self.dropped += 1
+
+
+
+class AsyncNode (object):
+    '''
+    This class provides an awaitable propose() method for a practical.Node,
+    functional.HeartbeatNode or multi.MultiPaxosNode. It acts as the node's
+    application messenger: it may either wrap the messenger the node would
+    otherwise use and be passed to the node in its place, or be passed as
+    the 'messenger' argument of a transport in this module. In both cases,
+    all messenger methods other than on_resolution() are delegated to the
+    wrapped 'messenger', which defaults to a functional.HeartbeatMessenger
+    that ignores them. The node must be passed to attach() once created.
+
+    For single-instance nodes, propose() calls the node's set_proposal()
+    and completes with the (proposal_id, value) tuple of the resolution,
+    which is not necessarily the proposed value. All calls made after the
+    resolution complete immediately.
+
+    For multi.MultiPaxosNodes, concurrent proposals are multiplexed onto the
+    log with a batching.ProposalBatcher. Values proposed during one event
+    loop iteration are coalesced into a single batch, of at most
+    'max_batch_size' values, which is proposed at the end of the iteration
+    if the node's pipeline has room for it. Otherwise values continue to
+    accumulate until a slot is resolved, so the batch size grows with the
+    load rather than the number of queued slots. Each propose() completes
+    with the proposal id of the slot its value was resolved in and the
+    value. Values whose batch loses its slot to another proposer are
+    re-proposed by the node. The wrapped messenger's on_resolution() method
+    receives the resolved batches.
+
+    The 'batcher_uid' must be unique among all proposers to the log. It
+    defaults to the node's uid followed by a random suffix so that batches
+    proposed before a restart are not mistaken for new ones.
+
+    When the node's messages are sent with TCPMessenger, its default
+    wire.MultiCodec requires the proposed values to be byte strings. Other
+    values may be proposed by passing the messenger a wire.MultiCodec with
+    a suitable 'command_codec'. Values are only assigned to slots while the
+    node is the leader, so one node must call prepare() to acquire
+    leadership, as for any MultiPaxosNode.
+
+    Usage:
+
+        a = AsyncNode()
+        m = TCPMessenger('A', peers, messenger=a)
+        n = multi.MultiPaxosNode(m, 'A', 2, pipeline_window=16)
+        await m.listen()
+        m.attach(n)
+        a.attach(n)
+        n.prepare()
+        ...
+        proposal_id, value = await a.propose(b'value')
+    '''
+
+    max_batch_size = 1000
+
+    def __init__(self, messenger=None, loop=None, batcher_uid=None, max_batch_size=None):
+        self.messenger    = messenger if messenger is not None else functional.HeartbeatMessenger()
+        self.loop         = loop if loop is not None else asyncio.get_event_loop()
+        self.batcher_uid  = batcher_uid
+        self.node         = None
+        self.batcher      = None
+        self.resolution   = None   # (proposal_id, value) of a single-instance node
+        self.waiters      = list() # futures awaiting a single-instance resolution
+        self.flush_handle = None
+
+        if max_batch_size: self.max_batch_size = max_batch_size
+
+
+    def __getattr__(self, name):
+        return getattr(self.messenger, name)
+
+
+    def attach(self, node):
+        self.node = node
+
+        if isinstance(node, multi.MultiPaxosNode):
+            if self.batcher_uid is None:
+                self.batcher_uid = '%s-%s' % (node.node_uid, uuid.uuid4().hex[:8])
+
+            self.batcher = batching.ProposalBatcher(node, self.batcher_uid,
+                                                    max_batch_size = self.max_batch_size)
+
+
+    def propose(self, value):
+        '''
+        Proposes the value and returns a future that completes with the
+        (proposal_id, value) tuple of its resolution
+        '''
+        f = self.loop.create_future()
+
+        if self.batcher is not None:
+            self.batcher.propose( value, lambda proposal_id, value: self._complete(f, proposal_id, value) )
+            self._schedule_flush()
+
+        elif self.resolution is not None:
+            f.set_result( self.resolution )
+
+        else:
+            self.waiters.append( f )
+            self.node.set_proposal( value )
+
+        return f
+
+
+    def _complete(self, f, proposal_id, value):
+        if not f.done(): # The awaiter may have been cancelled
+            f.set_result( (proposal_id, value) )
+
+
+    def _schedule_flush(self):
+        if self.flush_handle is None and self.batcher.commands:
+            self.flush_handle = self.loop.call_soon(self._flush)
+
+
+    def _flush(self):
+        self.flush_handle = None
+
+        n = self.node
+
+        if len(n.in_flight) + len(n.proposal_queue) < n.pipeline_window:
+            self.batcher.flush()
+
+
+    def on_resolution(self, *args):
+        # Multi-Paxos resolutions are preceded by the slot
+        proposal_id, value = args[-2:]
+
+        if self.batcher is not None:
+            self.batcher.on_resolution( proposal_id, value )
+            self._schedule_flush()
+
+        else:
+            self.resolution       = (proposal_id, value)
+            waiters, self.waiters = self.waiters, list()
+
+            for f in waiters:
+                self._complete( f, proposal_id, value )
+
+        self.messenger.on_resolution( *args )
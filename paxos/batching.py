@@ -0,0 +1,295 @@
+'''
+This module provides batching front-ends that amortize the cost of a Paxos
+round, and of the associated Acceptor persistence, over many application
+commands. It also provides a Messenger wrapper that coalesces outbound
+messages into a single frame per destination.
+'''
+import collections
+import time
+
+
+# Proposal value used to carry a batch of commands. The batcher_uid and
+# batch number uniquely identify the batch so that the originating batcher
+# can recognize its own batches when they are resolved.
+#
+Batch = collections.namedtuple('Batch', ['batcher_uid', 'number', 'commands'])
+
+
+class ProposalBatcher (object):
+    '''
+    This class accumulates client commands and passes them to the proposer's
+    set_proposal() method as a single Batch value. A batch is flushed as soon
+    as it contains 'max_batch_size' commands or when poll() is called and the
+    oldest command in the batch has waited for at least 'max_delay' seconds.
+
+    The proposer is typically a multi.MultiPaxosNode as each practical.Node
+    resolves only a single value. The application must forward resolutions
+    to on_resolution() which invokes the completion callbacks of the
+    resolved batch's commands in order. Each callback is called with the
+    proposal id of the resolution and the command. The 'batcher_uid' must be
+    unique among all batchers proposing to the same Paxos instance(s).
+
+    If a 'controller' is supplied, the time between flushing each batch and
+    its resolution is reported to the controller which may then adjust the
+    max_batch_size and max_delay attributes. See AdaptiveBatchController.
+    '''
+
+    max_batch_size = 100
+    max_delay      = 0.005
+
+    timestamp      = time.time
+
+    def __init__(self, proposer, batcher_uid, max_batch_size=None, max_delay=None,
+                 controller=None):
+        self.proposer          = proposer
+        self.batcher_uid       = batcher_uid
+        self.controller        = controller
+        self.next_batch_number = 1
+        self.commands          = list()
+        self.callbacks         = list()
+        self.outstanding       = dict() # maps batch number => (callbacks, flush time, full)
+
+        self._tfirst           = None
+
+        if max_batch_size:         self.max_batch_size = max_batch_size
+        if max_delay is not None:  self.max_delay      = max_delay
+
+
+    def propose(self, command, callback=None):
+        '''
+        Adds the command to the current batch. The optional callback will be
+        called once the batch containing the command is resolved.
+        '''
+        if not self.commands:
+            self._tfirst = self.timestamp()
+
+        self.commands.append( command )
+        self.callbacks.append( callback )
+
+        if len(self.commands) >= self.max_batch_size:
+            self._flush(True)
+
+
+    def poll(self):
+        '''
+        Should be called at least every max_delay. Flushes the current batch
+        if its oldest command has waited for max_delay seconds or longer.
+        '''
+        if self.commands and self.timestamp() - self._tfirst >= self.max_delay:
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Proposes the current batch, if any, regardless of its size and age.
+        '''
+        self._flush(False)
+
+
+    def _flush(self, full):
+        if not self.commands:
+            return
+
+        batch = Batch(self.batcher_uid, self.next_batch_number, tuple(self.commands))
+
+        self.outstanding[ batch.number ] = (self.callbacks, self.timestamp(), full)
+
+        self.next_batch_number += 1
+        self.commands           = list()
+        self.callbacks          = list()
+
+        self.proposer.set_proposal( batch )
+
+
+    def on_resolution(self, proposal_id, value):
+        '''
+        Must be called for each resolved value. Values that are not batches
+        produced by this batcher are ignored.
+        '''
+        if not isinstance(value, Batch) or value.batcher_uid != self.batcher_uid:
+            return
+
+        outstanding = self.outstanding.pop(value.number, None)
+
+        if outstanding is None:
+            return # Duplicate resolution or a batch from a previous incarnation
+
+        callbacks, tflush, full = outstanding
+
+        if self.controller is not None:
+            self.controller.observe(self, self.timestamp() - tflush, len(value.commands), full)
+
+        for command, callback in zip(value.commands, callbacks):
+            if callback is not None:
+                callback(proposal_id, command)
+
+
+
+class AdaptiveBatchController (object):
+    '''
+    This class tunes the max_batch_size and max_delay attributes of a
+    ProposalBatcher based on the observed commit latency, measured from the
+    time each batch is proposed until it is resolved. A smoothed average of
+    the latency is maintained and compared against 'target_latency'.
+
+    Batches that fill up before their delay expires indicate that the load
+    exceeds the batch size so the size is doubled, up to the upper bound of
+    'batch_size_range'. Batches that are flushed while less than a quarter
+    full halve the size, but never below twice the number of commands the
+    batch contained nor the lower bound.
+
+    Waiting for additional commands is only worthwhile while latency is
+    below target and the waiting actually gathers more than one command. In
+    that case max_delay grows by 'delay_step', up to the upper bound of
+    'delay_range'. Otherwise max_delay is multiplied by 'backoff', down to
+    the lower bound. Under light load this drives the delay towards zero so
+    that commands are proposed immediately while heavy load results in
+    large batches.
+    '''
+
+    target_latency   = 0.010
+    batch_size_range = (1, 1000)
+    delay_range      = (0.0, 0.010)
+    delay_step       = 0.0005
+    backoff          = 0.5
+    smoothing        = 0.2
+
+    def __init__(self, target_latency=None):
+        self.latency = None
+
+        if target_latency: self.target_latency = target_latency
+
+
+    def observe(self, batcher, latency, count, full):
+        '''
+        Called by the batcher when one of its batches, containing 'count'
+        commands, is resolved 'latency' seconds after being proposed. The
+        'full' argument is True if the batch was flushed due to reaching
+        max_batch_size.
+        '''
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+
+        min_size, max_size   = self.batch_size_range
+        min_delay, max_delay = self.delay_range
+
+        if full:
+            batcher.max_batch_size = min(max_size, batcher.max_batch_size * 2)
+        elif count * 4 < batcher.max_batch_size:
+            batcher.max_batch_size = max(min_size, count * 2, batcher.max_batch_size // 2)
+
+        if self.latency > self.target_latency or count <= 1:
+            batcher.max_delay = max(min_delay, batcher.max_delay * self.backoff)
+        else:
+            batcher.max_delay = min(max_delay, batcher.max_delay + self.delay_step)
+
+
+
+# Maps the message names used in frames to the Node methods that handle them.
+# Each handler is called with the uid of the sender followed by the arguments
+# passed to the corresponding Messenger.send_* method, less the destination
+# uid for directed messages.
+#
+RECV_METHODS = { 'prepare'                 : 'recv_prepare',
+                 'promise'                 : 'recv_promise',
+                 'prepare_nack'            : 'recv_prepare_nack',
+                 'accept'                  : 'recv_accept_request',
+                 'accepted'                : 'recv_accepted',
+                 'accept_nack'             : 'recv_accept_nack',
+                 'heartbeat'               : 'recv_heartbeat',
+                 'leadership_proclamation' : 'recv_leadership_proclamation' }
+
+
+class BatchingMessenger (object):
+    '''
+    This class wraps a practical.Messenger, functional.HeartbeatMessenger,
+    external.ExternalMessenger or multi.MultiPaxosMessenger and buffers all
+    outbound messages until flush() is called. Buffered messages are grouped
+    by destination and each group is passed to the wrapped messenger's
+    send_frame(to_uid, messages) method, which must be implemented by the
+    application. The 'to_uid' argument is None for broadcast messages and
+    'messages' is a list of (message_name, args) tuples in the order they were
+    sent. On receipt, frames should be passed to dispatch_frame().
+
+    Applications will typically call flush() once at the end of each event
+    loop iteration. Alternatively, a 'call_soon' function such as asyncio's
+    loop.call_soon may be supplied, in which case a flush is scheduled via
+    that function whenever a message is buffered into an empty set of frames.
+
+    All other attributes, such as on_resolution() and schedule(), are
+    delegated directly to the wrapped messenger.
+    '''
+
+    def __init__(self, messenger, call_soon=None):
+        self.messenger = messenger
+        self.call_soon = call_soon
+        self.frames    = collections.OrderedDict() # maps to_uid => list of messages
+
+
+    def __getattr__(self, name):
+        return getattr(self.messenger, name)
+
+
+    def _buffer(self, to_uid, name, args):
+        if not self.frames and self.call_soon is not None:
+            self.call_soon(self.flush)
+
+        msgs = self.frames.get(to_uid)
+
+        if msgs is None:
+            msgs = self.frames[ to_uid ] = list()
+
+        msgs.append( (name, args) )
+
+
+    def flush(self):
+        '''
+        Sends all buffered messages, one frame per destination
+        '''
+        frames      = self.frames
+        self.frames = collections.OrderedDict()
+
+        for to_uid, msgs in frames.items():
+            self.messenger.send_frame(to_uid, msgs)
+
+
+    # Broadcast messages
+
+    def send_prepare(self, *args):
+        self._buffer(None, 'prepare', args)
+
+    def send_accept(self, *args):
+        self._buffer(None, 'accept', args)
+
+    def send_accepted(self, *args):
+        self._buffer(None, 'accepted', args)
+
+    def send_heartbeat(self, *args):
+        self._buffer(None, 'heartbeat', args)
+
+    def send_leadership_proclamation(self, *args):
+        self._buffer(None, 'leadership_proclamation', args)
+
+
+    # Directed messages
+
+    def send_promise(self, to_uid, *args):
+        self._buffer(to_uid, 'promise', args)
+
+    def send_prepare_nack(self, to_uid, *args):
+        self._buffer(to_uid, 'prepare_nack', args)
+
+    def send_accept_nack(self, to_uid, *args):
+        self._buffer(to_uid, 'accept_nack', args)
+
+
+
+def dispatch_frame(node, from_uid, messages):
+    '''
+    Delivers each message in a frame produced by BatchingMessenger to the
+    corresponding recv_* method of the node
+    '''
+    for name, args in messages:
+        getattr(node, RECV_METHODS[name])(from_uid, *args)
@@ -30,16 +30,70 @@ Design Approach:
 * Toggle writes between two different files
 * Include a monotonically incrementing serial number in each write to
   allow determination of the most recent version
-* md5sum the entire content of the data to be written and prefix the write
-  with the digest
-* fsync() after each write
+* Checksum the entire content of the data to be written and prefix the write
+  with the digest. The checksum algorithm is selectable and is recorded in
+  the header. CRC32 is used by default as it is sufficient for detecting
+  torn writes and considerably faster than a cryptographic hash.
+  Additional algorithms may be added with register_checksum().
+* Encode the object with a selectable serializer, also recorded in the
+  header. Objects are pickled by default. The compact "acceptor" serializer
+  encodes practical.Acceptor state without pickle's overhead and may be
+  loaded without executing arbitrary code. Additional serializers may be
+  added with register_serializer().
+* Optionally compress large serialized objects. The compression algorithm
+  is also recorded in the header.
+* Optionally, record small changes as patches appended to the current file
+  rather than rewriting the entire object. The patches are periodically
+  folded into a new full image.
+* fsync() after each write. Alternative sync strategies, such as O_DSYNC
+  files, preallocated files and periodic syncing, may be selected for each
+  DurableObjectHandler. MemoryObjectHandler provides an explicitly unsafe
+  in-memory equivalent for use in tests.
+
+The GroupCommitter class builds upon DurableObjectHandler to amortize the cost
+of each fsync() over many Paxos Acceptors. Rather than saving each Acceptor
+independently, Acceptors requiring persistence are registered with the
+committer and all of them are written by a single save() call.
+
+When a process hosts many durable objects, recover_all() may be used at
+startup to recover all of them concurrently with a pool of workers.
+
+The BackgroundSaver class moves the write and fsync() of a handler onto a
+worker thread so that the application's event loop may continue processing
+messages during disk I/O. Completion callbacks, such as Acceptor.persisted(),
+are invoked back on the event loop thread once the save is durable.
+
+The WriteAheadLog class provides an alternative to rewriting the complete
+state on every save. Each change is appended to the log as a small record
+using the same checksummed format as the DurableObjectHandler files. The log
+is split into segment files of bounded size and, on recovery, records are
+read back up to the last valid record. A torn write at the end of the log
+is truncated away. To bound disk usage and recovery time, the application
+may periodically hand the log a snapshot of its state, after which the
+segments holding the records covered by the snapshot are deleted.
+
+The DurableObjectStore class uses a WriteAheadLog to store the state of
+many objects in a single set of files. Each commit appends one record
+holding the state of just the objects that changed, so the cost of a commit
+is independent of the total number of objects stored. It shares the add()
+and commit() interface of GroupCommitter via their Committer base class.
 
 '''
 
 import os
 import os.path
+import errno
 import hashlib
 import struct
+import collections
+import copy
+import zlib
+import time
+import threading
+import mmap
+import multiprocessing.pool
+
+from paxos.essential import ProposalID
 
 try:
     import cPickle as pickle
@@ -70,10 +124,18 @@ if _fsync is None:
 
 # File format
 #
-#  0:  md5sum of file content
+#  0:  digest of bytes 16+, zero padded to 16 bytes
 # 16:  serial_number
-# 24:  pickle_length
-# 32+: pickle_data
+# 24:  checksum_id
+# 25:  serializer_id
+# 26:  compression_id
+# 27:  data_length (5 bytes)
+# 32+: serialized, and possibly compressed, data
+#
+# Files written prior to the introduction of selectable checksums,
+# serializers and compression always contain uncompressed pickle data with
+# md5 digests and have zero checksum_id, serializer_id and compression_id
+# bytes, which are the ids assigned to md5, pickle and no compression.
 
 class DurabilityFailure (Exception):
     pass
@@ -90,117 +152,833 @@ class HashMismatch (FileCorrupted):
 class FileTruncated (FileCorrupted):
     pass
 
+class UnknownFormat (FileCorrupted):
+    pass
+
+
+_header      = struct.Struct('>16sQQ')
+_length_mask = (1 << 40) - 1
+
+
+CHECKSUMS        = dict() # maps name => (checksum_id, function)
+_checksum_funcs  = dict() # maps checksum_id => function
+
+DEFAULT_CHECKSUM = 'crc32'
+
+
+def register_checksum( name, checksum_id, func ):
+    '''
+    Registers an integrity function for use by this module. The function is
+    called with the byte strings to be protected and must return a digest
+    of no more than 16 bytes. The checksum_id is recorded in the header of
+    each file and must be in the range 0-255.
+    '''
+    CHECKSUMS[ name ]              = (checksum_id, func)
+    _checksum_funcs[ checksum_id ] = func
+
+
+def _md5( *parts ):
+    m = hashlib.md5()
+    for p in parts:
+        m.update( p )
+    return m.digest()
+
+
+def _crc32( *parts ):
+    crc = 0
+    for p in parts:
+        crc = zlib.crc32(p, crc)
+    return struct.pack('>I', crc & 0xFFFFFFFF)
+
+
+def _blake2b( *parts ):
+    m = hashlib.blake2b(digest_size=16)
+    for p in parts:
+        m.update( p )
+    return m.digest()
+
+
+register_checksum('md5',   0, _md5)
+register_checksum('crc32', 1, _crc32)
+
+if hasattr(hashlib, 'blake2b'):
+    register_checksum('blake2b', 2, _blake2b)
+
+
+
+SERIALIZERS        = dict() # maps name => (serializer_id, serializer)
+_serializers       = dict() # maps serializer_id => serializer
+
+DEFAULT_SERIALIZER = 'pickle'
+
+
+def register_serializer( name, serializer_id, serializer ):
+    '''
+    Registers a serializer for use by this module. Serializers must provide
+    dumps(obj) and loads(data) methods that convert objects to and from
+    byte strings. The serializer_id is recorded in the header of each file
+    and must be in the range 0-255. Serializers that cannot encode the
+    patches passed to DurableObjectHandler.save_delta() should define a
+    'deltas' attribute of False.
+    '''
+    SERIALIZERS[ name ]           = (serializer_id, serializer)
+    _serializers[ serializer_id ] = serializer
+
+
+
+class PickleSerializer (object):
+    '''
+    Serializes arbitrary Python objects with the highest available pickle
+    protocol.
+    '''
+
+    def dumps(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+
+class AcceptorStateSerializer (object):
+    '''
+    Serializes the (promised_id, accepted_id, accepted_value) tuple used as
+    the persistent state of practical.Acceptor instances. Proposal ids are
+    encoded as fixed-size headers followed by the uid, which must be a byte
+    string, a text string, or an integer. The accepted value must be a
+    byte string or None. Decoded proposal ids are ProposalID instances.
+    Patches cannot be encoded so save_delta() is not supported.
+    '''
+
+    deltas = False
+
+    _pid   = struct.Struct('>BQH') # uid type, proposal number, uid length
+    _value = struct.Struct('>BI')  # present flag, value length
+
+    UID_NONE  = 0
+    UID_BYTES = 1
+    UID_TEXT  = 2
+    UID_INT   = 3
+
+    def _dump_pid(self, parts, pid):
+        if pid is None:
+            parts.append( self._pid.pack(self.UID_NONE, 0, 0) )
+            return
+
+        number, uid = pid
+
+        if isinstance(uid, bytes):
+            kind = self.UID_BYTES
+        elif isinstance(uid, type(u'')):
+            kind, uid = self.UID_TEXT, uid.encode('utf-8')
+        elif isinstance(uid, int) and not isinstance(uid, bool):
+            kind, uid = self.UID_INT, str(uid).encode('ascii')
+        else:
+            raise TypeError('Unsupported proposal uid type: %r' % (uid,))
+
+        parts.append( self._pid.pack(kind, number, len(uid)) )
+        parts.append( uid )
+
+
+    def _load_pid(self, data, offset):
+        kind, number, length = self._pid.unpack_from(data, offset)
+
+        offset += self._pid.size
+        uid     = data[offset : offset + length]
+        offset += length
+
+        if len(uid) != length:
+            raise FileCorrupted()
+
+        if kind == self.UID_NONE:
+            return None, offset
+        elif kind == self.UID_BYTES:
+            return ProposalID(number, uid), offset
+        elif kind == self.UID_TEXT:
+            return ProposalID(number, uid.decode('utf-8')), offset
+        elif kind == self.UID_INT:
+            return ProposalID(number, int(uid)), offset
+        else:
+            raise UnknownFormat()
+
+
+    def dumps(self, state):
+        promised_id, accepted_id, accepted_value = state
+
+        parts = list()
+
+        self._dump_pid( parts, promised_id )
+        self._dump_pid( parts, accepted_id )
+
+        if accepted_value is None:
+            parts.append( self._value.pack(0, 0) )
+        elif isinstance(accepted_value, bytes):
+            parts.append( self._value.pack(1, len(accepted_value)) )
+            parts.append( accepted_value )
+        else:
+            raise TypeError('Accepted values must be byte strings')
+
+        return b''.join(parts)
+
+
+    def loads(self, data):
+        try:
+            promised_id, offset = self._load_pid(data, 0)
+            accepted_id, offset = self._load_pid(data, offset)
+
+            present, length = self._value.unpack_from(data, offset)
+        except struct.error:
+            raise FileTruncated()
+
+        offset += self._value.size
+        value   = data[offset : offset + length] if present else None
+
+        if offset + length != len(data):
+            raise FileCorrupted()
+
+        return promised_id, accepted_id, value
+
+
+class OutOfBandPickleSerializer (object):
+    '''
+    Serializes arbitrary Python objects with pickle protocol 5. Byte strings
+    and bytearrays of at least 'threshold' bytes, held directly or within
+    tuples (including namedtuples), lists and dictionaries, are stored
+    out-of-band: dumps_parts() returns them as separate buffers that
+    reference the caller's memory, so they are written to disk without
+    being copied into the pickle.
+
+    On recovery, out-of-band values are returned as read-only memoryviews
+    over the data passed to loads(). DurableObjectHandler passes a view of
+    its memory mapped file so these values are not copied at all. Note that
+    the values are therefore memoryviews rather than bytes. Only available
+    with Python 3.8 and later.
+    '''
+
+    zero_copy = True
+    threshold = 64 * 1024
+
+    _counts = struct.Struct('>IQ') # number of buffers, pickle length
+
+    def __init__(self, threshold=None):
+        if threshold is not None: self.threshold = threshold
+
+
+    def _wrap(self, obj):
+        '''
+        Returns the object with large byte strings replaced by PickleBuffers.
+        Pickler.reducer_override() cannot be used for this as it is not
+        called for bytes instances. Memoryviews, which cannot otherwise be
+        pickled, are converted as well.
+        '''
+        t = type(obj)
+
+        if t in (bytes, bytearray):
+            return pickle.PickleBuffer(obj) if len(obj) >= self.threshold else obj
+        elif t is memoryview:
+            # Typically a value recovered by a previous loads()
+            return pickle.PickleBuffer(obj) if obj.nbytes >= self.threshold else obj.tobytes()
+        elif t in (tuple, list):
+            return t( self._wrap(o) for o in obj )
+        elif t is dict:
+            return dict( (k, self._wrap(v)) for k, v in obj.items() )
+        elif isinstance(obj, tuple) and hasattr(obj, '_make'):
+            return obj._make( self._wrap(o) for o in obj )
+        else:
+            return obj
+
+
+    def dumps_parts(self, obj):
+        buffers = list()
+        pdata   = pickle.dumps(self._wrap(obj), protocol=5, buffer_callback=buffers.append)
+        views   = [ b.raw() for b in buffers ]
+        prefix = self._counts.pack(len(views), len(pdata)) + \
+                 struct.pack('>%dQ' % len(views), *[ len(v) for v in views ])
+
+        return [ prefix, pdata ] + views
+
+
+    def dumps(self, obj):
+        return b''.join( self.dumps_parts(obj) )
+
+
+    def loads(self, data):
+        view = memoryview(data)
+
+        try:
+            nbuffers, plen = self._counts.unpack_from(view, 0)
+            offset         = self._counts.size
+            lengths        = struct.unpack_from('>%dQ' % nbuffers, view, offset)
+        except struct.error:
+            raise FileTruncated()
+
+        offset  += 8 * nbuffers
+        pdata    = view[offset : offset + plen]
+        offset  += plen
+        buffers  = list()
+
+        for length in lengths:
+            buffers.append( view[offset : offset + length].toreadonly() )
+            offset += length
+
+        if offset != len(view):
+            raise FileCorrupted()
+
+        return pickle.loads(pdata, buffers=buffers)
+
+
+
+register_serializer('pickle',   0, PickleSerializer())
+register_serializer('acceptor', 1, AcceptorStateSerializer())
+
+if pickle.HIGHEST_PROTOCOL >= 5 and hasattr(pickle, 'PickleBuffer'):
+    register_serializer('pickle5', 2, OutOfBandPickleSerializer())
+
+
+
+COMPRESSORS    = dict() # maps name => (compression_id, compress, decompress)
+_decompressors = dict() # maps compression_id => decompress
+
+
+def register_compressor( name, compression_id, compress, decompress ):
+    '''
+    Registers a compression algorithm for use by this module. compress() is
+    called with the data and a compression level, which is None to request
+    the algorithm's default level. decompress() is called with the
+    compressed data. The compression_id is recorded in the header of each
+    file and must be in the range 1-255. Id 0 denotes uncompressed data.
+    '''
+    COMPRESSORS[ name ]              = (compression_id, compress, decompress)
+    _decompressors[ compression_id ] = decompress
+
+
+register_compressor('zlib', 1,
+                    lambda data, level : zlib.compress(data, 6 if level is None else level),
+                    zlib.decompress)
+
+try:
+    import lzma
+    register_compressor('lzma', 2,
+                        lambda data, level : lzma.compress(data, preset=level),
+                        lzma.decompress)
+except ImportError:
+    pass
+
 
 
 def read( fd ):
     '''
-    Returns: (serial_number, unpickled_object) or raises a FileCorrupted exception
+    Returns: (serial_number, deserialized_object) or raises a FileCorrupted exception
     '''
     os.lseek(fd, 0, os.SEEK_SET)
         
-    md5hash       = os.read(fd, 16)
+    digest        = os.read(fd, 16)
     data1         = os.read(fd, 8)
     data2         = os.read(fd, 8)
     
-    if ( (not md5hash or len(md5hash) != 16) or
-         (not data1   or len(data1)   !=  8) or
-         (not data2   or len(data2)   !=  8) ):
+    if ( (not digest or len(digest) != 16) or
+         (not data1  or len(data1)  !=  8) or
+         (not data2  or len(data2)  !=  8) ):
         raise FileTruncated()
     
-    serial_number = struct.unpack('>Q', data1)[0]
-    pickle_length = struct.unpack('>Q', data2)[0]
+    serial_number                                           = struct.unpack('>Q', data1)[0]
+    checksum_id, serializer_id, compression_id, data_length = _unpack_info(data2)
 
-    data3         = os.read(fd, pickle_length)
+    data3         = os.read(fd, data_length)
 
-    if not data3 or len(data3) != pickle_length:
+    if not data3 or len(data3) != data_length:
         raise FileTruncated()
 
-    m = hashlib.md5()
-    m.update( data1 )
-    m.update( data2 )
-    m.update( data3 )
-    
-    if not m.digest() == md5hash:
+    if not _digest( checksum_id, data1, data2, data3 ) == digest:
         raise HashMismatch()
     
-    return serial_number, pickle.loads(data3)
+    return serial_number, _loads(serializer_id, data3, compression_id)
     
 
     
-def write( fd, serial_number, pyobject ):
-    os.lseek(fd, 0, os.SEEK_SET)
+def write( fd, serial_number, pyobject, checksum=DEFAULT_CHECKSUM,
+           serializer=DEFAULT_SERIALIZER, compression=None, compression_level=None,
+           compress_threshold=0 ):
+    _pwrite_parts(fd, encode_parts(serial_number, pyobject, checksum, serializer,
+                                   compression, compression_level, compress_threshold), 0)
+
+    _fsync(fd)
+
+
+
+# When available, os.pwritev/os.writev pass the header and serialized object
+# to the kernel as separate buffers. This avoids both the lseek() system call
+# and the copy of the entire object that joining them into a single string
+# would require. Older Pythons fall back to joining the buffers.
+#
+try:
+    _iov_max = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _iov_max = 16
+
+
+if hasattr(os, 'pwritev'):
+    def _pwrite_parts( fd, parts, offset ):
+        if len(parts) > _iov_max:
+            parts = [ b''.join(parts) ]
+        os.pwritev(fd, parts, offset)
+else:
+    def _pwrite_parts( fd, parts, offset ):
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, b''.join(parts))
+
+
+if hasattr(os, 'writev'):
+    def _write_parts( fd, parts ):
+        if len(parts) > _iov_max:
+            parts = [ b''.join(parts) ]
+        os.writev(fd, parts)
+else:
+    def _write_parts( fd, parts ):
+        os.write(fd, b''.join(parts))
+
+
+
+def encode( serial_number, pyobject, checksum=DEFAULT_CHECKSUM,
+            serializer=DEFAULT_SERIALIZER, compression=None, compression_level=None,
+            compress_threshold=0 ):
+    '''
+    Returns the on-disk representation of the object, header included
+    '''
+    return b''.join( encode_parts(serial_number, pyobject, checksum, serializer,
+                                  compression, compression_level, compress_threshold) )
+
+
+
+def encode_parts( serial_number, pyobject, checksum=DEFAULT_CHECKSUM,
+                  serializer=DEFAULT_SERIALIZER, compression=None, compression_level=None,
+                  compress_threshold=0 ):
+    '''
+    Returns the on-disk representation of the object as a list of buffers,
+    the header followed by the serialized object, suitable for vectored
+    writes. Serializers providing a dumps_parts() method may return the
+    object as several buffers. If a compression
+    algorithm is named, serialized objects of at least 'compress_threshold'
+    bytes are compressed unless compression fails to reduce their size.
+    '''
+    checksum_id                = CHECKSUMS[checksum][0]
+    serializer_id, serializer  = SERIALIZERS[serializer]
+    compression_id             = 0
+
+    if hasattr(serializer, 'dumps_parts'):
+        data_parts = serializer.dumps_parts(pyobject)
+    else:
+        data_parts = [ serializer.dumps(pyobject) ]
+
+    data_size = sum( len(p) for p in data_parts )
+
+    if compression is not None and data_size >= compress_threshold:
+        cid, compress, decompress = COMPRESSORS[compression]
+        compressed                = compress(b''.join(data_parts), compression_level)
+
+        if len(compressed) < data_size:
+            compression_id, data_parts, data_size = cid, [compressed], len(compressed)
 
-    data_pickle = pickle.dumps(pyobject, pickle.HIGHEST_PROTOCOL)
     data_serial = struct.pack('>Q', serial_number)
-    data_length = struct.pack('>Q', len(data_pickle))
+    data_length = struct.pack('>Q', _pack_info(checksum_id, serializer_id, data_size,
+                                               compression_id))
+    digest      = _digest(checksum_id, data_serial, data_length, *data_parts)
 
-    m = hashlib.md5()
-    m.update( data_serial )
-    m.update( data_length )
-    m.update( data_pickle )
+    return [ b''.join([digest, data_serial, data_length]) ] + data_parts
 
-    os.write(fd, ''.join([m.digest(), data_serial, data_length, data_pickle]))
 
-    _fsync(fd)
+
+def _pack_info( checksum_id, serializer_id, data_length, compression_id=0 ):
+    return (checksum_id << 56) | (serializer_id << 48) | (compression_id << 40) | data_length
+
+
+
+def _unpack_info( data_length ):
+    '''
+    Returns the (checksum_id, serializer_id, compression_id, data_length)
+    tuple encoded in the length field
+    '''
+    value = struct.unpack('>Q', data_length)[0]
+    return value >> 56, (value >> 48) & 0xFF, (value >> 40) & 0xFF, value & _length_mask
+
+
+
+def _loads( serializer_id, data, compression_id=0 ):
+    serializer = _serializers.get(serializer_id)
+
+    if serializer is None:
+        raise UnknownFormat()
+
+    if compression_id:
+        decompress = _decompressors.get(compression_id)
+
+        if decompress is None:
+            raise UnknownFormat()
+
+        data = decompress(data)
+
+    return serializer.loads(data)
+
+
+
+def _digest( checksum_id, data_serial, data_length, *data ):
+    func = _checksum_funcs.get(checksum_id)
+    
+    if func is None:
+        raise UnknownFormat()
+    
+    return func(data_serial, data_length, *data).ljust(16, b'\0')
+
+
+
+def _sync_dir( dirname ):
+    if hasattr(os, 'O_DIRECTORY'):
+        fdd = os.open(dirname, os.O_DIRECTORY | os.O_RDONLY)
+        os.fsync(fdd)
+        os.close(fdd)
+
+
+_bin_flag = 0 if not hasattr(os, 'O_BINARY') else os.O_BINARY
+
+
+
+class SyncStrategy (object):
+    '''
+    Determines how DurableObjectHandler files are flushed to stable media.
+    This default strategy calls fdatasync() (or the closest available
+    equivalent) after every write.
+    '''
+
+    open_flags = 0
+
+    def opened(self, fd):
+        '''
+        Called for each file opened by a handler
+        '''
+
+    def closing(self, fd):
+        '''
+        Called for each file prior to its being closed by a handler
+        '''
+
+    def sync(self, fd):
+        '''
+        Called after each write. The write is durable once this returns.
+        '''
+        _fsync(fd)
+
+
+
+class DSyncStrategy (SyncStrategy):
+    '''
+    Opens files with O_DSYNC so that each write() call returns only once its
+    data has reached stable media, avoiding a separate sync system call.
+    Falls back to the default strategy where O_DSYNC is unavailable.
+    '''
+
+    open_flags = getattr(os, 'O_DSYNC', 0)
+
+    def sync(self, fd):
+        if not self.open_flags:
+            _fsync(fd)
+
+
+
+class PreallocatedSyncStrategy (SyncStrategy):
+    '''
+    Extends each file to 'size' bytes of zeros before its first use. As long
+    as saved objects fit within the preallocated space, writes never change
+    the file size or block allocation so fdatasync() need not update any
+    file system metadata.
+    '''
+
+    size       = 64 * 1024
+    chunk_size = 64 * 1024
+
+    def __init__(self, size=None):
+        if size: self.size = size
+
+
+    def opened(self, fd):
+        current = os.fstat(fd).st_size
+
+        if current >= self.size:
+            return
+
+        # Zeros are explicitly written, rather than using ftruncate() or
+        # posix_fallocate(), to ensure that the blocks are both allocated and
+        # initialized. Otherwise the first write to each block would update
+        # the file system's extent metadata.
+        zeros = b'\0' * self.chunk_size
+
+        while current < self.size:
+            n        = min(self.chunk_size, self.size - current)
+            current += _write_at(fd, zeros[:n], current)
+
+        os.fsync(fd)
+
+
+
+if hasattr(os, 'pwrite'):
+    _write_at = os.pwrite
+else:
+    def _write_at( fd, data, offset ):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+
+
+class PeriodicSyncStrategy (SyncStrategy):
+    '''
+    Defers syncing until at least 'interval' seconds have elapsed since the
+    previous sync, at which point all files written in the meantime are
+    synced together. flush() may be called to sync them immediately.
+
+    Without further help, a deferred sync only happens when a later save
+    finds the interval has elapsed, or when the file is closed. To bound the
+    time written data may remain unsynced when saves stop, a 'schedule'
+    function with the signature of asyncio's loop.call_later(delay, func)
+    may be supplied. It is called whenever a write leaves data unsynced and
+    no flush is already scheduled. Otherwise the application must call
+    flush() on its own schedule. The function is called from the thread
+    performing the save, which is the worker thread of a BackgroundSaver, so
+    it must be safe to call from that thread. The flush itself may run on
+    any thread.
+
+    Saves are NOT durable when save() returns. This strategy is suitable
+    only for non-critical data, which excludes the state of Paxos Acceptors
+    unless the application delays sending Promise and Accepted messages
+    until the next flush.
+    '''
+
+    interval  = 1.0
+
+    timestamp = time.time
+
+    def __init__(self, interval=None, schedule=None):
+        self.dirty     = set()
+        self.last_sync = self.timestamp()
+        self.schedule  = schedule
+        self.scheduled = False
+        self.lock      = threading.Lock()
+
+        if interval is not None: self.interval = interval
+
+
+    def closing(self, fd):
+        with self.lock:
+            if fd in self.dirty:
+                self.dirty.discard(fd)
+                _fsync(fd)
+
+
+    def sync(self, fd):
+        with self.lock:
+            self.dirty.add(fd)
+
+            delay = self.last_sync + self.interval - self.timestamp()
+            arm   = delay > 0 and self.schedule is not None and not self.scheduled
+
+            if arm:
+                self.scheduled = True
+
+        if delay <= 0:
+            self.flush()
+        elif arm:
+            self.schedule( delay, self._scheduled_flush )
+
+
+    def _scheduled_flush(self):
+        self.scheduled = False
+        self.flush()
+
+
+    def flush(self):
+        '''
+        Syncs all files written since the last sync
+        '''
+        with self.lock:
+            dirty      = self.dirty
+            self.dirty = set()
+
+            for fd in dirty:
+                _fsync(fd)
+
+            self.last_sync = self.timestamp()
+
+
+
+SYNC_STRATEGIES = { 'fdatasync'   : SyncStrategy,
+                    'dsync'       : DSyncStrategy,
+                    'preallocate' : PreallocatedSyncStrategy,
+                    'periodic'    : PeriodicSyncStrategy }
 
 
 class DurableObjectHandler (object):
+
+    checksum           = DEFAULT_CHECKSUM
+    serializer         = DEFAULT_SERIALIZER
+    max_deltas         = 100
+    compression        = None
+    compression_level  = None
+    compress_threshold = 1024
+    read_only          = False
     
-    def __init__(self, dirname, object_id):
+    def __init__(self, dirname, object_id, checksum=None, serializer=None, sync=None,
+                 max_deltas=None, compression=None, compression_level=None,
+                 compress_threshold=None, read_only=False):
         '''
-        Throws UnrecoverableFailure if both files are corrupted
+        Throws UnrecoverableFailure if both files are corrupted. The optional
+        'checksum' and 'serializer' arguments name the integrity function and
+        serializer used for subsequent saves. Files written with any
+        registered function and serializer may be recovered. The 'sync'
+        argument may be a SyncStrategy instance or the name of one of the
+        SYNC_STRATEGIES. It defaults to SyncStrategy. 'max_deltas' bounds
+        the number of patches recorded by save_delta() between full saves.
+
+        If 'compression' names one of the COMPRESSORS, saved data of at least
+        'compress_threshold' bytes is compressed at the given
+        'compression_level'. The algorithm used is recorded in each file so
+        the compression setting may be changed freely between restarts.
+
+        If 'read_only' is True, the object is recovered without creating,
+        modifying or preparing any file. Missing files are treated as empty,
+        close() records no clean shutdown marker and saves are not permitted.
         '''
         
         if not os.path.isdir(dirname):
             raise Exception('Invalid directory: ' + dirname)
 
+        if checksum:
+            if checksum not in CHECKSUMS:
+                raise ValueError('Unknown checksum: ' + checksum)
+            self.checksum = checksum
+
+        if serializer:
+            if serializer not in SERIALIZERS:
+                raise ValueError('Unknown serializer: ' + serializer)
+            self.serializer = serializer
+
+        if sync is None:
+            sync = SyncStrategy()
+        elif not isinstance(sync, SyncStrategy):
+            if sync not in SYNC_STRATEGIES:
+                raise ValueError('Unknown sync strategy: ' + sync)
+            sync = SYNC_STRATEGIES[ sync ]()
+
+        self.sync_strategy = sync
+
+        if max_deltas is not None: self.max_deltas = max_deltas
+
+        if compression:
+            if compression not in COMPRESSORS:
+                raise ValueError('Unknown compression: ' + compression)
+            self.compression = compression
+
+        if compression_level is not None:  self.compression_level  = compression_level
+        if compress_threshold is not None: self.compress_threshold = compress_threshold
+
         sid = str(object_id)
 
-        self.fn_a = os.path.join(dirname, sid + '_a.durable')
-        self.fn_b = os.path.join(dirname, sid + '_b.durable')
+        self.fn_a     = os.path.join(dirname, sid + '_a.durable')
+        self.fn_b     = os.path.join(dirname, sid + '_b.durable')
+        self.fn_clean = os.path.join(dirname, sid + '.clean')
+
+        if read_only:
+            self.read_only = True
+            self.fd_a      = _open_existing(self.fn_a)
+            self.fd_b      = _open_existing(self.fn_b)
+            self.recover()
+            return
 
         sync_dir = False
         
         if not os.path.exists(self.fn_a) or not os.path.exists(self.fn_b):
             sync_dir = True
 
-        bin_flag = 0 if not hasattr(os, 'O_BINARY') else os.O_BINARY
-        
-        self.fd_a = os.open(self.fn_a, os.O_CREAT | os.O_RDWR | bin_flag)
-        self.fd_b = os.open(self.fn_b, os.O_CREAT | os.O_RDWR | bin_flag)
+        flags     = os.O_CREAT | os.O_RDWR | _bin_flag | sync.open_flags
+
+        self.fd_a = os.open(self.fn_a, flags)
+        self.fd_b = os.open(self.fn_b, flags)
 
-        if sync_dir and hasattr(os, 'O_DIRECTORY'):
-            fdd = os.open(dirname, os.O_DIRECTORY | os.O_RDONLY)
-            os.fsync(fdd)
-            os.close(fdd)
+        sync.opened(self.fd_a)
+        sync.opened(self.fd_b)
+
+        if sync_dir:
+            _sync_dir(dirname)
 
         self.recover()
 
 
     def recover(self):
+        '''
+        Only the headers of the two files are initially examined. The file
+        with the higher serial number is verified and deserialized first and
+        the other file is read only if that fails. The files are memory
+        mapped so that only the pages actually examined are read from disk.
 
-        sa, sb, obja, objb = (None, None, None, None)
-            
-        try:
-            sa, obja = read(self.fd_a)
-        except FileCorrupted:
-            pass
+        If the previous handler was closed cleanly, its close() recorded the
+        header of the newest file in a marker file. When the newest header
+        still matches the marker, the file is known to be intact and its
+        checksum is not verified. The 'clean_shutdown' attribute is set to
+        True in this case.
+        '''
+        s, obj, fd = (None, None, None)
+
+        clean_header        = self._read_clean_marker()
+        self.clean_shutdown = False
+
+        maps       = [ (_map(self.fd_a), self.fd_b), (_map(self.fd_b), self.fd_a) ]
+        candidates = list()
 
         try:
-            sb, objb = read(self.fd_b)
-        except FileCorrupted:
-            pass
+            for m, other_fd in maps:
+                try:
+                    candidates.append( (_mapped_serial(m), m, other_fd) )
+                except FileCorrupted:
+                    pass
 
-        if sa is not None and sb is not None:
-            s, obj, fd = (sa, obja, self.fd_b) if sa > sb else (sb, objb, self.fd_a)
-        else:
-            s, obj, fd = (sa, obja, self.fd_b) if sa is not None else (sb, objb, self.fd_a)
+            candidates.sort( key = lambda c : c[0], reverse=True )
+
+            for serial, m, other_fd in candidates:
+                trusted = clean_header is not None and m[:_header.size] == clean_header
+                try:
+                    obj, tail = _load_candidate(m, trusted)
+                    s, fd     = serial, other_fd
+                    self.clean_shutdown = trusted
+
+                    for s, offset, length, serializer_id, compression_id in \
+                            _scan_records(m, serial + 1, tail):
+                        obj  = self.apply_delta( obj, _loads(serializer_id, m[offset:offset+length],
+                                                             compression_id) )
+                        tail = offset + length
+
+                    self.ndeltas = s - serial
+                    break
+                except FileCorrupted:
+                    pass
+                finally:
+                    clean_header = None # Only the newest file may be trusted
+        finally:
+            self.pinned_fd = None
+
+            for m, other_fd in maps:
+                if m is not None:
+                    try:
+                        m.close()
+                    except BufferError:
+                        # Zero-copy values in the recovered object reference
+                        # the mapping. The file must not be overwritten.
+                        self.pinned_fd = self.fd_a if other_fd == self.fd_b else self.fd_b
                 
         if s is None:
-            if os.stat(self.fn_a).st_size == 0 and os.stat(self.fn_b).st_size == 0:
+            if _unwritten(self.fd_a) and _unwritten(self.fd_b):
                 self.serial    = 1
                 self.fd_next   = self.fd_a
                 self.recovered = None
+                self.current   = None
+                self.tail      = None
+                self.ndeltas   = 0
             else:
                 raise UnrecoverableFailure('Unrecoverable Durability failure')
             
@@ -208,26 +986,1075 @@ class DurableObjectHandler (object):
             self.serial    = s + 1
             self.fd_next   = fd
             self.recovered = obj
+            self.current   = obj
+            self.tail      = tail
 
         return self.recovered
 
 
+    def _read_clean_marker(self):
+        '''
+        Returns the header recorded by the last clean close() or None
+        '''
+        if not os.path.exists(self.fn_clean):
+            return None
+
+        fd = os.open(self.fn_clean, os.O_RDONLY | _bin_flag)
+        try:
+            return read(fd)[1]
+        except FileCorrupted:
+            return None
+        finally:
+            os.close(fd)
+
+
+    def _write_clean_marker(self):
+        # The marker is not synced. If it is lost or torn, the next
+        # recovery simply verifies the newest file's checksum as usual.
+        newest = self.fd_a if self.fd_next == self.fd_b else self.fd_b
+
+        os.lseek(newest, 0, os.SEEK_SET)
+        header = os.read(newest, _header.size)
+
+        fd = os.open(self.fn_clean, os.O_CREAT | os.O_WRONLY | os.O_TRUNC | _bin_flag)
+        try:
+            os.write(fd, encode(0, header, self.checksum))
+        finally:
+            os.close(fd)
+
+
     def close(self):
-        if self.fd_a is not None:
+        '''
+        Closes the files and records a clean shutdown marker
+        '''
+        if self.read_only:
+            for fd in (self.fd_a, self.fd_b):
+                if fd is not None:
+                    os.close(fd)
+            self.fd_a = None
+            self.fd_b = None
+
+        elif self.fd_a is not None:
+            self.sync_strategy.closing(self.fd_a)
+            self.sync_strategy.closing(self.fd_b)
+            if self.serial > 1:
+                self._write_clean_marker()
             os.close(self.fd_a)
             os.close(self.fd_b)
             self.fd_a = None
             self.fd_b = None
 
             
+    def _replace_pinned(self):
+        '''
+        Replaces the file backing the memory mapped values of the recovered
+        object with a new, empty file so that the values remain unmodified
+        '''
+        old = self.pinned_fd
+        fn  = self.fn_a if old == self.fd_a else self.fn_b
+        tmp = fn + '.tmp'
+
+        fd  = os.open(tmp, os.O_CREAT | os.O_TRUNC | os.O_RDWR | _bin_flag |
+                      self.sync_strategy.open_flags)
+
+        self.sync_strategy.opened(fd)
+
+        os.rename(tmp, fn)
+        _sync_dir(os.path.dirname(fn))
+
+        self.sync_strategy.closing(old)
+        os.close(old)
+
+        if old == self.fd_a:
+            self.fd_a = fd
+        else:
+            self.fd_b = fd
+
+        if self.fd_next == old:
+            self.fd_next = fd
+
+        self.pinned_fd = None
+
+            
     def save(self, obj):
+        if self.read_only:
+            raise DurabilityFailure('Handler is read only')
+
+        if self.pinned_fd is not None and self.pinned_fd == self.fd_next:
+            self._replace_pinned()
+
         serial = self.serial
         fd     = self.fd_next
+
+        if self.clean_shutdown:
+            # Newer saves render the marker obsolete. As the marker is only
+            # trusted when it matches the newest header, which this save
+            # changes, the removal need not be made durable.
+            self.clean_shutdown = False
+            try:
+                os.unlink(self.fn_clean)
+            except OSError:
+                pass
         
         self.serial += 1
         self.fd_next = self.fd_a if self.fd_next == self.fd_b else self.fd_b
         self.recovered = None
     
-        write( fd, serial, obj )
+        parts = encode_parts(serial, obj, self.checksum, self.serializer, self.compression,
+                             self.compression_level, self.compress_threshold)
 
-        
+        _pwrite_parts(fd, parts, 0)
+
+        self.sync_strategy.sync(fd)
+
+        self.current = obj
+        self.tail    = sum( len(p) for p in parts )
+        self.ndeltas = 0
+
+
+    def save_delta(self, patch):
+        '''
+        Durably records a change to the most recently saved object without
+        rewriting the object. The patch is passed to apply_delta() to obtain
+        the new object both now and during recovery. Patches are appended to
+        the file holding the current full image and are encoded with the
+        handler's serializer, which must be able to encode them. Once
+        'max_deltas' patches have been appended, the patched object is
+        folded into a new full image with save() instead.
+
+        A full save() must precede the first patch. As with save(), neither
+        the patched object nor the patch may be modified afterwards.
+        '''
+        if self.read_only:
+            raise DurabilityFailure('Handler is read only')
+
+        if not getattr(SERIALIZERS[self.serializer][1], 'deltas', True):
+            raise DurabilityFailure('The %s serializer does not support deltas' % self.serializer)
+
+        if self.tail is None:
+            raise DurabilityFailure('A full save is required prior to saving deltas')
+
+        obj = self.apply_delta( self.current, patch )
+
+        if self.ndeltas >= self.max_deltas:
+            self.save( obj )
+            return
+
+        fd     = self.fd_a if self.fd_next == self.fd_b else self.fd_b
+        parts  = encode_parts(self.serial, patch, self.checksum, self.serializer,
+                              self.compression, self.compression_level, self.compress_threshold)
+
+        self.serial   += 1
+        self.recovered = None
+
+        _pwrite_parts(fd, parts, self.tail)
+
+        self.sync_strategy.sync(fd)
+
+        self.current  = obj
+        self.tail    += sum( len(p) for p in parts )
+        self.ndeltas += 1
+
+
+    def apply_delta(self, obj, patch):
+        '''
+        Returns a copy of the object with the patch applied. Subclasses may
+        override this method to support other patch formats.
+        '''
+        return apply_delta(obj, patch)
+
+
+
+def apply_delta( obj, patch ):
+    '''
+    Returns a copy of the object with the patch applied. Patches are
+    dictionaries. For dictionary objects, the patch entries replace those
+    of the object. For lists and tuples, including namedtuples, the keys
+    are indices. For all other objects, the keys are attribute names.
+    '''
+    if isinstance(obj, dict):
+        obj = dict(obj)
+        obj.update( patch )
+        return obj
+
+    elif isinstance(obj, (list, tuple)):
+        items = list(obj)
+        for index, value in patch.items():
+            items[ index ] = value
+        if isinstance(obj, list):
+            return items
+        elif hasattr(obj, '_make'):
+            return obj._make(items)
+        else:
+            return tuple(items)
+
+    else:
+        obj = copy.copy(obj)
+        for name, value in patch.items():
+            setattr(obj, name, value)
+        return obj
+
+
+
+def _map( fd ):
+    '''
+    Returns a read-only memory map of the file or None if it is too small to
+    contain a header or does not exist
+    '''
+    if fd is None or os.fstat(fd).st_size < _header.size:
+        return None
+    return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+
+
+def _mapped_serial( m ):
+    '''
+    Returns the serial number from the header of a mapped file
+    '''
+    if m is None:
+        raise FileTruncated()
+    return _header.unpack_from(m, 0)[1]
+
+
+
+def _mapped_load( m, verify=True ):
+    '''
+    Verifies the checksum of a mapped file, unless 'verify' is False, and
+    returns the (deserialized_object, end_offset) tuple
+    '''
+    digest, serial, info                   = _header.unpack_from(m, 0)
+    checksum_id, serializer_id, compression_id, data_length = _unpack_info( m[24:32] )
+
+    end = _header.size + data_length
+
+    if data_length == 0 or end > len(m):
+        raise FileTruncated()
+
+    if getattr(_serializers.get(serializer_id), 'zero_copy', False) and not compression_id:
+        data = memoryview(m)[_header.size : end]
+    else:
+        data = m[_header.size : end]
+
+    if verify and _digest( checksum_id, m[16:24], m[24:32], data ) != digest:
+        raise HashMismatch()
+
+    return _loads(serializer_id, data, compression_id), end
+
+
+
+def _load_candidate( m, trusted ):
+    if trusted:
+        try:
+            return _mapped_load(m, False)
+        except Exception:
+            pass # Modified since the clean shutdown. Verify the checksum instead.
+
+    return _mapped_load(m)
+
+
+
+def _scan_records( data, serial, offset=0 ):
+    '''
+    Returns a list of (serial, offset, length, serializer_id, compression_id)
+    tuples for the consecutive valid records in the data, starting at 'offset' with a
+    record numbered 'serial'
+    '''
+    records = list()
+
+    while offset + _header.size <= len(data):
+        digest, rserial, info = _header.unpack_from(data, offset)
+
+        checksum_id   = info >> 56
+        serializer_id  = (info >> 48) & 0xFF
+        compression_id = (info >> 40) & 0xFF
+        start          = offset + _header.size
+        end            = start + (info & _length_mask)
+
+        if rserial != serial or end > len(data) or checksum_id not in _checksum_funcs:
+            break
+
+        if _digest( checksum_id, data[offset+16:offset+24], data[offset+24:start],
+                    data[start:end] ) != digest:
+            break
+
+        records.append( (serial, start, end - start, serializer_id, compression_id) )
+
+        offset  = end
+        serial += 1
+
+    return records
+
+
+
+def _open_existing( fn ):
+    '''
+    Returns a read-only file descriptor for the file or None if it does not
+    exist
+    '''
+    try:
+        return os.open(fn, os.O_RDONLY | _bin_flag)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+
+def _unwritten( fd ):
+    '''
+    Returns True if the file is missing, empty or contains only the zeroed
+    header of a preallocated file
+    '''
+    if fd is None or os.fstat(fd).st_size == 0:
+        return True
+
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.read(fd, _header.size) == b'\0' * _header.size
+
+
+
+class MemoryObjectHandler (object):
+    '''
+    An UNSAFE, in-memory replacement for DurableObjectHandler intended for
+    tests. Saved objects are encoded exactly as they would be on disk and
+    held in a process-wide dictionary so that a new handler created with the
+    same dirname and object_id recovers the last saved object. Nothing
+    survives the termination of the process.
+    '''
+
+    store      = dict() # maps (dirname, object_id) => encoded object
+
+    checksum   = DEFAULT_CHECKSUM
+    serializer = DEFAULT_SERIALIZER
+
+    def __init__(self, dirname, object_id, checksum=None, serializer=None):
+        if checksum:   self.checksum   = checksum
+        if serializer: self.serializer = serializer
+
+        self.key = (dirname, str(object_id))
+
+        self.recover()
+
+
+    def recover(self):
+        data = self.store.get(self.key)
+
+        if data is None:
+            self.serial    = 1
+            self.recovered = None
+        else:
+            checksum_id, serializer_id, compression_id, length = _unpack_info(data[24:32])
+            self.serial    = struct.unpack('>Q', data[16:24])[0] + 1
+            self.recovered = _loads(serializer_id, data[32:], compression_id)
+
+        self.current = self.recovered
+
+        return self.recovered
+
+
+    def close(self):
+        pass
+
+
+    def save(self, obj):
+        self.store[ self.key ] = encode(self.serial, obj, self.checksum, self.serializer)
+        self.serial           += 1
+        self.recovered         = None
+        self.current           = obj
+
+
+    def save_delta(self, patch):
+        '''
+        Equivalent to saving the result of apply_delta()
+        '''
+        if not getattr(SERIALIZERS[self.serializer][1], 'deltas', True):
+            raise DurabilityFailure('The %s serializer does not support deltas' % self.serializer)
+
+        if self.key not in self.store:
+            raise DurabilityFailure('A full save is required prior to saving deltas')
+
+        self.save( self.apply_delta(self.current, patch) )
+
+
+    def apply_delta(self, obj, patch):
+        return apply_delta(obj, patch)
+
+
+
+
+def list_objects( dirname ):
+    '''
+    Returns a sorted list of the ids of the DurableObjectHandler objects
+    stored in the directory. The snapshots of WriteAheadLogs, which are
+    stored with ids ending in "_snapshot", are not included.
+    '''
+    ids = set()
+
+    for fn in os.listdir(dirname):
+        if fn.endswith('_a.durable') or fn.endswith('_b.durable'):
+            ids.add( fn[:-len('_a.durable')] )
+
+    return sorted( oid for oid in ids if not oid.endswith('_snapshot') )
+
+
+
+def _copy_views( obj ):
+    '''
+    Returns the object with the memoryviews returned by zero-copy
+    serializers, held directly or within the containers supported by
+    OutOfBandPickleSerializer, replaced by bytes
+    '''
+    t = type(obj)
+
+    if t is memoryview:
+        return obj.tobytes()
+    elif t in (tuple, list):
+        return t( _copy_views(o) for o in obj )
+    elif t is dict:
+        return dict( (k, _copy_views(v)) for k, v in obj.items() )
+    elif isinstance(obj, tuple) and hasattr(obj, '_make'):
+        return obj._make( _copy_views(o) for o in obj )
+    else:
+        return obj
+
+
+
+def _recover_object( args ):
+    dirname, object_id, kwargs = args
+
+    handler = DurableObjectHandler(dirname, object_id, read_only=True, **kwargs)
+
+    try:
+        return object_id, _copy_views( handler.recovered )
+    finally:
+        handler.close()
+
+
+
+def recover_all( dirname, object_ids=None, pool=None, workers=None, **kwargs ):
+    '''
+    Recovers many durable objects concurrently and returns a dictionary
+    mapping each object id to its recovered object, which is None for
+    objects that were never saved. If 'object_ids' is None, all objects
+    found in the directory are recovered. Any additional keyword arguments
+    are passed to the DurableObjectHandler constructor, other than
+    'read_only': the objects are always recovered with read-only handlers so
+    no files, including clean shutdown markers, are created or modified.
+
+    As the handlers are closed once their objects are recovered, values
+    that zero-copy serializers such as 'pickle5' return as memoryviews are
+    copied into bytes. This also allows them to be returned from the
+    processes of a multiprocessing.Pool. Memoryviews held by objects other
+    than tuples, lists and dictionaries are not copied.
+
+    By default a thread pool of 'workers' threads is used. Reading files and
+    verifying checksums release the GIL but deserialization does not, so
+    applications with large pickled states may instead supply a
+    multiprocessing.Pool via the 'pool' argument. Supplied pools are not
+    closed. UnrecoverableFailure is raised if any object cannot be
+    recovered.
+    '''
+    if not kwargs.pop('read_only', True):
+        raise ValueError('recover_all() only uses read-only handlers')
+
+    if object_ids is None:
+        object_ids = list_objects(dirname)
+
+    if not object_ids:
+        return dict()
+
+    own_pool = pool is None
+
+    if own_pool:
+        if workers is None:
+            workers = min(32, multiprocessing.cpu_count() * 4)
+        pool = multiprocessing.pool.ThreadPool( min(workers, len(object_ids)) )
+
+    try:
+        return dict( pool.map(_recover_object, [ (dirname, oid, kwargs) for oid in object_ids ]) )
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+
+
+def acceptor_state( acceptor ):
+    '''
+    Returns the state to persist for an Acceptor. This is the value of the
+    object's acceptor_state() method, if it has one, as is the case for
+    multi.MultiPaxosNode. Otherwise the (promised_id, accepted_id,
+    accepted_value) tuple of a practical.Acceptor is returned. Either may be
+    passed to the object's recover() method after a restart.
+    '''
+    if hasattr(acceptor, 'acceptor_state'):
+        return acceptor.acceptor_state()
+
+    return acceptor.promised_id, acceptor.accepted_id, acceptor.accepted_value
+
+
+
+class BackgroundSaver (object):
+    '''
+    This class performs the saves of a DurableObjectHandler on a dedicated
+    worker thread. Completion callbacks are passed to the supplied
+    'call_soon_threadsafe' function, such as asyncio's
+    loop.call_soon_threadsafe, for invocation on the application's event
+    loop thread.
+
+    Only the most recent object passed to save() needs to be written so, if
+    several saves are requested while the worker is busy, they are coalesced
+    into a single write and fsync() after which all of their callbacks are
+    invoked. Callbacks are always invoked in the order their saves were
+    requested.
+
+    Exceptions raised by the handler are passed to on_error(), also on the
+    event loop thread, and the callbacks of the failed save are discarded.
+    The default on_error() implementation re-raises the exception.
+
+    As the handler holds a single object, a BackgroundSaver may persist only
+    one Acceptor, such as a multi.MultiPaxosNode. Applications hosting
+    several Acceptors should use one BackgroundSaver, and handler, for each
+    or combine their states with a GroupCommitter. persist() must be called
+    from the event loop thread.
+    '''
+
+    def __init__(self, handler, call_soon_threadsafe):
+        self.handler   = handler
+        self.call_soon = call_soon_threadsafe
+        self.pending   = None    # (object, list of callbacks) awaiting the worker
+        self.closed    = False
+        self.acceptor  = None    # the Acceptor passed to persist()
+        self.persists  = 0       # number of persist() calls made
+        self.cond      = threading.Condition()
+        self.thread    = threading.Thread(target=self._run)
+
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def save(self, obj, callback=None):
+        '''
+        Requests that the object be saved. The optional callback is invoked
+        with no arguments on the event loop thread once the object, or a
+        more recently saved object, is durable. The object must not be
+        modified until then.
+        '''
+        with self.cond:
+            if self.closed:
+                raise DurabilityFailure('BackgroundSaver is closed')
+
+            if self.pending is None:
+                self.pending = (obj, list())
+                self.cond.notify()
+            else:
+                self.pending = (obj, self.pending[1])
+
+            if callback is not None:
+                self.pending[1].append( callback )
+
+
+    def persist(self, acceptor, state=None):
+        '''
+        Saves the state returned by acceptor_state(), or the explicitly
+        supplied state, and calls the Acceptor's persisted() method once it
+        is durable. If persisted() leaves the Acceptor requiring persistence
+        once more, its state is saved again.
+
+        persisted() sends messages reflecting the Acceptor's current state,
+        so it is only called once the state passed to the most recent
+        persist() call for the Acceptor is durable. The application must
+        therefore call persist() whenever the Acceptor's state changes.
+        '''
+        if self.acceptor is None:
+            self.acceptor = acceptor
+
+        elif acceptor is not self.acceptor:
+            raise ValueError('A BackgroundSaver may only persist a single Acceptor')
+
+        if state is None:
+            state = acceptor_state(acceptor)
+
+        self.persists += 1
+
+        n = self.persists
+
+        self.save( state, lambda : self._persisted(acceptor, n) )
+
+
+    def _persisted(self, acceptor, n):
+        if n != self.persists:
+            return # A more recent state is yet to be saved
+
+        acceptor.persisted()
+
+        if acceptor.persistance_required:
+            self.persist( acceptor )
+
+
+    def on_error(self, exc):
+        raise exc
+
+
+    def _completed(self, callbacks):
+        for cb in callbacks:
+            cb()
+
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closed:
+                    self.cond.wait()
+
+                if self.pending is None:
+                    return
+
+                obj, callbacks = self.pending
+                self.pending   = None
+
+            try:
+                self.handler.save( obj )
+            except Exception as e:
+                self.call_soon( self.on_error, e )
+            else:
+                self.call_soon( self._completed, callbacks )
+
+
+    def close(self):
+        '''
+        Waits for all outstanding saves to complete and stops the worker
+        thread. The handler is not closed.
+        '''
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+        self.thread.join()
+
+
+
+class Committer (object):
+    '''
+    Base class for GroupCommitter and DurableObjectStore, which persist the
+    state of many Acceptors at once. Whenever an Acceptor's
+    'persistance_required' property is set, the Acceptor should be passed to
+    add(). A subsequent call to commit() durably stores the state of every
+    added Acceptor and then calls their persisted() methods. Any Acceptor
+    that requires persistence once more after its persisted() call, due to
+    the processing of deferred requests, is added and committed again.
+
+    By default the saved state is that returned by the module's
+    acceptor_state() function, which may be passed to the Acceptor's
+    recover() method after a restart. Alternative states may be saved by
+    explicitly supplying them to add() or by overriding acceptor_state().
+    The last committed state of every Acceptor is held in the 'state'
+    dictionary, keyed by the application-defined keys passed to add().
+    '''
+
+    def __init__(self, state):
+        self.state      = state
+        self.pending    = collections.OrderedDict() # maps key => (acceptor, state)
+        self.commits    = 0                         # number of commits started
+        self.committing = dict()                    # maps key => number of its latest commit
+
+
+    def acceptor_state(self, acceptor):
+        return acceptor_state(acceptor)
+
+
+    def recovered(self, key):
+        '''
+        Returns the last committed state for the key or None
+        '''
+        return self.state.get(key)
+
+
+    def add(self, key, acceptor, state=None):
+        '''
+        Registers an Acceptor for inclusion in the next commit. If 'state' is
+        None, the state is obtained via acceptor_state() at commit time.
+        '''
+        self.pending[ key ] = (acceptor, state)
+
+
+    def _start_commit(self):
+        '''
+        Returns a (pending, commit_number, changes) tuple for the Acceptors
+        added since the previous commit, where 'changes' maps their keys to
+        the states to store
+        '''
+        pending      = self.pending
+        self.pending = collections.OrderedDict()
+        changes      = dict()
+
+        self.commits += 1
+
+        n = self.commits
+
+        for key, (acceptor, state) in pending.items():
+            changes[ key ]         = state if state is not None else self.acceptor_state(acceptor)
+            self.committing[ key ] = n
+
+        return pending, n, changes
+
+
+    def _persisted(self, pending, n):
+        '''
+        Called once the states of commit 'n' are durable
+        '''
+        for key, (acceptor, state) in pending.items():
+            # persisted() sends messages reflecting the Acceptor's current
+            # state, which is only known to be durable if the Acceptor has
+            # not been added again since this commit began
+            if self.committing.get(key) != n or key in self.pending:
+                continue
+
+            del self.committing[ key ]
+
+            # Requests deferred by the Acceptor are processed by persisted()
+            # and may require its state to be committed once more
+            acceptor.persisted()
+            if acceptor.persistance_required:
+                self.add( key, acceptor )
+
+        self.commit()
+
+
+
+class GroupCommitter (Committer):
+    '''
+    This class persists the state of many Acceptors, possibly belonging to
+    many different Paxos instances, with a single write and fsync(). Each
+    commit() saves the full 'state' dictionary via the supplied
+    DurableObjectHandler.
+
+    If a BackgroundSaver wrapping the handler is supplied, commit() returns
+    immediately and the persisted() methods are called from the event loop
+    once the save completes. An Acceptor that has been added again in the
+    meantime is left for the later commit, which holds its current state.
+    '''
+
+    def __init__(self, handler, saver=None):
+        super(GroupCommitter, self).__init__( handler.recovered if handler.recovered is not None
+                                              else dict() )
+        self.handler = handler
+        self.saver   = saver
+
+
+    def commit(self):
+        '''
+        Saves the state of all registered Acceptors with a single write and
+        fsync() and then calls their persisted() methods.
+        '''
+        if not self.pending:
+            return
+
+        pending, n, changes = self._start_commit()
+
+        self.state.update( changes )
+
+        if self.saver is not None:
+            self.saver.save( dict(self.state), lambda : self._persisted(pending, n) )
+        else:
+            self.handler.save( self.state )
+            self._persisted( pending, n )
+
+
+
+class WriteAheadLog (object):
+    '''
+    This class implements an append-only log of checksummed records. Each
+    record holds a serialized object and is assigned a serial number, starting
+    from 1 and incrementing by one for every record. Records are stored in a
+    sequence of segment files named "<log_id>_<first serial>.wal". A new
+    segment is started once the current one exceeds 'segment_size' bytes.
+
+    append() writes a record without flushing it to disk. sync() must be
+    called before any action that depends upon the durability of the
+    appended records, such as sending Promise or Accepted messages. Multiple
+    records may therefore be made durable with a single fsync().
+
+    On construction, the log is scanned and verified. Any incomplete or
+    corrupted records at the end of the final segment are the result of
+    writes that were never synced and are truncated away. Corruption within
+    any other segment raises UnrecoverableFailure. The surviving records may
+    be read with replay().
+
+    compact() durably stores an application-supplied snapshot that reflects
+    the effects of every record appended so far and then deletes all
+    segments other than the current one. Snapshots are saved with a
+    DurableObjectHandler using the "<log_id>_snapshot" object id. After
+    recovery, the most recent snapshot is available via the 'snapshot'
+    attribute and replay() yields only the records appended after it was
+    taken.
+    '''
+
+    segment_size       = 16 * 1024 * 1024
+    checksum           = DEFAULT_CHECKSUM
+    serializer         = DEFAULT_SERIALIZER
+    compression        = None
+    compression_level  = None
+    compress_threshold = 1024
+
+    def __init__(self, dirname, log_id, segment_size=None, checksum=None,
+                 serializer=None, compression=None):
+        '''
+        Throws UnrecoverableFailure if a segment other than the last is corrupted
+        '''
+        if not os.path.isdir(dirname):
+            raise Exception('Invalid directory: ' + dirname)
+
+        if segment_size: self.segment_size = segment_size
+
+        if checksum:
+            if checksum not in CHECKSUMS:
+                raise ValueError('Unknown checksum: ' + checksum)
+            self.checksum = checksum
+
+        if serializer:
+            if serializer not in SERIALIZERS:
+                raise ValueError('Unknown serializer: ' + serializer)
+            self.serializer = serializer
+
+        if compression:
+            if compression not in COMPRESSORS:
+                raise ValueError('Unknown compression: ' + compression)
+            self.compression = compression
+
+        self.dirname  = dirname
+        self.log_id   = str(log_id)
+        self.segments = list() # list of (first_serial, filename) tuples
+        self.fd       = None
+        self.dirty    = False
+
+        self.snapshot_handler = DurableObjectHandler(dirname, self.log_id + '_snapshot',
+                                                     self.checksum)
+
+        self.recover()
+
+
+    def _list_segments(self):
+        prefix   = self.log_id + '_'
+        segments = list()
+
+        for fn in os.listdir(self.dirname):
+            if fn.startswith(prefix) and fn.endswith('.wal'):
+                first = fn[len(prefix):-4]
+                if first.isdigit():
+                    segments.append( (int(first), os.path.join(self.dirname, fn)) )
+
+        segments.sort()
+
+        return segments
+
+
+    def _scan(self, data, serial):
+        '''
+        Returns a list of (serial, offset, length, serializer_id,
+        compression_id) tuples for the valid records at the start of the data
+        '''
+        return _scan_records(data, serial)
+
+
+    def recover(self):
+        if self.snapshot_handler.recovered is not None:
+            self.snapshot_serial, self.snapshot = self.snapshot_handler.recovered
+        else:
+            self.snapshot_serial, self.snapshot = 1, None
+
+        segments = self._list_segments()
+
+        # Remove segments left behind by an interrupted compaction
+        while len(segments) > 1 and segments[1][0] <= self.snapshot_serial:
+            os.unlink(segments.pop(0)[1])
+
+        self.segments    = segments
+        self.next_serial = self.snapshot_serial
+
+        for i, (first, fn) in enumerate(self.segments):
+            data    = _read_file(fn)
+            last    = i == len(self.segments) - 1
+
+            if first > self.next_serial or (i > 0 and first != self.next_serial):
+                raise UnrecoverableFailure('Missing log records prior to: ' + fn)
+
+            records = self._scan(data, first)
+            valid   = records[-1][1] + records[-1][2] if records else 0
+
+            if valid != len(data):
+                if not last:
+                    raise UnrecoverableFailure('Corrupted log segment: ' + fn)
+
+                fd = os.open(fn, os.O_RDWR | _bin_flag)
+                os.ftruncate(fd, valid)
+                _fsync(fd)
+                os.close(fd)
+
+            self.next_serial = first + len(records)
+
+        if self.segments:
+            self.fd            = os.open(self.segments[-1][1], os.O_WRONLY | os.O_APPEND | _bin_flag)
+            self.segment_bytes = os.fstat(self.fd).st_size
+
+
+    def replay(self):
+        '''
+        Generator yielding a (serial_number, deserialized_object) tuple for every
+        record in the log that is not covered by the snapshot, in order.
+        '''
+        for first, fn in list(self.segments):
+            data = _read_file(fn)
+            for serial, offset, length, serializer_id, compression_id in self._scan(data, first):
+                if serial >= self.snapshot_serial:
+                    yield serial, _loads( serializer_id, data[offset:offset+length], compression_id )
+
+
+    def compact(self, snapshot):
+        '''
+        Durably saves the snapshot and deletes the log segments it covers. The
+        snapshot must reflect all records appended to the log thus far.
+        '''
+        if self.fd is not None and self.segment_bytes:
+            self._roll()
+
+        self.snapshot_handler.save( (self.next_serial, snapshot) )
+
+        self.snapshot_serial = self.next_serial
+        self.snapshot        = snapshot
+
+        for first, fn in self.segments[:-1]:
+            os.unlink(fn)
+
+        self.segments = self.segments[-1:]
+
+        _sync_dir(self.dirname)
+
+
+    def _roll(self):
+        if self.fd is not None:
+            self.sync()
+            os.close(self.fd)
+
+        fn = os.path.join(self.dirname, '%s_%020d.wal' % (self.log_id, self.next_serial))
+
+        self.fd            = os.open(fn, os.O_CREAT | os.O_WRONLY | os.O_APPEND | _bin_flag)
+        self.segment_bytes = 0
+
+        self.segments.append( (self.next_serial, fn) )
+
+        _sync_dir(self.dirname)
+
+
+    def append(self, obj):
+        '''
+        Appends the object to the log and returns the serial number of the new
+        record. The record is not durable until sync() is called.
+        '''
+        if self.fd is None or self.segment_bytes >= self.segment_size:
+            self._roll()
+
+        serial = self.next_serial
+        parts  = encode_parts(serial, obj, self.checksum, self.serializer, self.compression,
+                              self.compression_level, self.compress_threshold)
+
+        _write_parts(self.fd, parts)
+
+        self.next_serial   += 1
+        self.segment_bytes += sum( len(p) for p in parts )
+        self.dirty          = True
+
+        return serial
+
+
+    def sync(self):
+        '''
+        Flushes all appended records to stable media
+        '''
+        if self.dirty:
+            _fsync(self.fd)
+            self.dirty = False
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.snapshot_handler.close()
+
+
+
+def _read_file( fn ):
+    with open(fn, 'rb') as f:
+        return f.read()
+
+
+
+class DurableObjectStore (Committer):
+    '''
+    This class durably stores the state of many objects, such as the
+    Acceptors of thousands of Paxos groups, within a single WriteAheadLog.
+    Regardless of the number of objects, only the log's current segment and
+    snapshot files are held open and each commit() requires a single write
+    and fsync().
+
+    Each commit() appends a single log record holding the new state of only
+    the added objects. The current state of every object is held in memory
+    and is available from recovered().
+
+    To bound recovery time and disk usage, the log is compacted into a
+    snapshot of all object states once the number of records appended since
+    the previous snapshot exceeds both 'min_compact_records' and the number
+    of stored objects. Compaction takes place at the end of a commit, after
+    the persisted() methods have been called, so that it does not delay the
+    messages they send.
+    '''
+
+    min_compact_records = 1000
+
+    def __init__(self, dirname, store_id, checksum=None, min_compact_records=None):
+        if min_compact_records: self.min_compact_records = min_compact_records
+
+        self.log      = WriteAheadLog(dirname, store_id, checksum=checksum)
+        self.nrecords = 0
+
+        super(DurableObjectStore, self).__init__( dict(self.log.snapshot)
+                                                  if self.log.snapshot is not None else dict() )
+
+        for serial, changes in self.log.replay():
+            self.state.update( changes )
+            self.nrecords += 1
+
+
+    def commit(self):
+        '''
+        Appends the state of all registered Acceptors to the log as a single
+        record, syncs it, and then calls their persisted() methods.
+        '''
+        if not self.pending:
+            return
+
+        pending, n, changes = self._start_commit()
+
+        self.log.append( changes )
+        self.log.sync()
+
+        self.state.update( changes )
+        self.nrecords += 1
+
+        self._persisted( pending, n )
+
+        if self.nrecords > max(self.min_compact_records, len(self.state)):
+            self.compact()
+
+
+    def compact(self):
+        '''
+        Replaces the log records with a snapshot of the current state
+        '''
+        self.log.compact( self.state )
+        self.nrecords = 0
+
+
+    def close(self):
+        self.log.close()
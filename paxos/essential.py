@@ -97,7 +97,8 @@ class Proposer (object):
 
         self.promises_rcvd.add( from_uid )
         
-        if prev_accepted_id > self.last_accepted_id:
+        if prev_accepted_id is not None and (self.last_accepted_id is None or
+                                             prev_accepted_id > self.last_accepted_id):
             self.last_accepted_id = prev_accepted_id
             # If the Acceptor has already accepted a value, we MUST set our proposal
             # to that value.
@@ -127,7 +128,7 @@ class Acceptor (object):
             # Duplicate prepare message
             self.messenger.send_promise(from_uid, proposal_id, self.accepted_id, self.accepted_value)
         
-        elif proposal_id > self.promised_id:
+        elif self.promised_id is None or proposal_id > self.promised_id:
             self.promised_id = proposal_id
             self.messenger.send_promise(from_uid, proposal_id, self.accepted_id, self.accepted_value)
 
@@ -136,7 +137,7 @@ class Acceptor (object):
         '''
         Called when an Accept! message is received from a Proposer
         '''
-        if proposal_id >= self.promised_id:
+        if self.promised_id is None or proposal_id >= self.promised_id:
             self.promised_id     = proposal_id
             self.accepted_id     = proposal_id
             self.accepted_value  = value
@@ -172,7 +173,7 @@ class Learner (object):
         
         last_pn = self.acceptors.get(from_uid)
 
-        if not proposal_id > last_pn:
+        if last_pn is not None and not proposal_id > last_pn:
             return # Old message
 
         self.acceptors[ from_uid ] = proposal_id
@@ -43,7 +43,7 @@ class ExternalNode (practical.Node):
         super(ExternalNode, self).__init__(messenger, my_uid, quorum_size)
 
         self.leader_uid          = leader_uid
-        self.leader_proposal_id  = ProposalID(1, leader_uid)
+        self.leader_proposal_id  = ProposalID(1, leader_uid) if leader_uid is not None else None
         self._nacks              = set()
 
         if self.node_uid == leader_uid:
@@ -58,7 +58,7 @@ class ExternalNode (practical.Node):
 
 
     def recv_leadership_proclamation(self, from_uid, proposal_id):
-        if proposal_id > self.leader_proposal_id:
+        if self.leader_proposal_id is None or proposal_id > self.leader_proposal_id:
             old_leader_uid = self.leader_uid
             
             self.leader_uid         = from_uid
@@ -74,7 +74,7 @@ class HeartbeatNode (practical.Node):
         super(HeartbeatNode, self).__init__(messenger, my_uid, quorum_size)
 
         self.leader_uid          = leader_uid
-        self.leader_proposal_id  = ProposalID(1, leader_uid)
+        self.leader_proposal_id  = ProposalID(1, leader_uid) if leader_uid is not None else None
         self._tlast_hb           = self.timestamp()
         self._tlast_prep         = self.timestamp()
         self._acquiring          = False
@@ -117,7 +117,7 @@ class HeartbeatNode (practical.Node):
             
     def recv_heartbeat(self, from_uid, proposal_id):
 
-        if proposal_id > self.leader_proposal_id:
+        if self.leader_proposal_id is None or proposal_id > self.leader_proposal_id:
             # Change of leadership            
             self._acquiring = False
             
@@ -0,0 +1,597 @@
+'''
+This module builds a Multi-Paxos replicated log on top of the practical
+Paxos implementation. Each slot in the log is resolved by an independent
+practical.Node instance but, unlike a collection of unrelated Nodes, phase 1
+is performed once for all slots. A node that obtains a quorum of promises
+becomes the leader for every slot at or above the first slot it has not seen
+resolved and may then send Accept! messages for all subsequent slots directly.
+Under steady leadership this reduces the cost of each log entry from two
+round trips to one.
+'''
+import collections
+
+from paxos import practical
+
+from paxos.practical import ProposalID
+
+
+class MultiPaxosMessenger (object):
+
+    def send_prepare(self, proposal_id, first_slot):
+        '''
+        Broadcasts a Prepare message covering first_slot and all subsequent
+        slots to all Acceptors
+        '''
+
+    def send_promise(self, proposer_uid, proposal_id, first_slot, accepted):
+        '''
+        Sends a Promise message to the specified Proposer. The 'first_slot'
+        argument is the greater of the prepared slot and the lowest slot the
+        Acceptor has not truncated. The 'accepted' argument is a dictionary
+        mapping each slot at or above first_slot for which a value has been
+        accepted to an (accepted_id, accepted_value) tuple.
+        '''
+
+    def send_prepare_nack(self, to_uid, proposal_id, promised_id):
+        '''
+        Sends a Prepare Nack message for the proposal to the specified node
+        '''
+
+    def send_accept(self, slot, proposal_id, proposal_value):
+        '''
+        Broadcasts an Accept! message for the slot to all Acceptors
+        '''
+
+    def send_accepted(self, slot, proposal_id, accepted_value):
+        '''
+        Broadcasts an Accepted message for the slot to all Learners
+        '''
+
+    def send_accept_nack(self, to_uid, slot, proposal_id, promised_id):
+        '''
+        Sends an Accept! Nack message for the slot to the specified node
+        '''
+
+    def on_resolution(self, slot, proposal_id, value):
+        '''
+        Called when a resolution is reached for the slot
+        '''
+
+    def on_leadership_acquired(self):
+        '''
+        Called when leadership has been acquired. See
+        practical.Messenger.on_leadership_acquired() for caveats.
+        '''
+
+    def on_leadership_lost(self):
+        '''
+        Called when loss of leadership is detected
+        '''
+
+
+
+class SlotMessenger (practical.Messenger):
+    '''
+    Adapts the single-instance practical.Messenger interface used by the
+    per-slot practical.Node instances to the slot-aware MultiPaxosMessenger
+    interface of the owning MultiPaxosNode.
+    '''
+
+    def __init__(self, node, slot):
+        self.node = node
+        self.slot = slot
+
+    def send_accept(self, proposal_id, proposal_value):
+        self.node.messenger.send_accept(self.slot, proposal_id, proposal_value)
+
+    def send_accepted(self, proposal_id, accepted_value):
+        self.node.messenger.send_accepted(self.slot, proposal_id, accepted_value)
+
+    def send_accept_nack(self, to_uid, proposal_id, promised_id):
+        self.node.messenger.send_accept_nack(to_uid, self.slot, proposal_id, promised_id)
+
+    def on_resolution(self, proposal_id, value):
+        self.node.slot_resolved(self.slot, proposal_id, value)
+
+
+
+class MultiPaxosNode (object):
+    '''
+    This class implements a Multi-Paxos node that performs all three Paxos
+    roles for an unbounded sequence of slots, numbered from zero.
+
+    Proposer: Values passed to set_proposal() are queued and assigned to
+    slots in order once this node is the leader. Leadership is acquired by
+    calling prepare() which broadcasts a single Prepare message covering the
+    first slot this node has not seen resolved and all slots beyond it. The
+    Promise replies carry every value the Acceptors have accepted in those
+    slots. Once a quorum of promises is received, previously accepted values
+    are re-proposed in their slots and all remaining slots are free for new
+    values without any further phase 1 messages. A value this node proposed
+    that loses its slot to a different value is placed back at the head of
+    the queue. Slots that lie below the highest known slot but for which no
+    value was reported are filled with 'noop_value' if it is not None,
+    otherwise they are used for the next values passed to set_proposal().
+
+    The 'pipeline_window' attribute limits the number of slots the leader
+    will have outstanding Accept! messages for at any one time. With the
+    default of 1, each value waits for the resolution of the previous one.
+    Larger windows allow the leader to keep many slots in flight
+    concurrently, which is necessary to saturate links with non-trivial
+    round trip times. Slots may consequently be resolved out of order.
+
+    Acceptor: The node makes a single promise that applies to all slots at or
+    above the prepared slot. As with practical.Acceptor, after calling
+    recv_prepare() and recv_accept_request() the 'persistance_required'
+    property must be checked. If set, the 'promised_id' attribute and the
+    state of each per-slot Acceptor listed in 'pending_slots' (see
+    slot_state()) must be saved to stable media before calling persisted().
+    After a restart, the saved state may be restored with recover().
+
+    Learner: Accepted messages are tracked per slot and on_resolution() is
+    called once for each slot as it is resolved. The 'low_slot' attribute is
+    the lowest slot this node has not seen resolved.
+
+    Once the application has applied the resolved values of all slots below
+    some slot N and captured its state machine in a snapshot, truncate(N)
+    may be used to discard the Paxos state for those slots. Messages for
+    truncated slots are subsequently ignored and promises report the
+    truncated range so that a leader that has not seen those slots resolved
+    does not propose values for them; it must instead obtain the values from
+    an application snapshot. The snapshot should include
+    the value returned by acceptor_state() so that the log holding the
+    Acceptor state, such as a durable.WriteAheadLog, may be compacted.
+    After a restart from such a snapshot, the Acceptor state is restored
+    with recover() and truncate(N) is called once more to skip the slots
+    covered by the snapshot.
+    '''
+
+    leader          = False
+    noop_value      = None
+    pipeline_window = 1
+
+    def __init__(self, messenger, node_uid, quorum_size, pipeline_window=None):
+        self.messenger            = messenger
+        self.node_uid             = node_uid
+        self.quorum_size          = quorum_size
+
+        self.instances            = dict() # maps slot => practical.Node
+        self.base_slot            = 0      # state for all lower slots has been discarded
+        self.low_slot             = 0
+        self.next_slot            = 0
+
+        self.proposal_id          = None
+        self.next_proposal_number = 1
+        self.promises_rcvd        = set()
+        self.proposal_queue       = collections.deque()
+        self.in_flight            = dict() # maps unresolved slot => own value or None
+
+        self.promised_id          = None
+        self.pending_promise      = None   # None or the UID to send a promise message to
+        self.pending_slots        = set()  # slots with pending Accepted messages
+        self.queued_prepare       = None   # None or a deferred (from_uid, proposal_id, first_slot)
+
+        self._active              = True
+        self._prepare_slot        = 0
+        self._lead_from           = 0      # highest first_slot of the promises received
+        self._promise_slot        = 0
+        self._promised_values     = dict() # maps slot => (accepted_id, accepted_value)
+        self._free_slots          = list()
+        self._nacks               = set()
+
+        if pipeline_window: self.pipeline_window = pipeline_window
+
+
+    @property
+    def proposer_uid(self):
+        return self.node_uid
+
+
+    @property
+    def active(self):
+        return self._active
+
+
+    @active.setter
+    def active(self, value):
+        self._active = value
+        for inst in self.instances.values():
+            inst.active = value
+
+
+    @property
+    def persistance_required(self):
+        return self.pending_promise is not None or bool(self.pending_slots)
+
+
+    def change_quorum_size(self, quorum_size):
+        self.quorum_size = quorum_size
+        for inst in self.instances.values():
+            inst.change_quorum_size(quorum_size)
+
+
+    def instance(self, slot):
+        '''
+        Returns the practical.Node instance responsible for the slot, creating
+        it if necessary.
+        '''
+        inst = self.instances.get(slot)
+
+        if inst is None:
+            inst        = practical.Node(SlotMessenger(self, slot), self.node_uid, self.quorum_size)
+            inst.active = self._active
+
+            if self.promised_id is not None:
+                inst.recover(self.promised_id, None, None)
+
+            self.instances[slot] = inst
+
+        return inst
+
+
+    def slot_state(self, slot):
+        '''
+        Returns the (promised_id, accepted_id, accepted_value) tuple of the
+        Acceptor for the slot. This is the state that must be persisted for
+        each slot in 'pending_slots' prior to calling persisted().
+        '''
+        inst = self.instances[slot]
+        return inst.promised_id, inst.accepted_id, inst.accepted_value
+
+
+    def recover(self, promised_id, slot_states):
+        '''
+        Restores persisted Acceptor state. The 'slot_states' argument is a
+        dictionary mapping slot numbers to the tuples returned by slot_state().
+        '''
+        self.promised_id = promised_id
+
+        # Proposal ids used prior to the restart must never be reused
+        if promised_id is not None and promised_id.number >= self.next_proposal_number:
+            self.next_proposal_number = promised_id.number + 1
+
+        for slot, state in slot_states.items():
+            self.instance(slot).recover(*state)
+
+
+    def acceptor_state(self):
+        '''
+        Returns a (promised_id, slot_states) tuple containing the complete
+        Acceptor state of all retained slots, suitable for passing to
+        recover().
+        '''
+        return self.promised_id, dict( (slot, self.slot_state(slot))
+                                       for slot in self.instances )
+
+
+    def truncate(self, slot):
+        '''
+        Discards all state for the slots below 'slot'. The application must
+        ensure that the values of all such slots have been resolved and
+        captured in an application snapshot.
+        '''
+        if slot <= self.base_slot:
+            return
+
+        for s in [ s for s in self.instances if s < slot ]:
+            del self.instances[s]
+            self.in_flight.pop(s, None)
+            self.pending_slots.discard(s)
+
+        self._free_slots = [ s for s in self._free_slots if s >= slot ]
+
+        self.base_slot = slot
+        self.low_slot  = max(self.low_slot, slot)
+        self.next_slot = max(self.next_slot, slot)
+
+        while self.low_slot in self.instances and self.instances[self.low_slot].complete:
+            self.low_slot += 1
+
+
+    def accepted_values(self, first_slot):
+        '''
+        Returns a dictionary mapping each slot at or above first_slot for
+        which a value has been accepted to an (accepted_id, accepted_value)
+        tuple.
+        '''
+        return dict( (slot, (inst.accepted_id, inst.accepted_value))
+                     for slot, inst in self.instances.items()
+                     if slot >= first_slot and inst.accepted_id is not None )
+
+
+    # --- Proposer ---
+
+    def set_proposal(self, value):
+        '''
+        Queues the value for inclusion in the log. The value is assigned to a
+        slot as soon as this node is the leader.
+        '''
+        self.proposal_queue.append(value)
+        self._propose_queued()
+
+
+    def prepare(self, increment_proposal_number=True):
+        '''
+        Sends a prepare request covering all unresolved slots as the first
+        step in attempting to acquire leadership. If the
+        'increment_proposal_number' argument is True (the default), the
+        proposal id will be set higher than that of any previous observed
+        proposal id. Otherwise the previously used proposal id will simply be
+        retransmitted.
+        '''
+        if increment_proposal_number:
+            self._demote()
+            self.promises_rcvd    = set()
+            self.proposal_id      = ProposalID(self.next_proposal_number, self.node_uid)
+            self._prepare_slot    = self.low_slot
+            self._lead_from       = self.low_slot
+            self._promised_values = dict()
+            self._nacks.clear()
+
+            self.next_proposal_number += 1
+
+        if self.active:
+            self.messenger.send_prepare(self.proposal_id, self._prepare_slot)
+
+
+    def observe_proposal(self, from_uid, proposal_id):
+        '''
+        Updates the proposal counter as proposals are seen on the network.
+        '''
+        if from_uid != self.node_uid and proposal_id is not None:
+            if proposal_id >= (self.next_proposal_number, self.node_uid):
+                self.next_proposal_number = proposal_id.number + 1
+
+
+    def recv_promise(self, from_uid, proposal_id, first_slot, accepted):
+        '''
+        Called when a Promise message is received from the network
+        '''
+        self.observe_proposal( from_uid, proposal_id )
+
+        if self.leader or proposal_id != self.proposal_id or from_uid in self.promises_rcvd:
+            return
+
+        self.promises_rcvd.add( from_uid )
+
+        # Slots below first_slot were truncated by the Acceptor
+        self._lead_from = max(self._lead_from, first_slot)
+
+        for slot, (accepted_id, accepted_value) in accepted.items():
+            prev = self._promised_values.get(slot)
+            if prev is None or accepted_id > prev[0]:
+                self._promised_values[slot] = (accepted_id, accepted_value)
+
+        if len(self.promises_rcvd) == self.quorum_size:
+            self.leader = True
+
+            self.messenger.on_leadership_acquired()
+
+            self._assume_leadership()
+
+
+    def recv_prepare_nack(self, from_uid, proposal_id, promised_id):
+        '''
+        Called when an explicit NACK is sent in response to a prepare message.
+        '''
+        self.observe_proposal( from_uid, promised_id )
+
+
+    def recv_accept_nack(self, from_uid, slot, proposal_id, promised_id):
+        '''
+        Called when an explicit NACK is sent in response to an accept
+        message. Leadership is abandoned once a quorum of Acceptors has
+        rejected the current proposal id.
+        '''
+        self.observe_proposal( from_uid, promised_id )
+
+        if proposal_id == self.proposal_id:
+            self._nacks.add(from_uid)
+
+        if self.leader and len(self._nacks) >= self.quorum_size:
+            self._demote()
+            self.promises_rcvd = set()
+            self.messenger.on_leadership_lost()
+
+
+    def resend_accepts(self):
+        '''
+        Retransmits Accept! messages for all slots this node has proposed
+        values for that have not yet been resolved.
+        '''
+        if self.leader:
+            for slot in sorted(self.in_flight):
+                self._send_accept(slot)
+
+
+    def _send_accept(self, slot):
+        # Proposer.resend_accept() ignores falsy values, such as a noop_value
+        # of b'', so Accept! messages for led slots are sent directly
+        value = self.instances[slot].proposed_value
+
+        if self.active and value is not None:
+            self.messenger.send_accept(slot, self.proposal_id, value)
+
+
+    def _demote(self):
+        self.leader = False
+        for inst in self.instances.values():
+            inst.leader = False
+
+
+    def _lead_slot(self, slot):
+        inst             = self.instance(slot)
+        inst.leader      = True
+        inst.proposal_id = self.proposal_id
+        return inst
+
+
+    def _assume_leadership(self):
+        promised              = self._promised_values
+        self._promised_values = dict()
+        self._free_slots      = list()
+
+        if promised:
+            self.next_slot = max(self.next_slot, max(promised) + 1)
+
+        if self.instances:
+            self.next_slot = max(self.next_slot, max(self.instances) + 1)
+
+        self.next_slot = max(self.next_slot, self._lead_from)
+
+        for slot in [ s for s in self.in_flight if s < self._lead_from ]:
+            # The slot has been resolved and truncated by an Acceptor
+            own = self.in_flight.pop(slot)
+            if own is not None:
+                self.proposal_queue.appendleft(own)
+
+        for slot in range(self._lead_from, self.next_slot):
+            inst = self._lead_slot(slot)
+
+            if inst.complete:
+                continue
+
+            if slot in promised:
+                # Previously accepted values MUST be re-proposed
+                inst.proposed_value = promised[slot][1]
+
+            elif inst.proposed_value is None and self.noop_value is not None:
+                inst.proposed_value = self.noop_value
+
+            if inst.proposed_value is None:
+                self._free_slots.append(slot)
+            else:
+                self.in_flight.setdefault(slot, None)
+                self._send_accept(slot)
+
+        self._propose_queued()
+
+
+    def _propose_queued(self):
+        while (self.leader and self.proposal_queue and
+               len(self.in_flight) < self.pipeline_window):
+            if self._free_slots:
+                slot = self._free_slots.pop(0)
+            else:
+                slot            = self.next_slot
+                self.next_slot += 1
+
+            value = self.proposal_queue.popleft()
+
+            self.in_flight[slot] = value
+
+            self._lead_slot(slot).set_proposal(value)
+
+
+    # --- Acceptor ---
+
+    def recv_prepare(self, from_uid, proposal_id, first_slot):
+        '''
+        Called when a Prepare message is received from the network
+        '''
+        self.observe_proposal( from_uid, proposal_id )
+
+        if proposal_id == self.promised_id:
+            # Duplicate prepare message. Respond immediately unless the
+            # promise has yet to be persisted
+            if self.active and self.pending_promise is None:
+                first_slot = max(first_slot, self.base_slot)
+                self.messenger.send_promise(from_uid, proposal_id, first_slot,
+                                            self.accepted_values(first_slot))
+
+        elif self.promised_id is None or proposal_id > self.promised_id:
+            if self.pending_promise is None:
+                self.promised_id = proposal_id
+                if self.active:
+                    self.pending_promise = from_uid
+                    self._promise_slot   = first_slot
+
+            elif self.queued_prepare is None or proposal_id > self.queued_prepare[1]:
+                self.queued_prepare = (from_uid, proposal_id, first_slot)
+
+        else:
+            if self.active:
+                self.messenger.send_prepare_nack(from_uid, proposal_id, self.promised_id)
+
+
+    def recv_accept_request(self, from_uid, slot, proposal_id, value):
+        '''
+        Called when an Accept! message is received from the network
+        '''
+        self.observe_proposal( from_uid, proposal_id )
+
+        if slot < self.base_slot:
+            return
+
+        inst = self.instance(slot)
+
+        # The node-wide promise applies to all slots
+        if self.promised_id is not None and (inst.promised_id is None or
+                                             self.promised_id > inst.promised_id):
+            inst.promised_id = self.promised_id
+
+        inst.recv_accept_request(from_uid, proposal_id, value)
+
+        if inst.persistance_required:
+            self.pending_slots.add(slot)
+
+
+    def persisted(self):
+        '''
+        Sends any pending Promise and/or Accepted messages. Prior to calling
+        this method, the application must ensure that the promised_id and the
+        state of each slot in 'pending_slots' have been persisted to stable
+        media. As with practical.Acceptor, requests deferred while persistence
+        was pending are then processed so 'persistance_required' must be
+        checked again afterwards.
+        '''
+        if self.pending_promise is not None and self.active:
+            first_slot = max(self._promise_slot, self.base_slot)
+            self.messenger.send_promise(self.pending_promise,
+                                        self.promised_id,
+                                        first_slot,
+                                        self.accepted_values(first_slot))
+
+        self.pending_promise = None
+
+        pending            = sorted(self.pending_slots)
+        self.pending_slots = set()
+
+        for slot in pending:
+            inst = self.instances[slot]
+            inst.persisted()
+            if inst.persistance_required:
+                self.pending_slots.add(slot)
+
+        queued, self.queued_prepare = self.queued_prepare, None
+
+        if queued is not None:
+            self.recv_prepare(*queued)
+
+
+    # --- Learner ---
+
+    def recv_accepted(self, from_uid, slot, proposal_id, accepted_value):
+        '''
+        Called when an Accepted message is received from an acceptor
+        '''
+        if slot >= self.base_slot:
+            self.instance(slot).recv_accepted(from_uid, proposal_id, accepted_value)
+
+
+    def slot_resolved(self, slot, proposal_id, value):
+        '''
+        Called by the per-slot instances when their value is resolved
+        '''
+        own = self.in_flight.pop(slot, None)
+
+        if own is not None and own != value:
+            # Another proposer's value won the slot. Ours must try again.
+            self.proposal_queue.appendleft(own)
+
+        while self.low_slot in self.instances and self.instances[self.low_slot].complete:
+            self.low_slot += 1
+
+        self.messenger.on_resolution(slot, proposal_id, value)
+
+        self._propose_queued()
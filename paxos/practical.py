@@ -135,7 +135,8 @@ class Proposer (essential.Proposer):
 
         self.promises_rcvd.add( from_uid )
         
-        if prev_accepted_id > self.last_accepted_id:
+        if prev_accepted_id is not None and (self.last_accepted_id is None or
+                                             prev_accepted_id > self.last_accepted_id):
             self.last_accepted_id = prev_accepted_id
             # If the Acceptor has already accepted a value, we MUST set our proposal
             # to that value. Otherwise, we may retain our current value.
@@ -164,11 +165,16 @@ class Acceptor (essential.Acceptor):
 
     Note that because Paxos permits any combination of dropped packets, not
     every promise/accepted message needs to be sent. This implementation only
-    responds to the first prepare/accept_request message received and ignores
-    all others until the Acceptor's values are persisted to stable media (which
-    is typically a slow process). After saving the promised_id, accepted_id,
-    and accepted_value variables, the "persisted" method must be called to send
-    the pending promise and/or accepted messages.
+    acts upon the first prepare/accept_request message received while the
+    Acceptor's values are being persisted to stable media (which is typically
+    a slow process). Of the requests that would supersede the pending one,
+    only the most recent prepare and the most recent accept_request are
+    retained. After saving the promised_id, accepted_id, and accepted_value
+    variables, the "persisted" method must be called to send the pending
+    promise and/or accepted messages. The retained requests are then
+    processed immediately, rather than waiting for the proposer to
+    retransmit them, so 'persistance_required' must be checked again after
+    each call to persisted().
 
     The 'active' attribute is a boolean value indicating whether or not
     the Acceptor should send outgoing messages (defaults to True). Setting
@@ -179,6 +185,8 @@ class Acceptor (essential.Acceptor):
 
     pending_promise  = None # None or the UID to send a promise message to
     pending_accepted = None # None or the UID to send an accepted message to
+    queued_prepare   = None # None or the (from_uid, proposal_id) of a deferred prepare
+    queued_accept    = None # None or the (from_uid, proposal_id, value) of a deferred accept
     active           = True
     
     
@@ -203,12 +211,15 @@ class Acceptor (essential.Acceptor):
             if self.active:
                 self.messenger.send_promise(from_uid, proposal_id, self.accepted_id, self.accepted_value)
         
-        elif proposal_id > self.promised_id:
+        elif self.promised_id is None or proposal_id > self.promised_id:
             if self.pending_promise is None:
                 self.promised_id = proposal_id
                 if self.active:
                     self.pending_promise = from_uid
 
+            elif self.queued_prepare is None or proposal_id > self.queued_prepare[1]:
+                self.queued_prepare = (from_uid, proposal_id)
+
         else:
             if self.active:
                 self.messenger.send_prepare_nack(from_uid, proposal_id, self.promised_id)
@@ -224,13 +235,16 @@ class Acceptor (essential.Acceptor):
             if self.active:
                 self.messenger.send_accepted(proposal_id, value)
             
-        elif proposal_id >= self.promised_id:
+        elif self.promised_id is None or proposal_id >= self.promised_id:
             if self.pending_accepted is None:
                 self.promised_id      = proposal_id
                 self.accepted_value   = value
                 self.accepted_id      = proposal_id
                 if self.active:
                     self.pending_accepted = from_uid
+
+            elif self.queued_accept is None or proposal_id > self.queued_accept[1]:
+                self.queued_accept = (from_uid, proposal_id, value)
             
         else:
             if self.active:
@@ -242,7 +256,8 @@ class Acceptor (essential.Acceptor):
         This method sends any pending Promise and/or Accepted messages. Prior to
         calling this method, the application must ensure that the promised_id
         accepted_id, and accepted_value variables have been persisted to stable
-        media.
+        media. Requests that were deferred while persistence was pending are
+        then processed, which may require persistence once again.
         '''
         if self.active:
             
@@ -259,6 +274,15 @@ class Acceptor (essential.Acceptor):
         self.pending_promise  = None
         self.pending_accepted = None
 
+        queued_prepare, self.queued_prepare = self.queued_prepare, None
+        queued_accept,  self.queued_accept  = self.queued_accept,  None
+
+        if queued_prepare is not None:
+            self.recv_prepare(*queued_prepare)
+
+        if queued_accept is not None:
+            self.recv_accept_request(*queued_accept)
+
 
         
 class Learner (essential.Learner):
@@ -286,7 +310,7 @@ class Learner (essential.Learner):
             
         last_pn = self.acceptors.get(from_uid)
 
-        if not proposal_id > last_pn:
+        if last_pn is not None and not proposal_id > last_pn:
             return # Old message
 
         self.acceptors[ from_uid ] = proposal_id
@@ -0,0 +1,539 @@
+'''
+This module provides a compact binary encoding for every message exchanged
+by the Paxos nodes in this package along with a decoder that delivers
+received messages directly to the recv_* methods of a node.
+
+Each message has a fixed layout determined by its type:
+
+    type       (1 byte)
+    from_uid   (uid reference)
+    fields     (message specific, see PRACTICAL_MESSAGES and MULTI_MESSAGES)
+
+Integers are encoded as unsigned LEB128 varints of at most 10 bytes, which
+limits them to 64 bits. Proposal IDs are encoded as a varint holding the
+proposal number plus one, zero being reserved for None, followed by a uid
+reference. UIDs listed in the Codec's interning table are referenced by their
+varint index; all other UIDs are written inline. Values are encoded as a
+varint holding the length plus one, zero being reserved for None, followed by
+the value's bytes.
+
+Messages are decoded directly from a memoryview of the received data. The
+only copies made are of the uids and values, which are returned as byte
+strings (or passed to the value codec as memoryview slices) as the node may
+retain them after the received buffer has been reused.
+
+Messages are self-delimiting, so any number of them may be concatenated into
+a single frame. The destination of directed messages is not encoded as it is
+implied by the transport.
+
+Decoding never raises any exception other than a WireError for malformed
+input, including failures of the value codec's loads() method, so received
+data may be decoded without trusting the sender.
+
+MultiCodec combines MULTI_MESSAGES with a BatchCodec so that the
+batching.Batch values proposed by batching.ProposalBatcher and
+aio.AsyncNode may be sent between multi.MultiPaxosNodes.
+'''
+import sys
+
+from paxos.essential import ProposalID
+from paxos.batching  import RECV_METHODS, Batch
+
+
+class WireError (Exception):
+    pass
+
+class MessageTruncated (WireError):
+    pass
+
+class UnknownMessage (WireError):
+    pass
+
+class MalformedMessage (WireError):
+    pass
+
+
+# Field kinds
+PID      = 'pid'
+SLOT     = 'slot'
+VALUE    = 'value'
+ACCEPTED = 'accepted' # maps slot => (accepted_id, accepted_value)
+
+
+# Message layouts as (message_name, type_id, fields). The message names match
+# those used by batching.BatchingMessenger.
+#
+PRACTICAL_MESSAGES = [ ('prepare',                 1, (PID,)),
+                       ('promise',                 2, (PID, PID, VALUE)),
+                       ('prepare_nack',            3, (PID, PID)),
+                       ('accept',                  4, (PID, VALUE)),
+                       ('accepted',                5, (PID, VALUE)),
+                       ('accept_nack',             6, (PID, PID)),
+                       ('heartbeat',               7, (PID,)),
+                       ('leadership_proclamation', 8, (PID,)) ]
+
+MULTI_MESSAGES     = [ ('prepare',                 1, (PID, SLOT)),
+                       ('promise',                 2, (PID, SLOT, ACCEPTED)),
+                       ('prepare_nack',            3, (PID, PID)),
+                       ('accept',                  4, (SLOT, PID, VALUE)),
+                       ('accepted',                5, (SLOT, PID, VALUE)),
+                       ('accept_nack',             6, (SLOT, PID, PID)) ]
+
+
+# UID reference kinds. References at or above UID_INTERNED hold the index of
+# the uid in the interning table plus UID_INTERNED.
+UID_BYTES    = 0
+UID_TEXT     = 1
+UID_INT      = 2
+UID_INTERNED = 3
+
+# Value kinds used by BatchCodec
+VALUE_PLAIN  = 0
+VALUE_BATCH  = 1
+
+
+_text_type = type(u'')
+
+if sys.version_info[0] >= 3:
+    def _byte(view, offset):
+        return view[offset]
+else:
+    def _byte(view, offset):
+        return ord(view[offset])
+
+
+def put_varint( buf, n ):
+    '''
+    Appends the unsigned LEB128 encoding of n to the bytearray buf. Raises
+    ValueError if n is negative or does not fit in 64 bits.
+    '''
+    if n >> 64:
+        raise ValueError('Varints must be unsigned 64 bit integers')
+    while n > 0x7F:
+        buf.append( (n & 0x7F) | 0x80 )
+        n >>= 7
+    buf.append( n )
+
+
+def get_varint( view, offset ):
+    '''
+    Returns a (value, offset) tuple for the varint at the offset of the view.
+    Varints longer than 10 bytes or exceeding 64 bits are rejected.
+    '''
+    n = 0
+    try:
+        for shift in range(0, 70, 7):
+            b       = _byte(view, offset)
+            offset += 1
+            n      |= (b & 0x7F) << shift
+            if b < 0x80:
+                if n >> 64:
+                    raise MalformedMessage('Varint exceeds 64 bits')
+                return n, offset
+    except IndexError:
+        raise MessageTruncated()
+    raise MalformedMessage('Varint exceeds 10 bytes')
+
+
+class Codec (object):
+    '''
+    Encodes and decodes messages for one of the message layouts defined by
+    this module. PRACTICAL_MESSAGES, the default, covers the practical,
+    functional and external nodes. MULTI_MESSAGES covers multi.MultiPaxosNode.
+
+    The 'uids' argument lists the UIDs to intern. All peers must use the
+    same list, in the same order. Values must be byte strings unless a
+    'value_codec' object is supplied, in which case its dumps() method is
+    used to convert values to byte strings and its loads() method is called
+    with a memoryview of the encoded value on receipt.
+    '''
+
+    def __init__(self, uids=(), value_codec=None, messages=PRACTICAL_MESSAGES):
+        self.uids        = list(uids)
+        self.uid_refs    = dict( (uid, i + UID_INTERNED) for i, uid in enumerate(self.uids) )
+        self.value_codec = value_codec
+        self.by_name     = dict() # maps message_name => (type_id, encoders)
+        self.by_type     = dict() # maps type_id => (message_name, recv_method, decoders)
+
+        encoders = { PID      : self._put_pid,
+                     SLOT     : put_varint,
+                     VALUE    : self._put_value,
+                     ACCEPTED : self._put_accepted }
+
+        decoders = { PID      : self._get_pid,
+                     SLOT     : get_varint,
+                     VALUE    : self._get_value,
+                     ACCEPTED : self._get_accepted }
+
+        for name, type_id, fields in messages:
+            self.by_name[ name ]    = (type_id, [ encoders[f] for f in fields ])
+            self.by_type[ type_id ] = (name, RECV_METHODS[name], [ decoders[f] for f in fields ])
+
+
+    def _put_uid(self, buf, uid):
+        ref = self.uid_refs.get(uid)
+
+        if ref is not None:
+            put_varint( buf, ref )
+            return
+
+        if isinstance(uid, bytes):
+            kind = UID_BYTES
+        elif isinstance(uid, _text_type):
+            kind, uid = UID_TEXT, uid.encode('utf-8')
+        elif isinstance(uid, int) and not isinstance(uid, bool):
+            put_varint( buf, UID_INT )
+            put_varint( buf, uid )
+            return
+        else:
+            raise TypeError('Unsupported uid type: %r' % (uid,))
+
+        put_varint( buf, kind )
+        put_varint( buf, len(uid) )
+        buf.extend( uid )
+
+
+    def _get_uid(self, view, offset):
+        ref, offset = get_varint(view, offset)
+
+        if ref >= UID_INTERNED:
+            try:
+                return self.uids[ ref - UID_INTERNED ], offset
+            except IndexError:
+                raise UnknownMessage('Unknown interned uid: %d' % ref)
+
+        if ref == UID_INT:
+            return get_varint(view, offset)
+
+        length, offset = get_varint(view, offset)
+        end            = offset + length
+
+        if end > len(view):
+            raise MessageTruncated()
+
+        uid = view[offset:end].tobytes()
+
+        if ref == UID_TEXT:
+            uid = uid.decode('utf-8')
+
+        return uid, end
+
+
+    def _put_pid(self, buf, pid):
+        if pid is None:
+            buf.append( 0 )
+        else:
+            put_varint( buf, pid[0] + 1 )
+            self._put_uid( buf, pid[1] )
+
+
+    def _get_pid(self, view, offset):
+        number, offset = get_varint(view, offset)
+
+        if number == 0:
+            return None, offset
+
+        uid, offset = self._get_uid(view, offset)
+
+        return ProposalID(number - 1, uid), offset
+
+
+    def _put_value(self, buf, value):
+        if value is None:
+            buf.append( 0 )
+            return
+
+        if self.value_codec is not None:
+            value = self.value_codec.dumps(value)
+
+        put_varint( buf, len(value) + 1 )
+        buf.extend( value )
+
+
+    def _get_value(self, view, offset):
+        length, offset = get_varint(view, offset)
+
+        if length == 0:
+            return None, offset
+
+        end = offset + length - 1
+
+        if end > len(view):
+            raise MessageTruncated()
+
+        if self.value_codec is not None:
+            return self.value_codec.loads( view[offset:end] ), end
+        else:
+            return view[offset:end].tobytes(), end
+
+
+    def _put_accepted(self, buf, accepted):
+        put_varint( buf, len(accepted) )
+        for slot in sorted(accepted.keys()):
+            accepted_id, value = accepted[slot]
+            put_varint( buf, slot )
+            self._put_pid( buf, accepted_id )
+            self._put_value( buf, value )
+
+
+    def _get_accepted(self, view, offset):
+        accepted       = dict()
+        count, offset  = get_varint(view, offset)
+
+        for i in range(count):
+            slot, offset        = get_varint(view, offset)
+            accepted_id, offset = self._get_pid(view, offset)
+            value, offset       = self._get_value(view, offset)
+            accepted[ slot ]    = (accepted_id, value)
+
+        return accepted, offset
+
+
+    def encode_into(self, buf, from_uid, name, args):
+        '''
+        Appends the encoding of a message to the bytearray buf. The 'name' and
+        'args' arguments are those used by batching.BatchingMessenger: the
+        arguments of the corresponding send_* method, less any to_uid.
+        '''
+        try:
+            type_id, encoders = self.by_name[ name ]
+        except KeyError:
+            raise UnknownMessage('Unknown message: ' + name)
+
+        if len(args) != len(encoders):
+            raise TypeError('%s messages require %d arguments' % (name, len(encoders)))
+
+        buf.append( type_id )
+        self._put_uid( buf, from_uid )
+
+        for encoder, arg in zip(encoders, args):
+            encoder( buf, arg )
+
+
+    def encode(self, from_uid, name, args):
+        '''
+        Returns the encoding of a single message
+        '''
+        buf = bytearray()
+        self.encode_into( buf, from_uid, name, args )
+        return bytes(buf)
+
+
+    def encode_frame(self, from_uid, messages):
+        '''
+        Returns the encoding of a list of (name, args) tuples, as passed to
+        send_frame() by batching.BatchingMessenger
+        '''
+        buf = bytearray()
+        for name, args in messages:
+            self.encode_into( buf, from_uid, name, args )
+        return bytes(buf)
+
+
+    def _decode_one(self, view, offset):
+        try:
+            type_id = _byte(view, offset)
+        except IndexError:
+            raise MessageTruncated()
+
+        try:
+            name, method, decoders = self.by_type[ type_id ]
+        except KeyError:
+            raise UnknownMessage('Unknown message type: %d' % type_id)
+
+        try:
+            from_uid, offset = self._get_uid(view, offset + 1)
+
+            args = list()
+            for decoder in decoders:
+                arg, offset = decoder(view, offset)
+                args.append( arg )
+
+        except WireError:
+            raise
+        except Exception as e:
+            # Invalid UTF-8 uids, values rejected by the value codec, etc.
+            raise MalformedMessage('Malformed %s message: %r' % (name, e))
+
+        return name, method, from_uid, args, offset
+
+
+    def decode(self, data):
+        '''
+        Returns a list of (from_uid, name, args) tuples for each message
+        contained in data, which may be any object supporting the buffer
+        protocol
+        '''
+        view   = memoryview(data)
+        offset = 0
+        msgs   = list()
+
+        while offset < len(view):
+            name, method, from_uid, args, offset = self._decode_one(view, offset)
+            msgs.append( (from_uid, name, tuple(args)) )
+
+        return msgs
+
+
+    def dispatch(self, node, data):
+        '''
+        Decodes each message contained in data and delivers it to the
+        corresponding recv_* method of the node as soon as it is decoded.
+        Returns the number of messages delivered.
+        '''
+        view   = memoryview(data)
+        offset = 0
+        count  = 0
+
+        while offset < len(view):
+            name, method, from_uid, args, offset = self._decode_one(view, offset)
+            getattr(node, method)(from_uid, *args)
+            count += 1
+
+        return count
+
+
+
+class MultiCodec (Codec):
+    '''
+    Encodes and decodes MULTI_MESSAGES for multi.MultiPaxosNode with a
+    BatchCodec as the value codec. The 'command_codec' is passed to the
+    BatchCodec.
+    '''
+
+    def __init__(self, uids=(), command_codec=None):
+        super(MultiCodec, self).__init__(uids, BatchCodec(command_codec), MULTI_MESSAGES)
+
+
+
+class BatchCodec (object):
+    '''
+    Value codec for batching.Batch values. Each value begins with a varint
+    kind. Batches (VALUE_BATCH) continue with the batcher_uid, encoded as a
+    uid reference, the batch number as a varint and the number of commands
+    as a varint, followed by each command encoded as a value. Any other
+    value (VALUE_PLAIN), such as the noop_value of a MultiPaxosNode, is
+    encoded as a single value.
+
+    Commands and plain values must be byte strings unless a 'command_codec'
+    object is supplied, which is used for them as a Codec's 'value_codec'.
+    '''
+
+    def __init__(self, command_codec=None):
+        self.codec = Codec(value_codec=command_codec)
+
+
+    def dumps(self, value):
+        buf = bytearray()
+
+        if isinstance(value, Batch):
+            put_varint( buf, VALUE_BATCH )
+            self.codec._put_uid( buf, value.batcher_uid )
+            put_varint( buf, value.number )
+            put_varint( buf, len(value.commands) )
+            for command in value.commands:
+                self.codec._put_value( buf, command )
+        else:
+            put_varint( buf, VALUE_PLAIN )
+            self.codec._put_value( buf, value )
+
+        return bytes(buf)
+
+
+    def loads(self, view):
+        kind, offset = get_varint(view, 0)
+
+        if kind == VALUE_BATCH:
+            batcher_uid, offset = self.codec._get_uid(view, offset)
+            number, offset      = get_varint(view, offset)
+            count, offset       = get_varint(view, offset)
+            commands            = list()
+
+            for i in range(count):
+                command, offset = self.codec._get_value(view, offset)
+                commands.append( command )
+
+            value = Batch(batcher_uid, number, tuple(commands))
+
+        elif kind == VALUE_PLAIN:
+            value, offset = self.codec._get_value(view, offset)
+
+        else:
+            raise MalformedMessage('Unknown value kind: %d' % kind)
+
+        if offset != len(view):
+            raise MalformedMessage('Trailing bytes after value')
+
+        return value
+
+
+
+class WireMessenger (object):
+    '''
+    This class wraps an application messenger and encodes all outbound
+    messages with a Codec. Encoded messages are passed to the wrapped
+    messenger's send_data(to_uid, data) method, which must be implemented by
+    the application. As with batching.BatchingMessenger, 'to_uid' is None for
+    broadcast messages. Received data should be passed to Codec.dispatch().
+
+    This class also implements send_frame() so that it may itself be wrapped
+    by a BatchingMessenger, in which case each batched frame is encoded into
+    a single send_data() call.
+
+    All other attributes are delegated directly to the wrapped messenger.
+    '''
+
+    def __init__(self, messenger, node_uid, codec=None):
+        self.messenger = messenger
+        self.node_uid  = node_uid
+        self.codec     = codec if codec is not None else Codec()
+
+
+    def __getattr__(self, name):
+        return getattr(self.messenger, name)
+
+
+    def send_data(self, to_uid, data):
+        '''
+        Transmits encoded data. Subclasses implementing a transport may
+        override this method rather than wrapping a messenger that provides it.
+        '''
+        self.messenger.send_data( to_uid, data )
+
+
+    def _send(self, to_uid, name, args):
+        self.send_data( to_uid, self.codec.encode(self.node_uid, name, args) )
+
+
+    def send_frame(self, to_uid, messages):
+        self.send_data( to_uid, self.codec.encode_frame(self.node_uid, messages) )
+
+
+    # Broadcast messages
+
+    def send_prepare(self, *args):
+        self._send(None, 'prepare', args)
+
+    def send_accept(self, *args):
+        self._send(None, 'accept', args)
+
+    def send_accepted(self, *args):
+        self._send(None, 'accepted', args)
+
+    def send_heartbeat(self, *args):
+        self._send(None, 'heartbeat', args)
+
+    def send_leadership_proclamation(self, *args):
+        self._send(None, 'leadership_proclamation', args)
+
+
+    # Directed messages
+
+    def send_promise(self, to_uid, *args):
+        self._send(to_uid, 'promise', args)
+
+    def send_prepare_nack(self, to_uid, *args):
+        self._send(to_uid, 'prepare_nack', args)
+
+    def send_accept_nack(self, to_uid, *args):
+        self._send(to_uid, 'accept_nack', args)
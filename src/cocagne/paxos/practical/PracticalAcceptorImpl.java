@@ -9,6 +9,13 @@ public class PracticalAcceptorImpl extends EssentialAcceptorImpl implements Prac
 	protected String  pendingPromise  = null;
 	protected boolean active          = true;
 	
+	// Most recent requests received while persistence was pending
+	protected String     queuedPrepareUID    = null;
+	protected ProposalID queuedPrepareID     = null;
+	protected String     queuedAcceptUID     = null;
+	protected ProposalID queuedAcceptID      = null;
+	protected Object     queuedAcceptValue   = null;
+	
 	public PracticalAcceptorImpl(PracticalMessenger messenger) {
 		super(messenger);
 	}
@@ -40,6 +47,10 @@ public class PracticalAcceptorImpl extends EssentialAcceptorImpl implements Prac
 				if (active)
 					pendingPromise = fromUID;
 			}
+			else if (queuedPrepareID == null || proposalID.isGreaterThan(queuedPrepareID)) {
+				queuedPrepareUID = fromUID;
+				queuedPrepareID  = proposalID;
+			}
 		}
 		else {
 			if (active)
@@ -64,6 +75,11 @@ public class PracticalAcceptorImpl extends EssentialAcceptorImpl implements Prac
 				if (active)
 					pendingAccepted = fromUID;
 			}
+			else if (queuedAcceptID == null || proposalID.isGreaterThan(queuedAcceptID)) {
+				queuedAcceptUID   = fromUID;
+				queuedAcceptID    = proposalID;
+				queuedAcceptValue = value;
+			}
 		}
 		else {
 			if (active)
@@ -82,6 +98,24 @@ public class PracticalAcceptorImpl extends EssentialAcceptorImpl implements Prac
 		}
 		pendingPromise  = null;
 		pendingAccepted = null;
+		
+		String     prepareUID  = queuedPrepareUID;
+		ProposalID prepareID   = queuedPrepareID;
+		String     acceptUID   = queuedAcceptUID;
+		ProposalID acceptID    = queuedAcceptID;
+		Object     acceptValue = queuedAcceptValue;
+		
+		queuedPrepareUID  = null;
+		queuedPrepareID   = null;
+		queuedAcceptUID   = null;
+		queuedAcceptID    = null;
+		queuedAcceptValue = null;
+		
+		if (prepareID != null)
+			receivePrepare(prepareUID, prepareID);
+		
+		if (acceptID != null)
+			receiveAcceptRequest(acceptUID, acceptID, acceptValue);
 	}
 
 
@@ -0,0 +1,521 @@
+'''
+Benchmarks for the aio module over loopback. Run directly with Python 3:
+
+    python bench_aio.py [udp] [tcp] [heartbeat] [propose]
+'''
+
+import sys
+import os.path
+import time
+import socket
+import asyncio
+import collections
+import multiprocessing
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append( os.path.dirname(this_dir) )
+
+from paxos import aio, practical, functional, multi
+from paxos.practical import ProposalID
+
+
+class CountingNode (object):
+    '''
+    Counts delivered heartbeats and answers Prepare messages with a Promise
+    so that round trips may be timed
+    '''
+
+    leader               = False
+    liveness_window      = 3600
+    persistance_required = False
+
+    def __init__(self, messenger):
+        self.messenger  = messenger
+        self.heartbeats = 0
+        self.promises   = 0
+        self.waiter     = None
+
+    def recv_heartbeat(self, from_uid, proposal_id):
+        self.heartbeats += 1
+
+    def recv_prepare(self, from_uid, proposal_id):
+        self.messenger.send_promise(from_uid, proposal_id, None, None)
+
+    def recv_promise(self, from_uid, proposal_id, prev_id, prev_value):
+        self.promises += 1
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+async def udp_cluster(loop, uids):
+    peers = dict( (uid, ('127.0.0.1', 0)) for uid in uids )
+    nodes = dict()
+
+    for uid in uids:
+        m = aio.UDPMessenger(uid, peers, loop=loop)
+        await m.listen()
+        nodes[ uid ] = CountingNode(m)
+        m.attach( nodes[uid] )
+
+    return nodes
+
+
+async def udp_flood(loop, nmessages, burst):
+    '''
+    Broadcasts heartbeats from A in bursts. As asyncio delivers one datagram
+    per socket per event loop iteration, the sender waits for the receivers
+    to drain all but one burst before sending the next.
+    '''
+    nodes = await udp_cluster(loop, ['A', 'B', 'C'])
+    a     = nodes['A'].messenger
+    b     = nodes['B']
+    pid   = ProposalID(1, 'A')
+
+    tstart = time.time()
+    for sent in range(burst, nmessages + burst, burst):
+        for j in range(burst):
+            a.send_heartbeat(pid)
+
+        deadline = time.time() + 0.5
+        while b.heartbeats < sent - burst and time.time() < deadline:
+            await asyncio.sleep(0)
+
+    deadline = time.time() + 0.5
+    while b.heartbeats < nmessages and time.time() < deadline:
+        await asyncio.sleep(0)
+
+    elapsed  = time.time() - tstart
+    received = nodes['B'].heartbeats + nodes['C'].heartbeats
+
+    for n in nodes.values():
+        n.messenger.close()
+
+    return elapsed, received
+
+
+async def udp_round_trips(loop, iterations):
+    nodes = await udp_cluster(loop, ['A', 'B'])
+    a     = nodes['A']
+    pid   = ProposalID(1, 'A')
+
+    # Prepare is a broadcast message, so it is encoded and sent to B directly
+    prepare   = a.messenger.codec.encode('A', 'prepare', (pid,))
+    latencies = list()
+
+    for i in range(iterations):
+        a.waiter = loop.create_future()
+        tstart   = time.time()
+        a.messenger.send_data('B', prepare)
+        await a.waiter
+        latencies.append( time.time() - tstart )
+
+    for n in nodes.values():
+        n.messenger.close()
+
+    latencies.sort()
+    return latencies
+
+
+def bench_udp(nmessages=200000, iterations=2000):
+    loop = asyncio.new_event_loop()
+
+    try:
+        print('%-10s %12s %12s %10s' % ('burst', 'sent/s', 'delivered/s', 'loss'))
+
+        for burst in (1, 16, 64, 256):
+            elapsed, received = loop.run_until_complete( udp_flood(loop, nmessages, burst) )
+            expected          = nmessages * 2
+            print('%-10d %12.0f %12.0f %9.2f%%' % (burst, nmessages / elapsed, received / elapsed,
+                                                   100.0 * (expected - received) / expected))
+
+        latencies = loop.run_until_complete( udp_round_trips(loop, iterations) )
+
+        print('round trip us: mean %.1f  p50 %.1f  p99 %.1f' % (
+            sum(latencies) * 1e6 / iterations,
+            latencies[iterations // 2] * 1e6,
+            latencies[iterations * 99 // 100] * 1e6))
+    finally:
+        loop.close()
+
+
+class LeaderRecorder (functional.HeartbeatMessenger):
+
+    def __init__(self):
+        self.resolved   = None
+        self.leader_uid = None
+
+    def on_resolution(self, proposal_id, value):
+        self.resolved = time.time()
+
+    def on_leadership_change(self, prev_leader_uid, new_leader_uid):
+        self.leader_uid = new_leader_uid
+
+
+async def heartbeat_run(loop, nnodes, hb_period, liveness_window):
+    '''
+    Starts a cluster of HeartbeatNodes, waits for all of them to resolve a
+    value, then closes the leader and times the election of its successor
+    '''
+    uids  = [ chr(ord('A') + i) for i in range(nnodes) ]
+    peers = dict( (uid, ('127.0.0.1', 0)) for uid in uids )
+    ms    = dict()
+    apps  = dict()
+
+    for uid in uids:
+        apps[ uid ] = LeaderRecorder()
+        ms[ uid ]   = aio.UDPMessenger(uid, peers, messenger=apps[uid], loop=loop)
+        await ms[uid].listen()
+
+    tstart = time.time()
+
+    for uid in uids:
+        n = functional.HeartbeatNode(ms[uid], uid, nnodes // 2 + 1, hb_period=hb_period,
+                                     liveness_window=liveness_window)
+        n.set_proposal( uid.encode() )
+        ms[ uid ].attach( n )
+
+    def leaders(uids):
+        return set( apps[uid].leader_uid for uid in uids )
+
+    while not (all( a.resolved for a in apps.values() ) and len(leaders(uids)) == 1
+               and None not in leaders(uids)):
+        await asyncio.sleep(0.001)
+
+    resolved = max( a.resolved for a in apps.values() ) - tstart
+    old      = leaders(uids).pop()
+    rest     = [ uid for uid in uids if uid != old ]
+
+    tfail = time.time()
+    ms[ old ].close()
+
+    while leaders(rest) in (set([old]), set([None])) or len(leaders(rest)) != 1:
+        await asyncio.sleep(0.001)
+
+    failover = time.time() - tfail
+
+    for m in ms.values():
+        m.close()
+    await asyncio.sleep(0)
+
+    return resolved, failover
+
+
+def bench_heartbeat(runs=10, hb_period=0.01, liveness_window=0.05):
+    '''
+    Times leader election plus resolution and leader failover for clusters
+    of real HeartbeatNodes over loopback UDP
+    '''
+    loop = asyncio.new_event_loop()
+
+    print('hb_period %.0f ms, liveness_window %.0f ms, %d runs' % (hb_period * 1000,
+                                                                 liveness_window * 1000, runs))
+    print('%-6s %18s %18s' % ('nodes', 'resolve ms (mean)', 'failover ms (mean)'))
+
+    try:
+        for nnodes in (3, 5):
+            results = [ loop.run_until_complete( heartbeat_run(loop, nnodes, hb_period, liveness_window) )
+                        for i in range(runs) ]
+
+            print('%-6d %18.1f %18.1f' % (nnodes,
+                                          sum( r[0] for r in results ) * 1000 / runs,
+                                          sum( r[1] for r in results ) * 1000 / runs))
+    finally:
+        loop.close()
+
+
+class InstanceNode (object):
+    '''
+    Runs a separate practical.Node for each Paxos instance so that a series
+    of values may be resolved over one set of connections. Instance i uses
+    the proposal numbers from i * stride, by which received messages are
+    routed to it. Only the 'retain' most recent instances are kept and
+    messages for older ones are ignored.
+    '''
+
+    stride = 1000
+    retain = 256
+
+    def __init__(self, messenger, node_uid, quorum_size):
+        self.messenger   = messenger
+        self.node_uid    = node_uid
+        self.quorum_size = quorum_size
+        self.instances   = collections.OrderedDict()
+        self.low         = 0
+        self.unsaved     = set()
+
+    @property
+    def persistance_required(self):
+        return bool(self.unsaved)
+
+    def persisted(self):
+        unsaved, self.unsaved = self.unsaved, set()
+        for n in unsaved:
+            n.persisted()
+            if n.persistance_required:
+                self.unsaved.add( n )
+
+    def instance(self, i):
+        if i < self.low:
+            return None
+
+        n = self.instances.get(i)
+
+        if n is None:
+            n = self.instances[ i ] = practical.Node(self.messenger, self.node_uid, self.quorum_size)
+            n.next_proposal_number  = i * self.stride
+
+            self.low = max(self.low, i - self.retain + 1)
+            while next(iter(self.instances)) < self.low:
+                self.instances.popitem(last=False)
+
+        return n
+
+    def _deliver(self, proposal_id, method, *args):
+        n = self.instance( proposal_id[0] // self.stride )
+        if n is not None:
+            getattr(n, method)(*args)
+            if n.persistance_required:
+                self.unsaved.add( n )
+
+    def recv_prepare(self, from_uid, proposal_id):
+        self._deliver(proposal_id, 'recv_prepare', from_uid, proposal_id)
+
+    def recv_promise(self, from_uid, proposal_id, prev_id, prev_value):
+        self._deliver(proposal_id, 'recv_promise', from_uid, proposal_id, prev_id, prev_value)
+
+    def recv_prepare_nack(self, from_uid, proposal_id, promised_id):
+        self._deliver(proposal_id, 'recv_prepare_nack', from_uid, proposal_id, promised_id)
+
+    def recv_accept_request(self, from_uid, proposal_id, value):
+        self._deliver(proposal_id, 'recv_accept_request', from_uid, proposal_id, value)
+
+    def recv_accepted(self, from_uid, proposal_id, value):
+        self._deliver(proposal_id, 'recv_accepted', from_uid, proposal_id, value)
+
+    def recv_accept_nack(self, from_uid, proposal_id, promised_id):
+        self._deliver(proposal_id, 'recv_accept_nack', from_uid, proposal_id, promised_id)
+
+
+class ResolutionTimer (practical.Messenger):
+    '''
+    Records the time taken to resolve each instance started by the leader.
+    wait() completes when an instance resolves.
+    '''
+
+    def __init__(self, loop):
+        self.loop      = loop
+        self.started   = dict() # maps instance => start time
+        self.latencies = list()
+        self.waiter    = None
+
+    def on_resolution(self, proposal_id, value):
+        tstart = self.started.pop( proposal_id[0] // InstanceNode.stride, None )
+
+        if tstart is not None:
+            self.latencies.append( time.time() - tstart )
+
+            if self.waiter is not None and not self.waiter.done():
+                self.waiter.set_result( None )
+
+    async def wait(self, timeout):
+        self.waiter = self.loop.create_future()
+        await asyncio.wait_for( self.waiter, timeout )
+
+
+def free_ports(n):
+    socks = [ socket.socket() for i in range(n) ]
+    for s in socks:
+        s.bind(('127.0.0.1', 0))
+    ports = [ s.getsockname()[1] for s in socks ]
+    for s in socks:
+        s.close()
+    return ports
+
+
+def tcp_follower(uid, peers):
+    loop = asyncio.new_event_loop()
+    m    = aio.TCPMessenger(uid, peers, loop=loop)
+    loop.run_until_complete( m.listen() )
+    m.attach( InstanceNode(m, uid, len(peers) // 2 + 1) )
+    loop.run_forever()
+
+
+async def tcp_leader(loop, peers, first, nvalues, size, window, high_water):
+    '''
+    Resolves 'nvalues' instances, starting with instance 'first', keeping
+    up to 'window' of them outstanding. Each instance runs both phases of
+    Paxos from the leader, A. As any message may be dropped under load,
+    outstanding instances are prepared again if none resolve for a second.
+    '''
+    app = ResolutionTimer(loop)
+    m   = aio.TCPMessenger('A', peers, messenger=app, loop=loop, high_water=high_water,
+                           low_water=high_water // 4)
+    n   = InstanceNode(m, 'A', len(peers) // 2 + 1)
+
+    await m.listen()
+    m.attach( n )
+    await m.wait_writable()
+
+    value = b'v' * size
+    stats = dict(peak=0, retries=0)
+
+    async def wait_below(limit):
+        while len(app.started) > limit:
+            try:
+                await app.wait( 1.0 )
+            except asyncio.TimeoutError:
+                stats['retries'] += len(app.started)
+                for i in app.started:
+                    n.instance(i).prepare()
+
+            stats['peak'] = max(stats['peak'], sum( c.transport.get_write_buffer_size()
+                                                    for c in m.connections.values()
+                                                    if c.transport is not None ))
+
+    tstart = time.time()
+
+    for i in range(first, first + nvalues):
+        await wait_below( window - 1 )
+        await m.wait_writable()
+
+        app.started[ i ] = time.time()
+        p                = n.instance(i)
+        p.set_proposal( value )
+        p.prepare()
+
+    await wait_below( 0 )
+
+    elapsed = time.time() - tstart
+    dropped = m.dropped + sum( c.dropped for c in m.connections.values() )
+
+    m.close()
+    await asyncio.sleep(0)
+
+    app.latencies.sort()
+
+    return elapsed, app.latencies, stats['peak'], dropped, stats['retries']
+
+
+def bench_tcp(nodes=3, window=16, max_in_flight=4 * 1024 * 1024):
+    '''
+    Runs the leader of a cluster of practical.Nodes in this process against
+    followers in child processes, resolving values of various sizes with
+    and without a meaningful write-buffer high watermark. At most 'window'
+    instances, holding no more than 'max_in_flight' bytes of values, are
+    outstanding at once.
+    '''
+    ports = free_ports(nodes)
+    uids  = [ chr(ord('A') + i) for i in range(nodes) ]
+    peers = dict( (uid, ('127.0.0.1', port)) for uid, port in zip(uids, ports) )
+    procs = [ multiprocessing.Process(target=tcp_follower, args=(uid, dict(peers)))
+              for uid in uids[1:] ]
+
+    for p in procs:
+        p.daemon = True
+        p.start()
+
+    loop  = asyncio.new_event_loop()
+    first = 0
+
+    print('%d nodes, %d follower processes' % (nodes, len(procs)))
+    print('%-8s %-10s %7s %10s %8s %8s %8s %12s %8s %8s' % ('size', 'high water', 'window',
+                                                           'values/s', 'MB/s', 'p50 ms', 'p99 ms',
+                                                           'peak buffer', 'dropped', 'retries'))
+
+    try:
+        for size, nvalues in ((1024, 20000), (64 * 1024, 2000), (1024 * 1024, 200)):
+            w = max(1, min(window, max_in_flight // size))
+
+            for high_water in (256 * 1024, 1 << 40):
+                elapsed, latencies, peak, dropped, retries = loop.run_until_complete(
+                    tcp_leader(loop, dict(peers), first, nvalues, size, w, high_water) )
+
+                first += nvalues
+
+                print('%-8s %-10s %7d %10.0f %8.1f %8.2f %8.2f %12d %8d %8d' % (
+                    '%dK' % (size // 1024),
+                    '%dK' % (high_water // 1024) if high_water < 1 << 30 else 'none',
+                    w,
+                    nvalues / elapsed,
+                    nvalues * size * (nodes - 1) / elapsed / (1024 * 1024),
+                    latencies[len(latencies) // 2] * 1000,
+                    latencies[len(latencies) * 99 // 100] * 1000,
+                    peak, dropped, retries))
+    finally:
+        loop.close()
+        for p in procs:
+            p.terminate()
+            p.join()
+
+
+class SimulatedLog (object):
+    '''
+    Resolves each Accept! sent by a MultiPaxosNode leader after a fixed
+    round trip time, standing in for the Acceptors and the network
+    '''
+
+    def __init__(self, loop, rtt):
+        self.loop  = loop
+        self.rtt   = rtt
+        self.node  = None
+        self.slots = 0
+
+    def send_accept(self, slot, proposal_id, value):
+        self.slots += 1
+        self.loop.call_later(self.rtt, self.node.slot_resolved, slot, proposal_id, value)
+
+    def on_resolution(self, slot, proposal_id, value):
+        pass
+
+
+async def concurrent_writes(loop, nwriters, nwrites, rtt, window, max_batch_size):
+    log  = SimulatedLog(loop, rtt)
+    a    = aio.AsyncNode(log, loop=loop, max_batch_size=max_batch_size)
+    node = multi.MultiPaxosNode(a, 'A', 2, pipeline_window=window)
+
+    node.leader      = True
+    node.proposal_id = ProposalID(1, 'A')
+    log.node         = node
+    a.attach(node)
+
+    async def writer(w):
+        for i in range(nwrites):
+            await a.propose( (w, i) )
+
+    tstart = time.time()
+    await asyncio.gather( *[ writer(w) for w in range(nwriters) ] )
+    return time.time() - tstart, log.slots
+
+
+def bench_propose(nwriters=1000, nwrites=20, rtt=0.001, window=8):
+    '''
+    Issues writes from many concurrent coroutines against a simulated log
+    with a fixed round trip time, with and without multiplexing writes into
+    batches
+    '''
+    loop  = asyncio.new_event_loop()
+    total = nwriters * nwrites
+
+    print('%d writers x %d writes, %.1f ms rtt, pipeline window %d' % (nwriters, nwrites,
+                                                                       rtt * 1000, window))
+    print('%-12s %12s %10s %14s' % ('mode', 'writes/s', 'slots', 'writes/slot'))
+
+    try:
+        for label, max_batch_size in (('unbatched', 1), ('multiplexed', None)):
+            elapsed, slots = loop.run_until_complete(
+                concurrent_writes(loop, nwriters, nwrites, rtt, window, max_batch_size) )
+
+            print('%-12s %12.0f %10d %14.1f' % (label, total / elapsed, slots, float(total) / slots))
+    finally:
+        loop.close()
+
+
+BENCHMARKS = dict( udp       = bench_udp,
+                   tcp       = bench_tcp,
+                   heartbeat = bench_heartbeat,
+                   propose   = bench_propose )
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS.keys()):
+        BENCHMARKS[name]()
@@ -0,0 +1,244 @@
+'''
+Benchmarks for the durable module. Run directly:
+
+    python bench_durable.py [write] [sync] [recover] [delta]
+'''
+
+import sys
+import os
+import os.path
+import time
+import tempfile
+import shutil
+import multiprocessing
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append( os.path.dirname(this_dir) )
+
+from paxos import durable
+
+
+class SyscallCounter (object):
+    '''
+    Wraps the os functions used by the durable module's write paths and counts
+    the calls made to them
+    '''
+
+    names = ('lseek', 'write', 'writev', 'pwritev')
+
+    def __init__(self):
+        self.counts = dict()
+        self.saved  = dict()
+
+    def __enter__(self):
+        for name in self.names:
+            if hasattr(os, name):
+                self.saved[ name ] = getattr(os, name)
+                setattr(os, name, self._wrap(name, self.saved[name]))
+        return self
+
+    def __exit__(self, *args):
+        for name, func in self.saved.items():
+            setattr(os, name, func)
+
+    def _wrap(self, name, func):
+        def wrapper(*args):
+            self.counts[ name ] = self.counts.get(name, 0) + 1
+            return func(*args)
+        return wrapper
+
+
+def joined_write( fd, serial_number, pyobject ):
+    '''
+    The original write path: seek, join header and object, write
+    '''
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, durable.encode(serial_number, pyobject))
+    durable._fsync(fd)
+
+
+def vectored_write( fd, serial_number, pyobject ):
+    durable.write(fd, serial_number, pyobject)
+
+
+def pickle5_write( fd, serial_number, pyobject ):
+    durable.write(fd, serial_number, pyobject, serializer='pickle5')
+
+
+def copied_bytes( label, pyobject ):
+    '''
+    Returns the number of bytes copied in memory by the write path, counting
+    the serializer's output and any joining of buffers
+    '''
+    serializer = 'pickle5' if label == 'pickle5' else durable.DEFAULT_SERIALIZER
+    parts      = durable.encode_parts(1, pyobject, serializer=serializer)
+    copied     = sum( len(p) for p in parts if not isinstance(p, memoryview) )
+
+    if label == 'joined' or not hasattr(os, 'pwritev'):
+        copied += sum( len(p) for p in parts )
+
+    return copied
+
+
+def bench_write(iterations=20):
+    tmpfs_dir = '/dev/shm' if os.path.exists('/dev/shm') else None
+    tdir      = tempfile.mkdtemp(dir=tmpfs_dir)
+
+    print('vectored writes available: %s' % hasattr(os, 'pwritev'))
+    print('%-10s %-9s %12s %10s %14s' % ('size', 'path', 'ms/write', 'syscalls', 'bytes copied'))
+
+    try:
+        for mb in (1, 4, 16):
+            obj = b'x' * (mb * 1024 * 1024)
+
+            paths = [ ('joined', joined_write), ('vectored', vectored_write) ]
+
+            if 'pickle5' in durable.SERIALIZERS:
+                paths.append( ('pickle5', pickle5_write) )
+
+            for label, func in paths:
+                fd = os.open(os.path.join(tdir, label), os.O_CREAT | os.O_RDWR | durable._bin_flag)
+
+                with SyscallCounter() as c:
+                    func(fd, 1, obj)
+
+                copied = copied_bytes(label, obj)
+
+                tstart = time.time()
+                for i in range(iterations):
+                    func(fd, i, obj)
+                elapsed = time.time() - tstart
+
+                os.close(fd)
+
+                print('%-10s %-9s %12.3f %10d %14d' % ('%d MB' % mb, label,
+                                                       elapsed * 1000.0 / iterations,
+                                                       sum(c.counts.values()), copied))
+    finally:
+        shutil.rmtree(tdir)
+
+
+def bench_sync(iterations=200):
+    '''
+    Reports the latency of DurableObjectHandler.save() for each sync
+    strategy. A disk-backed temporary directory is used as syncing is a
+    no-op on tmpfs.
+    '''
+    tdir  = tempfile.mkdtemp()
+    state = ((10, 'node_a'), (9, 'node_b'), b'v' * 256)
+
+    handlers = [ (name, lambda i, name=name: durable.DurableObjectHandler(tdir, i, sync=name))
+                 for name in sorted(durable.SYNC_STRATEGIES.keys()) ]
+
+    handlers.append( ('memory', lambda i: durable.MemoryObjectHandler(tdir, i)) )
+
+    print('%-12s %12s %12s %12s' % ('strategy', 'mean ms', 'p50 ms', 'p99 ms'))
+
+    try:
+        for i, (name, factory) in enumerate(handlers):
+            h         = factory(i)
+            latencies = list()
+
+            for n in range(iterations):
+                tstart = time.time()
+                h.save(state)
+                latencies.append( time.time() - tstart )
+
+            h.close()
+            latencies.sort()
+
+            print('%-12s %12.3f %12.3f %12.3f' % (name,
+                                                  sum(latencies) * 1000.0 / iterations,
+                                                  latencies[iterations // 2] * 1000.0,
+                                                  latencies[iterations * 99 // 100] * 1000.0))
+    finally:
+        shutil.rmtree(tdir)
+        durable.MemoryObjectHandler.store.clear()
+
+
+def bench_recover(nobjects=2000):
+    '''
+    Compares sequential construction of DurableObjectHandlers with
+    recover_all() for a directory of many small objects
+    '''
+    tmpfs_dir = '/dev/shm' if os.path.exists('/dev/shm') else None
+    tdir      = tempfile.mkdtemp(dir=tmpfs_dir)
+    state     = ((10, 'node_a'), (9, 'node_b'), b'v' * 1024)
+
+    try:
+        for i in range(nobjects):
+            h = durable.DurableObjectHandler(tdir, i, sync='periodic')
+            h.save(state)
+            h.save(state)
+            h.close()
+
+        tstart = time.time()
+        for oid in durable.list_objects(tdir):
+            durable.DurableObjectHandler(tdir, oid).close()
+        sequential = time.time() - tstart
+
+        print('%d objects' % nobjects)
+        print('%-12s %10.3f s' % ('sequential', sequential))
+
+        for workers in (2, 4, 8, 16):
+            tstart = time.time()
+            durable.recover_all(tdir, workers=workers)
+            print('%-12s %10.3f s' % ('%d threads' % workers, time.time() - tstart))
+
+        pool   = multiprocessing.Pool()
+        tstart = time.time()
+        durable.recover_all(tdir, pool=pool)
+        print('%-12s %10.3f s' % ('%d procs' % multiprocessing.cpu_count(), time.time() - tstart))
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(tdir)
+
+
+def bench_delta(iterations=100):
+    '''
+    Compares full saves with delta saves for an Acceptor holding a large
+    accepted value while only its promised id changes
+    '''
+    tmpfs_dir = '/dev/shm' if os.path.exists('/dev/shm') else None
+    tdir      = tempfile.mkdtemp(dir=tmpfs_dir)
+
+    print('%-8s %12s %16s' % ('mode', 'ms/save', 'bytes/save'))
+
+    try:
+        for mode in ('full', 'delta'):
+            h = durable.DurableObjectHandler(tdir, mode, max_deltas=iterations)
+            h.save( ((1, 'node_a'), (1, 'node_a'), b'v' * (1024 * 1024)) )
+
+            sizes  = os.stat(h.fn_a).st_size + os.stat(h.fn_b).st_size
+            tstart = time.time()
+
+            for i in range(2, iterations + 2):
+                if mode == 'full':
+                    h.save( ((i, 'node_b'),) + h.current[1:] )
+                else:
+                    h.save_delta( {0 : (i, 'node_b')} )
+
+            elapsed = time.time() - tstart
+
+            if mode == 'full':
+                written = len(durable.encode(1, h.current))
+            else:
+                written = (os.stat(h.fn_a).st_size + os.stat(h.fn_b).st_size - sizes) // iterations
+
+            h.close()
+
+            print('%-8s %12.3f %16d' % (mode, elapsed * 1000.0 / iterations, written))
+    finally:
+        shutil.rmtree(tdir)
+
+
+BENCHMARKS = dict( write   = bench_write,
+                   sync    = bench_sync,
+                   recover = bench_recover,
+                   delta   = bench_delta )
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS.keys()):
+        BENCHMARKS[name]()
@@ -0,0 +1,729 @@
+
+import sys
+import os.path
+
+import unittest
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append( os.path.dirname(this_dir) )
+
+try:
+    import asyncio
+    from paxos import aio
+except ImportError:
+    asyncio = None
+
+from paxos import wire, practical, functional, multi, batching
+
+from test_essential import PID
+
+
+
+class TNode (object):
+    '''
+    Records the messages delivered by a transport
+    '''
+
+    leader               = False
+    liveness_window      = 5
+    quorum_size          = 2
+    persistance_required = False
+
+    def __init__(self):
+        self.received  = list()
+        self.polls     = 0
+        self.persists  = 0
+
+    def recv_heartbeat(self, from_uid, proposal_id):
+        self.received.append( ('heartbeat', from_uid, proposal_id) )
+
+    def recv_promise(self, from_uid, proposal_id, prev_id, prev_value):
+        self.received.append( ('promise', from_uid, proposal_id, prev_id, prev_value) )
+
+    def recv_accept_request(self, from_uid, proposal_id, value):
+        self.received.append( ('accept', from_uid, proposal_id, value) )
+
+    def recv_prepare(self, from_uid, proposal_id):
+        self.received.append( ('prepare', from_uid, proposal_id) )
+        self.persistance_required = True
+
+    def persisted(self):
+        self.persistance_required = False
+        self.persists += 1
+
+    def poll_liveness(self):
+        self.polls += 1
+
+
+
+class PromiseRecorder (practical.Messenger):
+
+    def __init__(self):
+        self.promises = list()
+
+    def send_promise(self, to_uid, proposal_id, prev_id, prev_value):
+        self.promises.append( (to_uid, proposal_id) )
+
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class PersisterTester (unittest.TestCase):
+
+    def setUp(self):
+        self.m = PromiseRecorder()
+        self.a = practical.Acceptor()
+        self.a.messenger = self.m
+        self.a.recover( PID(0,'A'), None, None )
+
+
+    def test_persist_immediately(self):
+        self.a.recv_prepare( 'A', PID(1,'A') )
+        self.a.recv_prepare( 'B', PID(2,'B') )
+        aio.persist_immediately( self.a )
+        self.assertFalse( self.a.persistance_required )
+        self.assertEqual( self.m.promises, [ ('A', PID(1,'A')), ('B', PID(2,'B')) ] )
+
+
+    def test_deliver(self):
+        loop  = asyncio.new_event_loop()
+        codec = wire.Codec(['A', 'B'])
+        t     = aio.TransportMessenger(self.m, 'C', codec, loop, None)
+        t.node = self.a
+        t.deliver( codec.encode('A', 'prepare', (PID(1,'A'),)) +
+                   codec.encode('B', 'prepare', (PID(2,'B'),)) )
+        loop.close()
+        self.assertFalse( self.a.persistance_required )
+        self.assertEqual( self.m.promises, [ ('A', PID(1,'A')), ('B', PID(2,'B')) ] )
+
+
+    def test_deliver_malformed_tail(self):
+        loop  = asyncio.new_event_loop()
+        codec = wire.Codec(['A', 'B'])
+        t     = aio.TransportMessenger(self.m, 'C', codec, loop, None)
+        t.node = self.a
+        t.deliver( codec.encode('A', 'prepare', (PID(1,'A'),)) + b'\xff\x00' )
+        loop.close()
+        self.assertFalse( self.a.persistance_required )
+        self.assertEqual( self.m.promises, [ ('A', PID(1,'A')) ] )
+
+
+
+class LoopTests (object):
+    '''
+    Closes the messengers in self.ms and the event loop in self.loop after
+    each test
+    '''
+
+    def tearDown(self):
+        for m in self.ms.values():
+            m.close()
+        self.loop.run_until_complete( asyncio.sleep(0) )
+        self.loop.close()
+
+
+    def run_until(self, predicate, timeout=2.0):
+        deadline = self.loop.time() + timeout
+        while not predicate() and self.loop.time() < deadline:
+            self.loop.run_until_complete( asyncio.sleep(0.005) )
+        self.assertTrue( predicate() )
+
+
+
+class TransportTests (LoopTests):
+    '''
+    Tests common to all transports. Subclasses create messengers for nodes
+    A, B and C in self.ms and their TNodes in self.nodes.
+    '''
+
+    def test_bound_addresses(self):
+        ports = set( addr[1] for addr in self.peers.values() )
+        self.assertEqual( len(ports), 3 )
+        self.assertFalse( 0 in ports )
+
+
+    def test_broadcast(self):
+        self.ms['A'].send_heartbeat( PID(1,'A') )
+        self.run_until( lambda: all( n.received for n in self.nodes.values() ) )
+        for n in self.nodes.values():
+            self.assertEqual( n.received, [('heartbeat', 'A', PID(1,'A'))] )
+
+
+    def test_directed(self):
+        self.ms['B'].send_promise( 'A', PID(1,'A'), PID(0,'C'), b'foo' )
+        self.ms['B'].send_promise( 'Z', PID(1,'A'), None, None )
+        self.run_until( lambda: self.nodes['A'].received )
+        self.assertEqual( self.nodes['A'].received, [('promise', 'B', PID(1,'A'), PID(0,'C'), b'foo')] )
+        self.assertEqual( self.nodes['B'].received, [] )
+        self.assertEqual( self.nodes['C'].received, [] )
+
+
+    def test_persist(self):
+        self.ms['A'].send_prepare( PID(1,'A') )
+        self.run_until( lambda: all( n.persists for n in self.nodes.values() ) )
+
+
+    def test_persister(self):
+        persisted = list()
+        self.ms['C'].persister = persisted.append
+        self.ms['A'].send_prepare( PID(1,'A') )
+        self.run_until( lambda: persisted )
+        self.assertEqual( persisted, [self.nodes['C']] )
+        self.assertEqual( self.nodes['C'].persists, 0 )
+
+
+    def test_malformed_messages_dropped(self):
+        self.ms['A'].send_data( 'B', b'\xff\x00' )
+        self.ms['A'].send_data( 'B', b'\x01\x01\x02\xff\xfe\x01' )
+        self.ms['A'].send_data( 'B', self.ms['A'].codec.encode('A', 'prepare', (PID(1,'A'),))[:-1] )
+        self.ms['A'].send_heartbeat( PID(2,'A') )
+        self.run_until( lambda: self.nodes['B'].received )
+        self.assertEqual( self.nodes['B'].received, [('heartbeat', 'A', PID(2,'A'))] )
+
+
+    def test_delegation(self):
+        class App (object):
+            def on_resolution(self, proposal_id, value):
+                self.resolved = (proposal_id, value)
+        app = App()
+        m   = self.messenger_class('D', dict(D=('127.0.0.1', 0)), messenger=app, loop=self.loop)
+        m.on_resolution( PID(1,'A'), b'foo' )
+        self.assertEqual( app.resolved, (PID(1,'A'), b'foo') )
+
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class UDPMessengerTester (TransportTests, unittest.TestCase):
+
+    def setUp(self):
+        self.messenger_class = aio.UDPMessenger
+        self.loop            = asyncio.new_event_loop()
+        self.peers           = dict( A=('127.0.0.1', 0), B=('127.0.0.1', 0), C=('127.0.0.1', 0) )
+        self.ms              = dict()
+        self.nodes           = dict()
+
+        for uid in sorted(self.peers.keys()):
+            m = aio.UDPMessenger(uid, self.peers, loop=self.loop)
+            n = TNode()
+            self.loop.run_until_complete( m.listen() )
+            m.attach(n)
+            self.ms[ uid ]    = m
+            self.nodes[ uid ] = n
+
+
+    def test_schedule(self):
+        called = list()
+        self.ms['A'].schedule( 0.01, lambda: called.append(True) )
+        self.run_until( lambda: called )
+
+
+    def test_poll_liveness(self):
+        m = aio.UDPMessenger('D', dict(D=('127.0.0.1', 0)), loop=self.loop, poll_interval=0.01)
+        n = TNode()
+        self.loop.run_until_complete( m.listen() )
+        m.attach(n)
+        self.run_until( lambda: n.polls >= 3 )
+        m.close()
+        polls = n.polls
+        self.loop.run_until_complete( asyncio.sleep(0.03) )
+        self.assertEqual( n.polls, polls )
+
+
+    def test_default_poll_interval(self):
+        self.assertEqual( self.ms['A'].poll_interval, 5 )
+
+
+    def test_attach_leader_pulses(self):
+        class Leader (TNode):
+            leader = True
+            def pulse(self):
+                self.pulsed = True
+        n = Leader()
+        aio.UDPMessenger('D', dict(D=('127.0.0.1', 0)), loop=self.loop).attach(n)
+        self.assertTrue( n.pulsed )
+
+
+    def test_schedule_after_close(self):
+        called = list()
+        self.ms['A'].close()
+        self.ms['A'].schedule( 0, lambda: called.append(True) )
+        self.loop.run_until_complete( asyncio.sleep(0.01) )
+        self.assertEqual( called, [] )
+
+
+
+class ResolutionRecorder (functional.HeartbeatMessenger):
+
+    def __init__(self):
+        self.resolution = None
+        self.leader_uid = None
+
+    def on_resolution(self, proposal_id, value):
+        self.resolution = value
+
+    def on_leadership_change(self, prev_leader_uid, new_leader_uid):
+        self.leader_uid = new_leader_uid
+
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class UDPHeartbeatClusterTester (LoopTests, unittest.TestCase):
+    '''
+    Runs a cluster of real HeartbeatNodes over loopback UDP
+    '''
+
+    def setUp(self):
+        self.loop  = asyncio.new_event_loop()
+        self.peers = dict( A=('127.0.0.1', 0), B=('127.0.0.1', 0), C=('127.0.0.1', 0) )
+        self.ms    = dict()
+        self.apps  = dict()
+        self.nodes = dict()
+
+        for uid in sorted(self.peers.keys()):
+            app = ResolutionRecorder()
+            m   = aio.UDPMessenger(uid, self.peers, messenger=app, loop=self.loop)
+            n   = functional.HeartbeatNode(m, uid, 2, hb_period=0.01, liveness_window=0.05)
+            n.set_proposal( ('value-' + uid).encode() )
+            self.loop.run_until_complete( m.listen() )
+            self.ms[ uid ]    = m
+            self.apps[ uid ]  = app
+            self.nodes[ uid ] = n
+
+        for uid in sorted(self.peers.keys()):
+            self.ms[ uid ].attach( self.nodes[uid] )
+
+
+    def leaders(self, uids):
+        return set( self.apps[uid].leader_uid for uid in uids )
+
+
+    def test_election_and_resolution(self):
+        uids = sorted(self.nodes.keys())
+        self.run_until( lambda: all( a.resolution is not None for a in self.apps.values() ) )
+        self.run_until( lambda: len(self.leaders(uids)) == 1 and None not in self.leaders(uids) )
+
+        leader = self.leaders(uids).pop()
+        values = set( a.resolution for a in self.apps.values() )
+
+        self.assertEqual( values, set([ ('value-' + leader).encode() ]) )
+        self.assertTrue( self.nodes[leader].leader )
+
+
+    def test_leader_failover(self):
+        uids = sorted(self.nodes.keys())
+        self.run_until( lambda: len(self.leaders(uids)) == 1 and None not in self.leaders(uids) )
+
+        old       = self.leaders(uids).pop()
+        survivors = [ uid for uid in uids if uid != old ]
+
+        self.ms[ old ].close()
+
+        self.run_until( lambda: self.leaders(survivors) not in (set([old]), set([None])) and
+                                len(self.leaders(survivors)) == 1 )
+
+        new = self.leaders(survivors).pop()
+
+        self.assertTrue( new in survivors )
+        self.assertTrue( self.nodes[new].leader )
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class TCPMessengerTester (TransportTests, unittest.TestCase):
+
+    def setUp(self):
+        self.messenger_class = aio.TCPMessenger
+        self.loop            = asyncio.new_event_loop()
+        self.peers           = dict( A=('127.0.0.1', 0), B=('127.0.0.1', 0), C=('127.0.0.1', 0) )
+        self.ms              = dict()
+        self.nodes           = dict()
+
+        for uid in sorted(self.peers.keys()):
+            self.ms[ uid ] = aio.TCPMessenger(uid, self.peers, loop=self.loop,
+                                              reconnect_delay=0.01)
+            self.loop.run_until_complete( self.ms[uid].listen() )
+
+        for uid in sorted(self.peers.keys()):
+            self.nodes[ uid ] = TNode()
+            self.ms[ uid ].attach( self.nodes[uid] )
+
+
+    def connected(self):
+        return all( c.writable for m in self.ms.values() for c in m.connections.values() )
+
+
+    def test_bound_addresses(self):
+        super(TCPMessengerTester, self).test_bound_addresses()
+        self.run_until( self.connected )
+
+
+    def test_local_delivery(self):
+        self.ms['A'].send_promise( 'A', PID(1,'A'), None, None )
+        self.assertEqual( self.nodes['A'].received, [] )
+        self.run_until( lambda: self.nodes['A'].received )
+
+
+    def test_large_values(self):
+        value = b'v' * (4 * 1024 * 1024)
+        self.ms['A'].send_accept( PID(1,'A'), value )
+        self.ms['A'].send_accept( PID(2,'A'), b'small' )
+        self.run_until( lambda: len(self.nodes['C'].received) == 2 )
+        self.assertEqual( self.nodes['C'].received, [('accept', 'A', PID(1,'A'), value),
+                                                     ('accept', 'A', PID(2,'A'), b'small')] )
+        for p in self.ms['C'].inbound:
+            self.assertEqual( len(p.buffer), 0 )
+
+
+    def test_fragmented_frames(self):
+        p    = aio.FrameProtocol(self.ms['B'])
+        data = self.ms['A'].codec.encode('A', 'heartbeat', (PID(1,'A'),))
+        data = (aio._frame_header.pack(len(data)) + data) * 2
+
+        for i in range(len(data)):
+            p.data_received( data[i:i+1] )
+
+        self.assertEqual( self.nodes['B'].received, [('heartbeat', 'A', PID(1,'A'))] * 2 )
+        self.assertEqual( len(p.buffer), 0 )
+
+
+    def test_reconnect(self):
+        self.run_until( self.connected )
+
+        b     = self.ms['B']
+        addr  = self.peers['B']
+        b.close()
+        self.run_until( lambda: not self.ms['A'].connections['B'].writable )
+
+        self.ms['A'].send_heartbeat( PID(3,'A') )
+        self.assertTrue( self.ms['A'].connections['B'].pending )
+
+        node           = TNode()
+        self.ms['B']   = aio.TCPMessenger('B', self.peers, loop=self.loop)
+        self.loop.run_until_complete( self.ms['B'].listen() )
+        self.ms['B'].attach( node )
+        self.assertEqual( self.peers['B'], addr )
+
+        self.run_until( lambda: node.received )
+        self.assertEqual( node.received, [('heartbeat', 'A', PID(3,'A'))] )
+
+
+    def test_pending_bounded(self):
+        self.ms['C'].close()
+        c = self.ms['A'].connections['C']
+        self.run_until( lambda: not c.writable )
+        self.ms['A'].max_pending = 100
+        for i in range(10):
+            self.ms['A'].send_accept( PID(i,'A'), b'x' * 40 )
+        self.assertTrue( c.pending_bytes < 200 )
+
+
+    def test_throttle(self):
+        a = self.ms['A']
+        self.run_until( self.connected )
+        self.assertFalse( a.throttled )
+
+        a.connections['B'].pause_writing()
+        self.assertFalse( a.throttled )
+        a.connections['C'].pause_writing()
+        self.assertTrue( a.throttled )
+
+        f = a.wait_writable()
+        a.send_accept( PID(1,'A'), b'foo' )
+        a.send_heartbeat( PID(1,'A') )
+        self.assertEqual( a.deferred, [ a.codec.encode('A', 'accept', (PID(1,'A'), b'foo')) ] )
+
+        self.loop.run_until_complete( asyncio.sleep(0.05) )
+        self.assertFalse( f.done() )
+        self.assertEqual( self.nodes['B'].received, [('heartbeat', 'A', PID(1,'A'))] )
+
+        a.connections['C'].resume_writing()
+        self.assertTrue( f.done() )
+        self.assertEqual( a.deferred, [] )
+        self.assertEqual( a.deferred_bytes, 0 )
+        self.run_until( lambda: len(self.nodes['B'].received) == 2 )
+        self.assertEqual( self.nodes['B'].received[1], ('accept', 'A', PID(1,'A'), b'foo') )
+        self.assertTrue( a.wait_writable().done() )
+
+
+    def test_deferred_bounded(self):
+        a = self.ms['A']
+        self.run_until( self.connected )
+        a.connections['B'].pause_writing()
+        a.connections['C'].pause_writing()
+
+        size          = len( a.codec.encode('A', 'accept', (PID(0,'A'), b'x' * 40)) )
+        a.max_pending = size * 2
+        for i in range(10):
+            a.send_accept( PID(i,'A'), b'x' * 40 )
+
+        self.assertEqual( len(a.deferred), 2 )
+        self.assertEqual( a.deferred_bytes, size * 2 )
+        self.assertEqual( a.dropped, 8 )
+
+        a.connections['C'].resume_writing()
+        self.run_until( lambda: len(self.nodes['C'].received) == 2 )
+        self.assertEqual( [ r[2] for r in self.nodes['C'].received ], [PID(0,'A'), PID(1,'A')] )
+
+
+    def test_oversized_frame(self):
+        self.run_until( self.connected )
+        self.ms['C'].max_frame_size = 1024
+
+        self.ms['A'].send_accept( PID(1,'A'), b'x' * 2048 )
+        self.run_until( lambda: any( p.oversized for p in self.ms['C'].inbound ) or
+                                not self.ms['A'].connections['C'].writable )
+        self.assertEqual( self.nodes['C'].received, [] )
+
+        # The connection is re-established and smaller frames are delivered
+        self.run_until( lambda: self.ms['A'].connections['C'].writable )
+        self.ms['A'].send_heartbeat( PID(2,'A') )
+        self.run_until( lambda: self.nodes['C'].received )
+        self.assertEqual( self.nodes['C'].received, [('heartbeat', 'A', PID(2,'A'))] )
+
+
+    def test_oversized_frame_not_buffered(self):
+        class Transport (object):
+            closed = False
+            def close(self):
+                self.closed = True
+        p = aio.FrameProtocol(self.ms['B'])
+        t = Transport()
+        p.connection_made( t )
+        self.ms['B'].max_frame_size = 1024
+        p.data_received( aio._frame_header.pack(1 << 30) + b'x' * 100 )
+        self.assertTrue( t.closed )
+        self.assertEqual( p.oversized, 1 )
+        self.assertEqual( len(p.buffer), 0 )
+        p.connection_lost( None )
+
+
+    def test_watermarks(self):
+        self.run_until( self.connected )
+        t = self.ms['A'].connections['B'].transport
+        self.assertEqual( t.get_write_buffer_limits(), (self.ms['A'].low_water, self.ms['A'].high_water) )
+
+
+class ResolvedLog (multi.MultiPaxosMessenger):
+
+    def __init__(self):
+        self.slots = dict() # maps slot => resolved value
+
+    def on_resolution(self, slot, proposal_id, value):
+        self.slots[ slot ] = value
+
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class AsyncTCPClusterTester (LoopTests, unittest.TestCase):
+    '''
+    Proposes batches through AsyncNodes wrapping MultiPaxosNodes whose
+    messages are sent with TCPMessengers
+    '''
+
+    def setUp(self):
+        self.loop   = asyncio.new_event_loop()
+        self.peers  = dict( A=('127.0.0.1', 0), B=('127.0.0.1', 0), C=('127.0.0.1', 0) )
+        self.ms     = dict()
+        self.logs   = dict()
+        self.asyncs = dict()
+        self.nodes  = dict()
+
+        for uid in sorted(self.peers.keys()):
+            self.logs[ uid ]   = ResolvedLog()
+            self.asyncs[ uid ] = aio.AsyncNode(self.logs[uid], loop=self.loop)
+            self.ms[ uid ]     = aio.TCPMessenger(uid, self.peers, messenger=self.asyncs[uid],
+                                                  loop=self.loop, reconnect_delay=0.01)
+            self.loop.run_until_complete( self.ms[uid].listen() )
+
+        for uid in sorted(self.peers.keys()):
+            self.nodes[ uid ] = multi.MultiPaxosNode(self.ms[uid], uid, 2, pipeline_window=2)
+            self.ms[ uid ].attach( self.nodes[uid] )
+            self.asyncs[ uid ].attach( self.nodes[uid] )
+
+
+    def propose_all(self, a, values):
+        return self.loop.run_until_complete( asyncio.wait_for(
+            asyncio.gather( *[ a.propose(v) for v in values ] ), 5.0 ) )
+
+
+    def test_multi_codec_selected(self):
+        for m in self.ms.values():
+            self.assertTrue( isinstance(m.codec, wire.MultiCodec) )
+
+        m = aio.TCPMessenger('D', dict(D=('127.0.0.1', 0)), codec=wire.Codec(), loop=self.loop)
+        m.attach( multi.MultiPaxosNode(m, 'D', 1) )
+        m.close()
+        self.assertFalse( isinstance(m.codec, wire.MultiCodec) )
+
+
+    def test_propose_batches(self):
+        a      = self.asyncs['A']
+        values = [ ('value-%d' % i).encode() for i in range(50) ]
+
+        self.nodes['A'].prepare()
+        self.run_until( lambda: self.nodes['A'].leader )
+
+        results = self.propose_all( a, values )
+
+        self.assertEqual( [ r[1] for r in results ], values )
+
+        self.run_until( lambda: all( len(l.slots) == len(self.logs['A'].slots)
+                                     for l in self.logs.values() ) )
+
+        slots = self.logs['A'].slots
+
+        for l in self.logs.values():
+            self.assertEqual( l.slots, slots )
+
+        batches = [ slots[s] for s in sorted(slots.keys()) ]
+
+        self.assertTrue( all( isinstance(b, batching.Batch) for b in batches ) )
+        self.assertTrue( len(batches) < len(values) )
+        self.assertEqual( [ c for b in batches for c in b.commands ], values )
+
+
+class LogMessenger (object):
+    '''
+    Records the Accept! messages of a MultiPaxosNode leader
+    '''
+
+    def __init__(self):
+        self.accepts  = list()
+        self.resolved = list()
+
+    def send_accept(self, slot, proposal_id, value):
+        self.accepts.append( (slot, value) )
+
+    def on_resolution(self, *args):
+        self.resolved.append( args )
+
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class AsyncNodeTester (unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.m    = LogMessenger()
+        self.a    = aio.AsyncNode(self.m, loop=self.loop, batcher_uid='A')
+
+
+    def tearDown(self):
+        self.loop.close()
+
+
+    def step(self):
+        self.loop.run_until_complete( asyncio.sleep(0) )
+
+
+    def leader(self, pipeline_window=1):
+        n             = multi.MultiPaxosNode(self.a, 'A', 2, pipeline_window)
+        n.leader      = True
+        n.proposal_id = PID(1,'A')
+        self.a.attach(n)
+        return n
+
+
+    def test_multi_batching(self):
+        n  = self.leader()
+        fs = [ self.a.propose(v) for v in ('a', 'b', 'c') ]
+        self.assertEqual( self.m.accepts, [] )
+        self.step()
+        self.assertEqual( self.m.accepts, [ (0, batching.Batch('A', 1, ('a', 'b', 'c'))) ] )
+
+        n.slot_resolved( 0, PID(1,'A'), self.m.accepts[0][1] )
+        self.assertEqual( [ f.result() for f in fs ],
+                          [ (PID(1,'A'), 'a'), (PID(1,'A'), 'b'), (PID(1,'A'), 'c') ] )
+        self.assertEqual( self.m.resolved, [ (0, PID(1,'A'), self.m.accepts[0][1]) ] )
+
+
+    def test_multi_pipeline_full(self):
+        n  = self.leader()
+        f1 = self.a.propose('a')
+        self.step()
+        fs = [ self.a.propose(v) for v in ('b', 'c', 'd') ]
+        self.step()
+        self.assertEqual( len(self.m.accepts), 1 )
+        self.assertEqual( self.a.batcher.commands, ['b', 'c', 'd'] )
+
+        n.slot_resolved( 0, PID(1,'A'), self.m.accepts[0][1] )
+        self.assertEqual( f1.result(), (PID(1,'A'), 'a') )
+        self.step()
+        self.assertEqual( self.m.accepts[1], (1, batching.Batch('A', 2, ('b', 'c', 'd'))) )
+
+
+    def test_multi_pipeline_window(self):
+        n = self.leader(pipeline_window=2)
+        self.a.propose('a')
+        self.step()
+        self.a.propose('b')
+        self.step()
+        self.a.propose('c')
+        self.step()
+        self.assertEqual( [ slot for slot, v in self.m.accepts ], [0, 1] )
+
+
+    def test_multi_max_batch_size(self):
+        self.a.max_batch_size = 2
+        self.leader(pipeline_window=4)
+        for v in ('a', 'b', 'c'):
+            self.a.propose(v)
+        self.assertEqual( self.m.accepts, [ (0, batching.Batch('A', 1, ('a', 'b'))) ] )
+        self.step()
+        self.assertEqual( self.m.accepts[1], (1, batching.Batch('A', 2, ('c',))) )
+
+
+    def test_multi_lost_slot(self):
+        n = self.leader()
+        f = self.a.propose('a')
+        self.step()
+        n.slot_resolved( 0, PID(1,'B'), 'other' )
+        self.assertFalse( f.done() )
+        self.assertEqual( self.m.accepts[1], (1, batching.Batch('A', 1, ('a',))) )
+        n.slot_resolved( 1, PID(1,'A'), self.m.accepts[1][1] )
+        self.assertEqual( f.result(), (PID(1,'A'), 'a') )
+
+
+    def test_cancelled_awaiter(self):
+        n = self.leader()
+        f = self.a.propose('a')
+        self.step()
+        f.cancel()
+        n.slot_resolved( 0, PID(1,'A'), self.m.accepts[0][1] )
+        self.assertTrue( f.cancelled() )
+
+
+    def test_default_batcher_uid(self):
+        a = aio.AsyncNode(self.m, loop=self.loop)
+        b = aio.AsyncNode(self.m, loop=self.loop)
+        a.attach( multi.MultiPaxosNode(a, 'A', 2) )
+        b.attach( multi.MultiPaxosNode(b, 'A', 2) )
+        self.assertTrue( a.batcher_uid.startswith('A-') )
+        self.assertNotEqual( a.batcher_uid, b.batcher_uid )
+
+
+    def test_single_instance(self):
+        n  = practical.Node(self.a, 'A', 2)
+        self.a.attach(n)
+        f1 = self.a.propose('a')
+        f2 = self.a.propose('b')
+        self.assertEqual( n.proposed_value, 'a' )
+        self.a.on_resolution( PID(1,'B'), 'c' )
+        self.assertEqual( f1.result(), (PID(1,'B'), 'c') )
+        self.assertEqual( f2.result(), (PID(1,'B'), 'c') )
+        self.assertEqual( self.a.propose('d').result(), (PID(1,'B'), 'c') )
+        self.assertEqual( self.m.resolved, [ (PID(1,'B'), 'c') ] )
+
+
+    def test_await(self):
+        n = self.leader()
+
+        def resolve():
+            slot, value = self.m.accepts[0]
+            n.slot_resolved( slot, PID(1,'A'), value )
+
+        f = self.a.propose('a')
+        self.loop.call_later( 0.001, resolve )
+        self.assertEqual( self.loop.run_until_complete(f), (PID(1,'A'), 'a') )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+
+import sys
+import os.path
+
+import unittest
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append( os.path.dirname(this_dir) )
+
+from paxos import batching, practical
+
+from test_essential import PID
+
+
+
+class TBatcher (batching.ProposalBatcher):
+
+    def timestamp(self):
+        return self.proposer.t
+
+
+
+class ProposalBatcherTester (unittest.TestCase):
+
+    def setUp(self):
+        self.t         = 0
+        self.proposals = list()
+        self.completed = list()
+        self.b         = TBatcher(self, 'A', max_batch_size=3, max_delay=2)
+
+
+    def set_proposal(self, value):
+        self.proposals.append(value)
+
+
+    def done(self, proposal_id, command):
+        self.completed.append( (proposal_id, command) )
+
+
+    def test_flush_on_size(self):
+        self.b.propose('a', self.done)
+        self.b.propose('b', self.done)
+        self.assertEqual( self.proposals, [] )
+        self.b.propose('c', self.done)
+        self.assertEqual( self.proposals, [batching.Batch('A', 1, ('a', 'b', 'c'))] )
+        self.assertEqual( self.b.commands, [] )
+
+
+    def test_flush_on_delay(self):
+        self.b.propose('a')
+        self.t = 1
+        self.b.poll()
+        self.assertEqual( self.proposals, [] )
+        self.b.propose('b')
+        self.t = 2
+        self.b.poll()
+        self.assertEqual( self.proposals, [batching.Batch('A', 1, ('a', 'b'))] )
+
+
+    def test_poll_empty(self):
+        self.t = 10
+        self.b.poll()
+        self.b.flush()
+        self.assertEqual( self.proposals, [] )
+
+
+    def test_callbacks_on_resolution(self):
+        self.b.propose('a', self.done)
+        self.b.propose('b')
+        self.b.flush()
+        self.b.propose('c', self.done)
+        self.b.flush()
+        self.b.on_resolution( PID(1,'A'), self.proposals[1] )
+        self.assertEqual( self.completed, [(PID(1,'A'), 'c')] )
+        self.b.on_resolution( PID(1,'A'), self.proposals[0] )
+        self.assertEqual( self.completed, [(PID(1,'A'), 'c'), (PID(1,'A'), 'a')] )
+        self.assertEqual( self.b.outstanding, dict() )
+
+
+    def test_ignore_foreign_resolutions(self):
+        self.b.propose('a', self.done)
+        self.b.flush()
+        self.b.on_resolution( PID(1,'B'), 'foo' )
+        self.b.on_resolution( PID(1,'B'), batching.Batch('B', 1, ('x',)) )
+        self.assertEqual( self.completed, [] )
+
+
+    def test_ignore_duplicate_resolution(self):
+        self.b.propose('a', self.done)
+        self.b.flush()
+        self.b.on_resolution( PID(1,'A'), self.proposals[0] )
+        self.b.on_resolution( PID(1,'A'), self.proposals[0] )
+        self.assertEqual( self.completed, [(PID(1,'A'), 'a')] )
+
+
+
+class AdaptiveBatchControllerTester (unittest.TestCase):
+
+    def setUp(self):
+        self.t         = 0
+        self.proposals = list()
+        self.c         = batching.AdaptiveBatchController(target_latency=1.0)
+        self.c.delay_range = (0.0, 1.0)
+        self.c.delay_step  = 0.25
+        self.b         = TBatcher(self, 'A', max_batch_size=4, max_delay=0.5,
+                                  controller=self.c)
+
+
+    def set_proposal(self, value):
+        self.proposals.append(value)
+
+
+    def commit(self, ncommands, latency, flush=True):
+        for i in range(ncommands):
+            self.b.propose(i)
+        if flush:
+            self.b.flush()
+        self.t += latency
+        self.b.on_resolution( PID(1,'A'), self.proposals[-1] )
+
+
+    def test_full_batches_grow_size(self):
+        self.commit(4, 0.1, False)
+        self.assertEqual( self.b.max_batch_size, 8 )
+        self.commit(8, 0.1, False)
+        self.assertEqual( self.b.max_batch_size, 16 )
+        self.assertEqual( self.c.latency, 0.1 )
+
+
+    def test_size_bounded(self):
+        self.c.batch_size_range = (1, 6)
+        self.commit(4, 0.1, False)
+        self.assertEqual( self.b.max_batch_size, 6 )
+
+
+    def test_sparse_batches_shrink_size(self):
+        self.b.max_batch_size = 64
+        self.commit(1, 0.1)
+        self.assertEqual( self.b.max_batch_size, 32 )
+        for i in range(10):
+            self.commit(1, 0.1)
+        self.assertEqual( self.b.max_batch_size, 4 )
+
+
+    def test_single_command_batches_reduce_delay(self):
+        self.commit(1, 0.1)
+        self.assertEqual( self.b.max_delay, 0.25 )
+        self.commit(1, 0.1)
+        self.assertEqual( self.b.max_delay, 0.125 )
+
+
+    def test_productive_delay_grows_under_target(self):
+        self.commit(2, 0.1)
+        self.assertEqual( self.b.max_delay, 0.75 )
+        self.commit(2, 0.1)
+        self.assertEqual( self.b.max_delay, 1.0 )
+        self.commit(2, 0.1)
+        self.assertEqual( self.b.max_delay, 1.0 )
+
+
+    def test_delay_backs_off_over_target(self):
+        self.commit(2, 2.0)
+        self.assertEqual( self.b.max_delay, 0.25 )
+        self.commit(2, 0.1)
+        self.assertTrue( self.c.latency > 1.0 )
+        self.assertEqual( self.b.max_delay, 0.125 )
+
+
+
+class BatchingMessengerTester (unittest.TestCase):
+
+    def setUp(self):
+        self.frames    = list()
+        self.scheduled = list()
+        self.resolved  = None
+        self.m         = batching.BatchingMessenger(self)
+
+
+    def send_frame(self, to_uid, messages):
+        self.frames.append( (to_uid, messages) )
+
+
+    def on_resolution(self, proposal_id, value):
+        self.resolved = (proposal_id, value)
+
+
+    def test_coalesce_per_destination(self):
+        self.m.send_prepare( PID(1,'A') )
+        self.m.send_promise( 'B', PID(1,'B'), None, None )
+        self.m.send_accept( PID(1,'A'), 'foo' )
+        self.m.send_accept_nack( 'B', PID(1,'B'), PID(2,'C') )
+        self.m.send_prepare_nack( 'C', PID(1,'C'), PID(2,'C') )
+        self.assertEqual( self.frames, [] )
+        self.m.flush()
+        self.assertEqual( self.frames,
+                          [ (None, [('prepare', (PID(1,'A'),)),
+                                    ('accept',  (PID(1,'A'), 'foo'))]),
+                            ('B',  [('promise', (PID(1,'B'), None, None)),
+                                    ('accept_nack', (PID(1,'B'), PID(2,'C')))]),
+                            ('C',  [('prepare_nack', (PID(1,'C'), PID(2,'C')))]) ] )
+        self.m.flush()
+        self.assertEqual( len(self.frames), 3 )
+
+
+    def test_call_soon(self):
+        self.m = batching.BatchingMessenger(self, self.scheduled.append)
+        self.m.send_heartbeat( PID(1,'A') )
+        self.m.send_accepted( PID(1,'A'), 'foo' )
+        self.assertEqual( self.scheduled, [self.m.flush] )
+        self.scheduled[0]()
+        self.assertEqual( self.frames, [ (None, [('heartbeat', (PID(1,'A'),)),
+                                                 ('accepted',  (PID(1,'A'), 'foo'))]) ] )
+        self.m.send_leadership_proclamation( PID(1,'A') )
+        self.assertEqual( len(self.scheduled), 2 )
+
+
+    def test_delegation(self):
+        self.m.on_resolution( PID(1,'A'), 'foo' )
+        self.assertEqual( self.resolved, (PID(1,'A'), 'foo') )
+
+
+    def test_dispatch_frame(self):
+        a = practical.Node(self.m, 'A', 2)
+        b = practical.Node(self.m, 'B', 2)
+        a.prepare()
+        self.m.flush()
+        batching.dispatch_frame(b, 'A', self.frames[-1][1])
+        b.persisted()
+        self.m.flush()
+        self.assertEqual( self.frames[-1], ('A', [('promise', ((1,'A'), None, None))]) )
+        batching.dispatch_frame(a, 'B', self.frames[-1][1])
+        self.assertEqual( a.promises_rcvd, set(['B']) )
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,14 @@ import struct
 import tempfile
 import shutil
 import pickle
+import threading
+import mmap
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 #from twisted.trial import unittest
 import unittest
@@ -14,7 +22,9 @@ import unittest
 this_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append( os.path.dirname(this_dir) )
 
-from paxos import durable
+from paxos import durable, practical
+
+from test_essential import PID
 
 
 class DObj(object):
@@ -56,22 +66,113 @@ class DurableReadTester (unittest.TestCase):
         self.assertRaises(durable.FileTruncated, durable.read, self.newfd())
 
     def test_read_header_too_small(self):
-        self.assertRaises(durable.FileTruncated, durable.read, self.newfd('\0'*31))
+        self.assertRaises(durable.FileTruncated, durable.read, self.newfd(b'\0'*31))
 
     def test_read_no_pickle_data(self):
-        data = '\0'*24 + struct.pack('>Q', 5)
+        data = b'\0'*24 + struct.pack('>Q', 5)
         self.assertRaises(durable.FileTruncated, durable.read, self.newfd(data))
 
     def test_read_bad_hash_mismatch(self):
-        data = '\0'*24 + struct.pack('>Q', 5) + 'x'*5
+        data = b'\0'*24 + struct.pack('>Q', 5) + b'x'*5
         self.assertRaises(durable.HashMismatch, durable.read, self.newfd(data))
 
     def test_read_ok(self):
         pdata = 'x'*5
         p     = pickle.dumps(pdata, pickle.HIGHEST_PROTOCOL)
-        data  = '\0'*8 + struct.pack('>Q', len(p)) + p
+        data  = b'\0'*8 + struct.pack('>Q', len(p)) + p
         data  = hashlib.md5(data).digest() + data
         self.assertEqual( durable.read(self.newfd(data) ), (0, pdata) )
+
+    def test_read_unknown_checksum(self):
+        data = b'\0'*24 + struct.pack('>Q', (255 << 56) | 5) + b'x'*5
+        self.assertRaises(durable.UnknownFormat, durable.read, self.newfd(data))
+
+    def test_write_read_checksums(self):
+        for name in durable.CHECKSUMS.keys():
+            fd = self.newfd()
+            durable.write(fd, 7, 'foo', name)
+            self.assertEqual( durable.read(fd), (7, 'foo') )
+
+    def test_default_checksum_is_crc32(self):
+        data = durable.encode(1, 'foo')
+        self.assertEqual( bytearray(data)[24], durable.CHECKSUMS['crc32'][0] )
+        self.assertEqual( data[4:16], b'\0'*12 )
+
+    def test_read_unknown_serializer(self):
+        fd = self.newfd()
+        durable.write(fd, 1, b'foo')
+        os.lseek(fd, 25, os.SEEK_SET)
+        os.write(fd, b'\xff')
+        self.assertRaises(durable.FileCorrupted, durable.read, fd)
+
+    def test_compression(self):
+        for name in durable.COMPRESSORS.keys():
+            fd   = self.newfd()
+            data = b'abc' * 1000
+            durable.write(fd, 1, data, compression=name, compress_threshold=100)
+            self.assertEqual( bytearray(durable.encode(1, data, compression=name))[26],
+                              durable.COMPRESSORS[name][0] )
+            self.assertTrue( os.fstat(fd).st_size < 1000 )
+            self.assertEqual( durable.read(fd), (1, data) )
+
+    def test_compression_threshold(self):
+        self.assertEqual( bytearray(durable.encode(1, b'abc' * 100, compression='zlib',
+                                                   compress_threshold=1000))[26], 0 )
+        self.assertEqual( bytearray(durable.encode(1, b'abc' * 100, compression='zlib',
+                                                   compression_level=1))[26], 1 )
+
+    def test_incompressible(self):
+        data = os.urandom(2000)
+        self.assertEqual( bytearray(durable.encode(1, data, compression='zlib'))[26], 0 )
+
+    def test_read_unknown_compression(self):
+        fd = self.newfd()
+        durable.write(fd, 1, b'abc' * 1000, compression='zlib')
+        os.lseek(fd, 26, os.SEEK_SET)
+        os.write(fd, b'\xff')
+        self.assertRaises(durable.FileCorrupted, durable.read, fd)
+
+    def test_write_read_acceptor_state(self):
+        fd    = self.newfd()
+        state = (PID(5,'B'), PID(4,'A'), b'value')
+        durable.write(fd, 3, state, serializer='acceptor')
+        self.assertEqual( bytearray(durable.encode(3, state, serializer='acceptor'))[25], 1 )
+        self.assertEqual( durable.read(fd), (3, state) )
+
+
+
+class AcceptorStateSerializerTester (unittest.TestCase):
+
+    def setUp(self):
+        self.s = durable.AcceptorStateSerializer()
+
+    def roundtrip(self, state):
+        self.assertEqual( self.s.loads(self.s.dumps(state)), state )
+
+    def test_empty(self):
+        self.roundtrip( (None, None, None) )
+
+    def test_promised_only(self):
+        self.roundtrip( (PID(1,'A'), None, None) )
+
+    def test_uid_types(self):
+        self.roundtrip( (PID(1,u'n\u00f8de'), PID(2,7), b'') )
+        self.assertTrue( isinstance(self.s.loads(self.s.dumps((PID(1,7), None, None)))[0].uid, int) )
+
+    def test_proposal_id_type(self):
+        pid = self.s.loads(self.s.dumps((PID(1,'A'), None, None)))[0]
+        self.assertEqual( pid.number, 1 )
+        self.assertEqual( pid.uid, 'A' )
+
+    def test_unsupported_types(self):
+        self.assertRaises(TypeError, self.s.dumps, (PID(1,1.5), None, None))
+        self.assertRaises(TypeError, self.s.dumps, (PID(1,'A'), PID(1,'A'), 5))
+
+    def test_truncated(self):
+        data = self.s.dumps( (PID(1,'A'), PID(1,'A'), b'foo') )
+        for i in range(len(data)):
+            self.assertRaises(durable.FileCorrupted, self.s.loads, data[:i])
+        self.assertRaises(durable.FileCorrupted, self.s.loads, data + b'x')
         
         
 
@@ -103,6 +204,60 @@ class DurableObjectHandlerTester (unittest.TestCase):
 
     def test_bad_directory(self):
         self.assertRaises(Exception, durable.DurableObjectHandler, '/@#$!$^FOOBARBAZ', 'blah')
+
+
+    def test_acceptor_serializer(self):
+        self.doh.close()
+        d = durable.DurableObjectHandler(self.tdir, 'id1', serializer='acceptor')
+        self.dohs.append(d)
+        d.save( (PID(2,'B'), PID(1,'A'), b'foo') )
+        d.close()
+        d = self.newdoh('id1')
+        self.assertEquals(d.recovered, (PID(2,'B'), PID(1,'A'), b'foo'))
+
+
+    def test_compression(self):
+        self.doh.close()
+        d = durable.DurableObjectHandler(self.tdir, 'id1', compression='zlib')
+        self.dohs.append(d)
+        d.save( {'small' : 1} )
+        self.assertEqual( d.compress_threshold, 1024 )
+        self.assertTrue( os.stat(d.fn_a).st_size < 100 )
+        d.save( {'big' : 'x' * 100000} )
+        self.assertTrue( os.stat(d.fn_b).st_size < 1000 )
+        d.save_delta( {'more' : 'y' * 100000} )
+        self.assertTrue( os.stat(d.fn_b).st_size < 2000 )
+        d.close()
+        d = self.newdoh('id1')
+        self.assertEquals( d.recovered, {'big' : 'x' * 100000, 'more' : 'y' * 100000} )
+
+
+    def test_bad_compression(self):
+        self.assertRaises(ValueError, durable.DurableObjectHandler, self.tdir, 'blah',
+                          compression='foo')
+
+
+    def test_bad_serializer(self):
+        self.assertRaises(ValueError, durable.DurableObjectHandler, self.tdir, 'blah', None, 'foo')
+
+
+    def test_bad_checksum(self):
+        self.assertRaises(ValueError, durable.DurableObjectHandler, self.tdir, 'blah', 'foo')
+
+
+    def test_change_checksum(self):
+        self.doh.close()
+        d = durable.DurableObjectHandler(self.tdir, 'id1', 'md5')
+        self.dohs.append(d)
+        d.save(self.o)
+        d.close()
+        d = self.newdoh('id1')
+        self.assertEquals(d.recovered.state, 'initial')
+        self.o.state = 'second'
+        d.save(self.o)
+        d.close()
+        d = self.newdoh('id1')
+        self.assertEquals(d.recovered.state, 'second')
         
 
     def test_no_save(self):
@@ -148,7 +303,7 @@ class DurableObjectHandlerTester (unittest.TestCase):
         self.test_two_save()
 
         with open(self.doh.fn_b, 'wb') as f:
-            f.write('\0')
+            f.write(b'\0')
             f.flush()
             
         d = self.newdoh('id1')
@@ -160,7 +315,7 @@ class DurableObjectHandlerTester (unittest.TestCase):
         self.test_two_save()
 
         with open(self.doh.fn_a, 'wb') as f:
-            f.write('\0')
+            f.write(b'\0')
             f.flush()
             
         d = self.newdoh('id1')
@@ -168,18 +323,1163 @@ class DurableObjectHandlerTester (unittest.TestCase):
         self.assertEquals(d.recovered.state, 'second')
 
 
+    def test_newest_payload_corrupted(self):
+        self.test_two_save()
+
+        with open(self.doh.fn_b, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'\xff')
+
+        d = self.newdoh('id1')
+        self.assertEquals(d.recovered.state, 'initial')
+        self.assertEquals(d.serial, 2)
+
+
+    def test_only_newest_loaded(self):
+        self.test_three_save()
+
+        loaded = list()
+        orig   = durable._mapped_load
+
+        def counting_load(m, *args):
+            loaded.append( durable._mapped_serial(m) )
+            return orig(m, *args)
+
+        durable._mapped_load = counting_load
+        try:
+            d = self.newdoh('id1')
+        finally:
+            durable._mapped_load = orig
+
+        self.assertEquals(d.recovered.state, 'third')
+        self.assertEquals(loaded, [3])
+
+
+    def test_clean_shutdown(self):
+        self.doh.save(self.o)
+        self.doh.close()
+        self.assertTrue( os.path.exists(self.doh.fn_clean) )
+
+        digests = list()
+        orig    = durable._digest
+
+        def counting_digest(*args):
+            digests.append(args)
+            return orig(*args)
+
+        durable._digest = counting_digest
+        try:
+            d = self.newdoh('id1')
+        finally:
+            durable._digest = orig
+
+        self.assertTrue( d.clean_shutdown )
+        self.assertEquals( d.recovered.state, 'initial' )
+        self.assertEquals( len(digests), 1 ) # The marker's own checksum
+
+        self.o.state = 'second'
+        d.save(self.o)
+        self.assertTrue( not d.clean_shutdown )
+        self.assertTrue( not os.path.exists(d.fn_clean) )
+
+
+    def test_unclean_shutdown(self):
+        self.doh.save(self.o)
+        self.doh.close()
+        with open(self.doh.fn_clean, 'rb') as f:
+            marker = f.read()
+
+        d = self.newdoh('id1')
+        self.assertTrue( d.clean_shutdown )
+        d.save(self.o)
+
+        # Stale marker restored as though its removal was lost in a crash
+        with open(self.doh.fn_clean, 'wb') as f:
+            f.write(marker)
+
+        d = self.newdoh('id1')
+        self.assertTrue( not d.clean_shutdown )
+        self.assertEquals( d.serial, 3 )
+
+
+    def test_no_marker_without_save(self):
+        self.doh.close()
+        self.assertTrue( not os.path.exists(self.doh.fn_clean) )
+
+
+    def test_delta_requires_save(self):
+        self.assertRaises(durable.DurabilityFailure, self.doh.save_delta, {'x' : 1})
+
+
+    def test_delta_save(self):
+        self.doh.save( {'a' : 1, 'big' : 'x' * 10000} )
+        size = os.stat(self.doh.fn_a).st_size
+        self.doh.save_delta( {'a' : 2} )
+        self.doh.save_delta( {'b' : 3} )
+        self.assertTrue( os.stat(self.doh.fn_a).st_size - size < 200 )
+        self.assertEquals( os.stat(self.doh.fn_b).st_size, 0 )
+        self.doh.close()
+        d = self.newdoh('id1')
+        self.assertEquals( d.recovered, {'a' : 2, 'b' : 3, 'big' : 'x' * 10000} )
+        self.assertEquals( d.serial, 4 )
+        self.assertEquals( d.ndeltas, 2 )
+        d.save_delta( {'a' : 4} )
+        d.close()
+        self.assertEquals( self.newdoh('id1').recovered['a'], 4 )
+
+
+    def test_delta_tuple_and_object(self):
+        self.doh.save( (PID(1,'A'), None, None) )
+        self.doh.save_delta( {0 : PID(2,'B')} )
+        self.assertEquals( self.doh.current, (PID(2,'B'), None, None) )
+        self.assertTrue( isinstance(self.doh.current[0], type(PID(2,'B'))) )
+        self.assertEquals( durable.apply_delta([1, 2], {1 : 3}), [1, 3] )
+        self.assertEquals( durable.apply_delta(self.o, {'state' : 'x'}).state, 'x' )
+        self.assertEquals( self.o.state, 'initial' )
+
+
+    def test_delta_serializer(self):
+        durable.register_serializer('test', 200, durable.PickleSerializer())
+        try:
+            self.doh.close()
+            d = durable.DurableObjectHandler(self.tdir, 'id1', serializer='test')
+            self.dohs.append(d)
+            d.save( {'a' : 1} )
+            size = os.stat(d.fn_a).st_size
+            d.save_delta( {'a' : 2} )
+            with open(d.fn_a, 'rb') as f:
+                self.assertEquals( bytearray(f.read())[size + 25], 200 )
+            d.close()
+            self.assertEquals( self.newdoh('id1').recovered, {'a' : 2} )
+        finally:
+            del durable.SERIALIZERS['test']
+            del durable._serializers[200]
+
+
+    def test_delta_unsupported_serializer(self):
+        self.doh.close()
+        d = durable.DurableObjectHandler(self.tdir, 'id1', serializer='acceptor')
+        self.dohs.append(d)
+        d.save( (PID(1,'A'), None, None) )
+        self.assertRaises( durable.DurabilityFailure, d.save_delta, {0 : PID(2,'A')} )
+        self.assertEquals( os.stat(d.fn_b).st_size, 0 )
+
+
+    def test_delta_fold(self):
+        self.doh.close()
+        d = durable.DurableObjectHandler(self.tdir, 'id1', max_deltas=2)
+        self.dohs.append(d)
+        d.save( {'a' : 0} )
+        for i in range(1, 6):
+            d.save_delta( {'a' : i} )
+        # image 1, deltas 2-3, image 4 (folded), deltas 5-6
+        self.assertEquals( d.ndeltas, 2 )
+        self.assertEquals( d.serial, 7 )
+        d.close()
+        d = self.newdoh('id1')
+        self.assertEquals( d.recovered, {'a' : 5} )
+        self.assertEquals( d.serial, 7 )
+        d.save( {'a' : 6} ) # Overwrites image 1 and its stale deltas
+        d.close()
+        d = self.newdoh('id1')
+        self.assertEquals( d.recovered, {'a' : 6} )
+        self.assertEquals( d.ndeltas, 0 )
+
+
+    def test_delta_torn(self):
+        self.doh.save( {'a' : 0} )
+        self.doh.save_delta( {'a' : 1} )
+        self.doh.save_delta( {'a' : 2} )
+        self.doh.close()
+
+        with open(self.doh.fn_a, 'r+b') as f:
+            f.truncate( os.stat(self.doh.fn_a).st_size - 3 )
+
+        d = self.newdoh('id1')
+        self.assertEquals( d.recovered, {'a' : 1} )
+        d.save_delta( {'a' : 3} )
+        d.close()
+        self.assertEquals( self.newdoh('id1').recovered, {'a' : 3} )
+
+
     def test_unrecoverable_corruption(self):
         self.test_two_save()
 
         with open(self.doh.fn_a, 'wb') as f:
-            f.write('\0')
+            f.write(b'\0')
             f.flush()
 
         with open(self.doh.fn_b, 'wb') as f:
-            f.write('\0')
+            f.write(b'\0')
             f.flush()
 
         def diehorribly():
             self.newdoh('id1')
 
         self.assertRaises(durable.UnrecoverableFailure, diehorribly)
+
+
+
+
+class TempDirTester (unittest.TestCase):
+    '''
+    Base class for tests requiring a temporary directory, which is created
+    on tmpfs where available. Handlers, logs and stores appended to
+    'opened' are closed before the directory is removed.
+    '''
+
+    def setUp(self):
+        tmpfs_dir   = '/dev/shm' if os.path.exists('/dev/shm') else None
+        self.tdir   = tempfile.mkdtemp(dir=tmpfs_dir)
+        self.opened = list()
+
+
+    def tearDown(self):
+        for obj in self.opened:
+            obj.close()
+        shutil.rmtree(self.tdir)
+
+
+
+class SyncStrategyTester (TempDirTester):
+
+    def newdoh(self, sync=None):
+        doh = durable.DurableObjectHandler(self.tdir, 'id1', sync=sync)
+        self.opened.append(doh)
+        return doh
+
+
+    def save_and_recover(self, sync):
+        d = self.newdoh(sync)
+        d.save('foo')
+        d.save('bar')
+        d.close()
+        self.assertEquals( self.newdoh(sync).recovered, 'bar' )
+
+
+    def test_bad_strategy(self):
+        self.assertRaises(ValueError, self.newdoh, 'foo')
+
+
+    def test_named_strategies(self):
+        for name in durable.SYNC_STRATEGIES.keys():
+            self.save_and_recover( name )
+            self.assertTrue( isinstance(self.opened[-1].sync_strategy,
+                                        durable.SYNC_STRATEGIES[name]) )
+
+
+    def test_dsync(self):
+        self.save_and_recover( durable.DSyncStrategy() )
+
+
+    def test_preallocated(self):
+        d = self.newdoh( durable.PreallocatedSyncStrategy(1000) )
+        self.assertEquals( os.stat(d.fn_a).st_size, 1000 )
+        self.assertEquals( os.stat(d.fn_b).st_size, 1000 )
+        self.assertEquals( d.recovered, None )
+        d.close()
+        d = self.newdoh( durable.PreallocatedSyncStrategy(1000) )
+        self.assertEquals( d.recovered, None )
+        self.assertEquals( d.serial, 1 )
+        d.save('x' * 2000)
+        d.save('foo')
+        d.close()
+        self.assertTrue( os.stat(d.fn_a).st_size > 2000 )
+        self.assertEquals( os.stat(d.fn_b).st_size, 1000 )
+        self.assertEquals( self.newdoh('preallocate').recovered, 'foo' )
+
+
+    def test_periodic(self):
+        synced = list()
+        p      = durable.PeriodicSyncStrategy(10)
+
+        p.t         = 0
+        p.last_sync = 0
+        p.timestamp = lambda : p.t
+        
+        orig_fsync = durable._fsync
+        durable._fsync = synced.append
+        try:
+            d = self.newdoh( p )
+            d.save('foo')
+            d.save('bar')
+            self.assertEquals( synced, [] )
+            self.assertEquals( p.dirty, set([d.fd_a, d.fd_b]) )
+            p.t = 10
+            d.save('baz')
+            self.assertEquals( sorted(synced), sorted([d.fd_a, d.fd_b]) )
+            self.assertEquals( p.dirty, set() )
+            d.save('foo')
+            p.flush()
+            self.assertEquals( len(synced), 3 )
+            d.save('bar')
+            fd = d.fd_a
+            d.close()
+            self.assertEquals( synced[-1], fd )
+        finally:
+            durable._fsync = orig_fsync
+
+        self.assertEquals( self.newdoh().recovered, 'bar' )
+
+
+    def test_periodic_schedule(self):
+        synced = list()
+        timers = list()
+        p      = durable.PeriodicSyncStrategy(10, lambda delay, f: timers.append( (delay, f) ))
+
+        p.t         = 4
+        p.last_sync = 0
+        p.timestamp = lambda : p.t
+
+        orig_fsync = durable._fsync
+        durable._fsync = synced.append
+        try:
+            d = self.newdoh( p )
+            d.save('foo')
+            d.save('bar')
+            self.assertEquals( [ delay for delay, f in timers ], [6] )
+            self.assertEquals( synced, [] )
+            p.t = 10
+            timers[0][1]()
+            self.assertEquals( sorted(synced), sorted([d.fd_a, d.fd_b]) )
+            self.assertEquals( p.dirty, set() )
+            d.save('baz')
+            self.assertEquals( [ delay for delay, f in timers ], [6, 10] )
+        finally:
+            durable._fsync = orig_fsync
+
+
+
+class MemoryObjectHandlerTester (unittest.TestCase):
+
+    def tearDown(self):
+        durable.MemoryObjectHandler.store.clear()
+
+
+    def test_save_and_recover(self):
+        m = durable.MemoryObjectHandler('dir', 'id1')
+        self.assertEquals( m.recovered, None )
+        self.assertEquals( m.serial, 1 )
+        m.save('foo')
+        m.save('bar')
+        m = durable.MemoryObjectHandler('dir', 'id1')
+        self.assertEquals( m.recovered, 'bar' )
+        self.assertEquals( m.serial, 3 )
+        self.assertEquals( durable.MemoryObjectHandler('dir', 'id2').recovered, None )
+
+
+    def test_delta_save(self):
+        m = durable.MemoryObjectHandler('dir', 'id1')
+        self.assertRaises(durable.DurabilityFailure, m.save_delta, {'a' : 1})
+        m.save( {'a' : 1} )
+        m.save_delta( {'b' : 2} )
+        self.assertEquals( durable.MemoryObjectHandler('dir', 'id1').recovered, {'a' : 1, 'b' : 2} )
+        m = durable.MemoryObjectHandler('dir', 'id2', serializer='acceptor')
+        m.save( (PID(1,'A'), None, None) )
+        self.assertRaises( durable.DurabilityFailure, m.save_delta, {0 : PID(2,'A')} )
+
+
+    def test_serializer(self):
+        m = durable.MemoryObjectHandler('dir', 'id1', serializer='acceptor')
+        m.save( (PID(1,'A'), None, None) )
+        self.assertEquals( durable.MemoryObjectHandler('dir', 'id1').recovered,
+                           (PID(1,'A'), None, None) )
+
+
+
+class CountingHandler (durable.DurableObjectHandler):
+    nsaves = 0
+
+    def save(self, obj):
+        self.nsaves += 1
+        super(CountingHandler, self).save(obj)
+
+
+
+class AcceptorMessenger (practical.Messenger):
+    '''
+    Mixin for tests of Acceptor persistence. Records the messages sent by
+    the Acceptors returned by acceptor() in 'msgs'.
+    '''
+
+    def send_promise(self, to_uid, proposal_id, previous_id, accepted_value):
+        self.msgs.append( ('promise', to_uid, proposal_id) )
+
+
+    def send_accepted(self, proposal_id, accepted_value):
+        self.msgs.append( ('accepted', proposal_id, accepted_value) )
+
+
+    def acceptor(self):
+        a = practical.Acceptor()
+        a.messenger = self
+        return a
+
+
+
+class GroupCommitterTester (AcceptorMessenger, TempDirTester):
+
+    def setUp(self):
+        super(GroupCommitterTester, self).setUp()
+        self.doh  = CountingHandler(self.tdir, 'group')
+        self.gc   = durable.GroupCommitter(self.doh)
+        self.msgs = list()
+
+
+    def tearDown(self):
+        self.doh.close()
+        super(GroupCommitterTester, self).tearDown()
+
+
+    def test_commit_nothing(self):
+        self.gc.commit()
+        self.assertEquals( self.doh.nsaves, 0 )
+
+
+    def test_single_save_for_many_acceptors(self):
+        acceptors = [ self.acceptor() for i in range(10) ]
+
+        for i, a in enumerate(acceptors):
+            a.recv_prepare('A', PID(i,'A'))
+            self.gc.add( ('group', i), a )
+
+        self.assertEquals( self.msgs, [] )
+
+        self.gc.commit()
+
+        self.assertEquals( self.doh.nsaves, 1 )
+        self.assertEquals( len(self.msgs), 10 )
+        self.assertTrue( not any(a.persistance_required for a in acceptors) )
+
+        a = acceptors[3]
+        a.recv_accept_request('A', PID(3,'A'), 'foo')
+        self.gc.add( ('group', 3), a )
+        self.gc.commit()
+
+        self.assertEquals( self.doh.nsaves, 2 )
+        self.assertEquals( self.msgs[-1], ('accepted', PID(3,'A'), 'foo') )
+
+        self.doh.close()
+        self.doh = CountingHandler(self.tdir, 'group')
+        gc = durable.GroupCommitter(self.doh)
+
+        self.assertEquals( gc.recovered( ('group', 3) ), (PID(3,'A'), PID(3,'A'), 'foo') )
+        self.assertEquals( gc.recovered( ('group', 4) ), (PID(4,'A'), None, None) )
+        self.assertEquals( gc.recovered( ('group', 99) ), None )
+
+
+    def test_explicit_state(self):
+        a = self.acceptor()
+        a.recv_prepare('A', PID(1,'A'))
+        self.gc.add( 'x', a, 'custom' )
+        self.gc.commit()
+        self.assertEquals( self.gc.recovered('x'), 'custom' )
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A'))] )
+
+
+    def test_deferred_requests_committed(self):
+        a = self.acceptor()
+        a.recv_prepare('A', PID(1,'A'))
+        a.recv_prepare('B', PID(2,'B'))
+        self.gc.add( 'x', a )
+        self.gc.commit()
+
+        self.assertEquals( self.doh.nsaves, 2 )
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A')),
+                                       ('promise', 'B', PID(2,'B'))] )
+        self.assertEquals( self.gc.recovered('x'), (PID(2,'B'), None, None) )
+        self.assertTrue( not a.persistance_required )
+
+
+    def test_background_commit(self):
+        loop  = queue.Queue()
+        saver = durable.BackgroundSaver(self.doh, lambda f, *args: loop.put( (f, args) ))
+        gc    = durable.GroupCommitter(self.doh, saver)
+        a     = self.acceptor()
+
+        a.recv_prepare('A', PID(1,'A'))
+        gc.add( 'x', a )
+        gc.commit()
+
+        f, args = loop.get(timeout=5)
+        self.assertEquals( self.msgs, [] )
+        f(*args)
+        saver.close()
+
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A'))] )
+        self.assertEquals( self.doh.nsaves, 1 )
+
+
+
+class BlockingHandler (durable.MemoryObjectHandler):
+
+    def __init__(self, *args):
+        super(BlockingHandler, self).__init__(*args)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.saved   = list()
+
+    def save(self, obj):
+        self.started.set()
+        self.release.wait(5)
+        if obj == 'fail':
+            raise durable.DurabilityFailure('fail')
+        self.saved.append(obj)
+        super(BlockingHandler, self).save(obj)
+
+
+
+class BackgroundSaverTester (AcceptorMessenger, unittest.TestCase):
+
+    def setUp(self):
+        self.loop    = queue.Queue()
+        self.handler = BlockingHandler('dir', 'id1')
+        self.saver   = durable.BackgroundSaver(self.handler, self.call_soon_threadsafe)
+        self.calls   = list()
+        self.msgs    = list()
+
+
+    def tearDown(self):
+        self.handler.release.set()
+        self.saver.close()
+        durable.MemoryObjectHandler.store.clear()
+
+
+    def call_soon_threadsafe(self, func, *args):
+        self.loop.put( (func, args) )
+
+
+    def run_loop(self, n=1):
+        for i in range(n):
+            func, args = self.loop.get(timeout=5)
+            func(*args)
+
+
+    def test_save(self):
+        self.handler.release.set()
+        self.saver.save('foo', lambda : self.calls.append(1))
+        self.run_loop()
+        self.assertEquals( self.calls, [1] )
+        self.assertEquals( self.handler.saved, ['foo'] )
+
+
+    def test_coalesce(self):
+        self.saver.save('foo', lambda : self.calls.append(1))
+        self.handler.started.wait(5)
+        self.saver.save('bar', lambda : self.calls.append(2))
+        self.saver.save('baz')
+        self.saver.save('qux', lambda : self.calls.append(3))
+        self.handler.release.set()
+        self.run_loop(2)
+        self.assertEquals( self.calls, [1, 2, 3] )
+        self.assertEquals( self.handler.saved, ['foo', 'qux'] )
+
+
+    def test_persist_acceptor(self):
+        a = practical.Acceptor()
+        a.messenger = self
+        a.recv_prepare('A', PID(1,'A'))
+        self.saver.persist(a)
+        self.handler.started.wait(5)
+        self.assertTrue( a.persistance_required )
+        self.assertEquals( self.msgs, [] )
+        self.handler.release.set()
+        self.run_loop()
+        self.assertTrue( not a.persistance_required )
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A'))] )
+        self.assertEquals( durable.MemoryObjectHandler('dir', 'id1').recovered,
+                           (PID(1,'A'), None, None) )
+
+
+    def test_single_acceptor(self):
+        self.handler.release.set()
+        a = self.acceptor()
+        b = self.acceptor()
+        a.recv_prepare('A', PID(1,'A'))
+        b.recv_prepare('B', PID(1,'B'))
+        self.saver.persist(a)
+        self.assertRaises(ValueError, self.saver.persist, b)
+        self.run_loop()
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A'))] )
+        self.assertTrue( b.persistance_required )
+
+
+    def test_persist_while_saving(self):
+        a = self.acceptor()
+        a.recv_prepare('A', PID(1,'A'))
+        self.saver.persist(a)
+        self.handler.started.wait(5)
+        a.recv_accept_request('A', PID(1,'A'), 'v')
+        self.saver.persist(a)
+        self.handler.release.set()
+
+        # Only (P1, None, None) is durable after the first save
+        self.run_loop()
+        self.assertEquals( self.handler.saved[0], (PID(1,'A'), None, None) )
+        self.assertEquals( self.msgs, [] )
+        self.assertTrue( a.persistance_required )
+
+        self.run_loop()
+        self.assertEquals( self.handler.saved[-1], (PID(1,'A'), PID(1,'A'), 'v') )
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A')),
+                                       ('accepted', PID(1,'A'), 'v')] )
+        self.assertTrue( not a.persistance_required )
+
+
+    def test_commit_while_saving(self):
+        gc = durable.GroupCommitter(self.handler, self.saver)
+        a  = self.acceptor()
+        a.recv_prepare('A', PID(1,'A'))
+        gc.add('x', a)
+        gc.commit()
+        self.handler.started.wait(5)
+        a.recv_accept_request('A', PID(1,'A'), 'v')
+        gc.add('x', a)
+        gc.commit()
+        self.handler.release.set()
+
+        self.run_loop()
+        self.assertEquals( self.handler.saved[0], {'x' : (PID(1,'A'), None, None)} )
+        self.assertEquals( self.msgs, [] )
+
+        self.run_loop()
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A')),
+                                       ('accepted', PID(1,'A'), 'v')] )
+
+
+    def test_commit_before_readded_acceptor_committed(self):
+        gc = durable.GroupCommitter(self.handler, self.saver)
+        a  = self.acceptor()
+        a.recv_prepare('A', PID(1,'A'))
+        gc.add('x', a)
+        gc.commit()
+        a.recv_accept_request('A', PID(1,'A'), 'v')
+        gc.add('x', a)
+        self.handler.release.set()
+
+        # The completed commit leaves the Acceptor to a commit of its new state
+        self.run_loop()
+        self.assertEquals( self.msgs, [] )
+        self.run_loop()
+        self.assertEquals( self.handler.saved[-1], {'x' : (PID(1,'A'), PID(1,'A'), 'v')} )
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A')),
+                                       ('accepted', PID(1,'A'), 'v')] )
+
+
+    def test_persist_deferred_requests(self):
+        self.handler.release.set()
+        a = practical.Acceptor()
+        a.messenger = self
+        a.recv_prepare('A', PID(1,'A'))
+        a.recv_prepare('B', PID(2,'B'))
+        self.saver.persist(a)
+        self.run_loop()
+        self.assertTrue( a.persistance_required )
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A'))] )
+        self.run_loop()
+        self.assertTrue( not a.persistance_required )
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A')), ('promise', 'B', PID(2,'B'))] )
+        self.assertEquals( self.handler.saved, [(PID(1,'A'), None, None), (PID(2,'B'), None, None)] )
+
+
+    def test_error(self):
+        errors = list()
+        self.saver.on_error = errors.append
+        self.handler.release.set()
+        self.saver.save('fail', lambda : self.calls.append(1))
+        self.run_loop()
+        self.assertEquals( self.calls, [] )
+        self.assertTrue( isinstance(errors[0], durable.DurabilityFailure) )
+
+
+    def test_close(self):
+        self.saver.save('foo', lambda : self.calls.append(1))
+        self.handler.release.set()
+        self.saver.close()
+        self.assertEquals( self.handler.saved, ['foo'] )
+        self.assertRaises( durable.DurabilityFailure, self.saver.save, 'bar' )
+
+
+
+
+class WriteAheadLogTester (TempDirTester):
+
+    def newlog(self, segment_size=None):
+        log = durable.WriteAheadLog(self.tdir, 'log', segment_size)
+        self.opened.append(log)
+        return log
+
+
+    def test_bad_directory(self):
+        self.assertRaises(Exception, durable.WriteAheadLog, '/@#$!$^FOOBARBAZ', 'blah')
+
+
+    def test_empty(self):
+        log = self.newlog()
+        self.assertEquals( list(log.replay()), [] )
+        self.assertEquals( log.next_serial, 1 )
+
+
+    def test_append_and_replay(self):
+        log = self.newlog()
+        self.assertEquals( log.append('foo'), 1 )
+        self.assertEquals( log.append(('bar', 2)), 2 )
+        log.sync()
+        log.close()
+        log = self.newlog()
+        self.assertEquals( list(log.replay()), [(1, 'foo'), (2, ('bar', 2))] )
+        self.assertEquals( log.append('baz'), 3 )
+        log.close()
+        log = self.newlog()
+        self.assertEquals( [o for s, o in log.replay()], ['foo', ('bar', 2), 'baz'] )
+
+
+    def test_mixed_checksums(self):
+        log = durable.WriteAheadLog(self.tdir, 'log', checksum='md5')
+        self.opened.append(log)
+        log.append('foo')
+        log.sync()
+        log.close()
+        log = self.newlog()
+        log.append('bar')
+        log.sync()
+        log.close()
+        log = self.newlog()
+        self.assertEquals( list(log.replay()), [(1, 'foo'), (2, 'bar')] )
+
+
+    def test_compression(self):
+        log = durable.WriteAheadLog(self.tdir, 'log', compression='zlib')
+        self.opened.append(log)
+        log.append( 'x' * 10000 )
+        log.append( 'y' )
+        log.sync()
+        log.close()
+        self.assertTrue( os.stat(log.segments[0][1]).st_size < 1000 )
+        log = self.newlog()
+        self.assertEquals( list(log.replay()), [(1, 'x' * 10000), (2, 'y')] )
+
+
+    def test_mixed_serializers(self):
+        log = durable.WriteAheadLog(self.tdir, 'log', serializer='acceptor')
+        self.opened.append(log)
+        log.append( (PID(1,'A'), None, None) )
+        log.sync()
+        log.close()
+        log = self.newlog()
+        log.append( {'foo' : 1} )
+        log.sync()
+        log.close()
+        log = self.newlog()
+        self.assertEquals( list(log.replay()), [(1, (PID(1,'A'), None, None)), (2, {'foo' : 1})] )
+
+
+    def test_segments(self):
+        log = self.newlog(100)
+        for i in range(20):
+            log.append( 'x' * 30 )
+        log.sync()
+        log.close()
+        self.assertTrue( len(log.segments) > 5 )
+        self.assertEquals( log.segments[0][0], 1 )
+        log = self.newlog(100)
+        self.assertEquals( [s for s, o in log.replay()], list(range(1,21)) )
+        self.assertEquals( log.next_serial, 21 )
+
+
+    def test_torn_tail_truncated(self):
+        log = self.newlog()
+        log.append('foo')
+        log.append('bar')
+        log.sync()
+        log.close()
+
+        fn   = log.segments[-1][1]
+        size = os.stat(fn).st_size
+
+        with open(fn, 'r+b') as f:
+            f.truncate(size - 3)
+
+        log = self.newlog()
+        self.assertEquals( list(log.replay()), [(1, 'foo')] )
+        self.assertEquals( log.append('baz'), 2 )
+        log.close()
+
+        log = self.newlog()
+        self.assertEquals( list(log.replay()), [(1, 'foo'), (2, 'baz')] )
+
+
+    def test_corrupted_tail_truncated(self):
+        log = self.newlog()
+        log.append('foo')
+        log.append('bar')
+        log.close()
+
+        fn = log.segments[-1][1]
+
+        with open(fn, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+
+        log = self.newlog()
+        self.assertEquals( list(log.replay()), [(1, 'foo')] )
+
+
+    def test_corrupted_middle_segment(self):
+        log = self.newlog(50)
+        for i in range(5):
+            log.append( 'x' * 30 )
+        log.close()
+
+        with open(log.segments[1][1], 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+
+        self.assertRaises(durable.UnrecoverableFailure, self.newlog, 50)
+
+
+    def test_missing_segment(self):
+        log = self.newlog(50)
+        for i in range(5):
+            log.append( 'x' * 30 )
+        log.close()
+
+        os.unlink(log.segments[2][1])
+
+        self.assertRaises(durable.UnrecoverableFailure, self.newlog, 50)
+
+
+    def test_compact(self):
+        log = self.newlog(50)
+        for i in range(5):
+            log.append( i )
+        log.compact( 'state@5' )
+        self.assertEquals( len(log.segments), 1 )
+        log.append( 5 )
+        log.sync()
+        log.close()
+
+        wal_files = [ fn for fn in os.listdir(self.tdir) if fn.endswith('.wal') ]
+        self.assertEquals( len(wal_files), 1 )
+
+        log = self.newlog(50)
+        self.assertEquals( log.snapshot, 'state@5' )
+        self.assertEquals( list(log.replay()), [(6, 5)] )
+        self.assertEquals( log.append( 6 ), 7 )
+
+
+    def test_compact_empty(self):
+        log = self.newlog()
+        log.compact( 'empty' )
+        log.close()
+        log = self.newlog()
+        self.assertEquals( log.snapshot, 'empty' )
+        self.assertEquals( log.next_serial, 1 )
+        self.assertEquals( log.append('foo'), 1 )
+        log.sync()
+        log.compact( 'foo' )
+        log.close()
+        log = self.newlog()
+        self.assertEquals( log.snapshot, 'foo' )
+        self.assertEquals( list(log.replay()), [] )
+        self.assertEquals( log.append('bar'), 2 )
+
+
+    def test_interrupted_compaction(self):
+        log = self.newlog(50)
+        for i in range(5):
+            log.append( i )
+        segments = list(log.segments)
+        log.compact( 'state@5' )
+        log.close()
+
+        # Recreate the segments as though the crash occurred prior to their deletion
+        for first, fn in segments:
+            if not os.path.exists(fn):
+                with open(fn, 'wb') as f:
+                    f.write( durable.encode(first, first - 1) )
+
+        log = self.newlog(50)
+        self.assertEquals( len(log.segments), 1 )
+        self.assertEquals( list(log.replay()), [] )
+        self.assertEquals( log.append( 5 ), 6 )
+
+
+
+class RecoverAllTester (TempDirTester):
+
+    def setUp(self):
+        super(RecoverAllTester, self).setUp()
+
+        for i in range(20):
+            doh = durable.DurableObjectHandler(self.tdir, 'obj%d' % i)
+            for j in range(i % 3):
+                doh.save( (i, j) )
+            doh.close()
+
+
+    def expected(self, i):
+        return (i, i % 3 - 1) if i % 3 else None
+
+
+    def test_list_objects(self):
+        self.assertEquals( durable.list_objects(self.tdir),
+                           sorted('obj%d' % i for i in range(20)) )
+
+
+    def test_recover_all(self):
+        r = durable.recover_all(self.tdir, workers=4)
+        self.assertEquals( r, dict( ('obj%d' % i, self.expected(i)) for i in range(20) ) )
+
+
+    def remove_clean_markers(self):
+        for fn in os.listdir(self.tdir):
+            if fn.endswith('.clean'):
+                os.unlink(os.path.join(self.tdir, fn))
+
+
+    def test_no_side_effects(self):
+        self.remove_clean_markers()
+        before = sorted(os.listdir(self.tdir))
+        r      = durable.recover_all(self.tdir, ['obj1', 'obj3', 'missing'])
+        self.assertEquals( r, {'obj1' : (1, 0), 'obj3' : None, 'missing' : None} )
+        self.assertEquals( sorted(os.listdir(self.tdir)), before )
+
+
+    def test_read_only_handler(self):
+        self.remove_clean_markers()
+        d = durable.DurableObjectHandler(self.tdir, 'obj2', read_only=True)
+        self.assertEquals( d.recovered, (2, 1) )
+        self.assertRaises( durable.DurabilityFailure, d.save, 'foo' )
+        self.assertRaises( durable.DurabilityFailure, d.save_delta, {} )
+        d.close()
+        self.assertFalse( os.path.exists(os.path.join(self.tdir, 'obj2.clean')) )
+
+
+    def test_read_only_argument(self):
+        self.assertEquals( durable.recover_all(self.tdir, ['obj1'], read_only=True), {'obj1' : (1, 0)} )
+        self.assertRaises( ValueError, durable.recover_all, self.tdir, ['obj1'], read_only=False )
+
+
+    def test_write_ahead_log_snapshots_excluded(self):
+        log = durable.WriteAheadLog(self.tdir, 'log')
+        log.append( 1 )
+        log.compact( 'snap' )
+        log.close()
+        self.assertEquals( durable.list_objects(self.tdir),
+                           sorted('obj%d' % i for i in range(20)) )
+
+
+    def test_recover_some(self):
+        self.assertEquals( durable.recover_all(self.tdir, ['obj2', 'obj4']),
+                           { 'obj2' : (2, 1), 'obj4' : (4, 0) } )
+        self.assertEquals( durable.recover_all(self.tdir, []), dict() )
+
+
+    def test_supplied_pool(self):
+        import multiprocessing.pool
+        pool = multiprocessing.pool.ThreadPool(2)
+        try:
+            self.assertEquals( durable.recover_all(self.tdir, ['obj1'], pool=pool), {'obj1' : (1, 0)} )
+            self.assertEquals( pool.apply(len, ('abc',)), 3 )
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def test_unrecoverable(self):
+        for suffix in ('_a.durable', '_b.durable'):
+            with open(os.path.join(self.tdir, 'obj2' + suffix), 'wb') as f:
+                f.write(b'\0')
+        self.assertRaises(durable.UnrecoverableFailure, durable.recover_all, self.tdir)
+
+
+
+class NullAcceptor (object):
+
+    persistance_required = False
+
+    def persisted(self):
+        pass
+
+
+
+class DurableObjectStoreTester (AcceptorMessenger, TempDirTester):
+
+    def setUp(self):
+        super(DurableObjectStoreTester, self).setUp()
+        self.msgs   = list()
+
+
+    def newstore(self, min_compact_records=None):
+        store = durable.DurableObjectStore(self.tdir, 'store', min_compact_records=min_compact_records)
+        self.opened.append(store)
+        return store
+
+
+    def prepared(self, uid):
+        a = self.acceptor()
+        a.recv_prepare(uid, PID(1,uid))
+        return a
+
+
+    def test_commit_and_recover(self):
+        st = self.newstore()
+        for i in range(100):
+            st.add( i, self.prepared(str(i)) )
+        self.assertEquals( self.msgs, [] )
+        st.commit()
+        self.assertEquals( len(self.msgs), 100 )
+        st.add( 5, self.prepared('5'), 'custom' )
+        st.commit()
+        st.commit()
+        st.close()
+
+        self.assertEquals( len(os.listdir(self.tdir)), 3 )
+
+        st = self.newstore()
+        self.assertEquals( st.recovered(7), (PID(1,'7'), None, None) )
+        self.assertEquals( st.recovered(5), 'custom' )
+        self.assertEquals( st.recovered(100), None )
+        self.assertEquals( st.nrecords, 2 )
+
+
+    def test_deferred_requests_committed(self):
+        st = self.newstore()
+        a  = self.prepared('A')
+        a.recv_prepare('B', PID(2,'B'))
+        st.add( 'x', a )
+        st.commit()
+        self.assertEquals( self.msgs, [('promise', 'A', PID(1,'A')), ('promise', 'B', PID(2,'B'))] )
+        self.assertEquals( st.recovered('x'), (PID(2,'B'), None, None) )
+        self.assertEquals( st.nrecords, 2 )
+        self.assertTrue( not a.persistance_required )
+
+
+    def test_persisted_before_compaction(self):
+        st   = self.newstore(1)
+        seen = list()
+
+        class Recorder (NullAcceptor):
+            def persisted(self):
+                seen.append( st.nrecords )
+
+        st.add( 0, Recorder(), 'a' )
+        st.commit()
+        st.add( 0, Recorder(), 'b' )
+        st.commit()
+        self.assertEquals( seen, [1, 2] )
+        self.assertEquals( st.nrecords, 0 )
+
+
+    def test_commit_writes_only_changes(self):
+        st = self.newstore()
+        for i in range(10):
+            st.add( i, NullAcceptor(), i )
+        st.commit()
+        st.add( 3, NullAcceptor(), 'x' )
+        st.commit()
+        self.assertEquals( [c for s, c in st.log.replay()],
+                           [ dict((i,i) for i in range(10)), {3 : 'x'} ] )
+
+
+    def test_compaction(self):
+        st = self.newstore(5)
+        for i in range(6):
+            st.add( i % 2, NullAcceptor(), i )
+            st.commit()
+        self.assertEquals( st.nrecords, 0 )
+        self.assertEquals( list(st.log.replay()), [] )
+        st.add( 2, NullAcceptor(), 'foo' )
+        st.commit()
+        st.close()
+
+        st = self.newstore(5)
+        self.assertEquals( st.state, {0 : 4, 1 : 5, 2 : 'foo'} )
+        self.assertEquals( st.nrecords, 1 )
+
+
+
+@unittest.skipUnless('pickle5' in durable.SERIALIZERS, 'requires pickle protocol 5')
+class OutOfBandPickleTester (TempDirTester):
+
+    def setUp(self):
+        super(OutOfBandPickleTester, self).setUp()
+        self.s    = durable.OutOfBandPickleSerializer(100)
+
+
+    def newdoh(self):
+        doh = durable.DurableObjectHandler(self.tdir, 'id1', serializer='pickle5')
+        self.opened.append(doh)
+        return doh
+
+
+    def test_out_of_band(self):
+        big   = b'x' * 200
+        parts = self.s.dumps_parts( (PID(1,'A'), b'small', big, bytearray(big)) )
+        self.assertEqual( len(parts), 4 )
+        self.assertTrue( parts[2].obj is big )
+
+        pid, small, v1, v2 = self.s.loads( b''.join(parts) )
+        self.assertEqual( pid, PID(1,'A') )
+        self.assertEqual( small, b'small' )
+        self.assertTrue( isinstance(v1, memoryview) )
+        self.assertTrue( v1.readonly )
+        self.assertEqual( v1, big )
+        self.assertEqual( v2, big )
+
+
+    def test_corrupted(self):
+        data = self.s.dumps( [b'x' * 200] )
+        self.assertRaises( durable.FileCorrupted, self.s.loads, data[:5] )
+        self.assertRaises( durable.FileCorrupted, self.s.loads, data + b'x' )
+
+
+    def test_zero_copy_recovery(self):
+        big = os.urandom(100000)
+        d   = self.newdoh()
+        d.save( (PID(1,'A'), PID(1,'A'), big) )
+        d.close()
+
+        d     = self.newdoh()
+        value = d.recovered[2]
+        self.assertTrue( isinstance(value, memoryview) )
+        self.assertTrue( isinstance(value.obj, mmap.mmap) )
+        self.assertEqual( value, big )
+        self.assertEqual( d.pinned_fd, d.fd_a )
+
+        # The second save targets the file backing 'value'
+        d.save( (PID(2,'A'), PID(1,'A'), value) )
+        d.save( (PID(3,'A'), PID(1,'A'), b'y' * 100000) )
+        self.assertEqual( d.pinned_fd, None )
+        self.assertEqual( value, big )
+        d.close()
+
+        self.assertEqual( self.newdoh().recovered, (PID(3,'A'), PID(1,'A'), b'y' * 100000) )
+
+
+    def test_recover_all_copies_views(self):
+        big = os.urandom(100000)
+        d   = self.newdoh()
+        d.save( {'v' : big, 'l' : [PID(1,'A'), big]} )
+        d.close()
+
+        pool = multiprocessing.Pool(2)
+        try:
+            for p in (None, pool):
+                r = durable.recover_all(self.tdir, ['id1'], pool=p)
+                self.assertEqual( r, {'id1' : {'v' : big, 'l' : [PID(1,'A'), big]}} )
+                self.assertTrue( type(r['id1']['v']) is bytes )
+                self.assertTrue( type(r['id1']['l'][1]) is bytes )
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def test_no_pin_without_references(self):
+        d = self.newdoh()
+        d.save( {'v' : b'x' * 10} )
+        d.close()
+        d = self.newdoh()
+        self.assertEqual( d.recovered, {'v' : b'x' * 10} )
+        self.assertEqual( d.pinned_fd, None )
@@ -1,5 +1,4 @@
 import sys
-import itertools
 import os.path
 import pickle
 
@@ -57,7 +56,7 @@ class EssentialMessenger (object):
 
     def amm(self, msgs):
         self.assertEquals( len(self._msgs), len(msgs) )
-        for a, e in itertools.izip(self._msgs, msgs):
+        for a, e in zip(self._msgs, msgs):
             self.assertEquals( a, e )
         self._msgs = list()
 
@@ -0,0 +1,398 @@
+
+import sys
+import os.path
+
+import unittest
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append( os.path.dirname(this_dir) )
+
+from paxos import multi
+
+import test_essential
+from   test_essential import PID
+
+
+
+class MultiMessenger (test_essential.EssentialMessenger):
+
+    leader_acquired = False
+    leader_lost     = False
+
+    def setUp(self):
+        super(MultiMessenger, self).setUp()
+        self.resolutions = list()
+
+    def send_prepare(self, proposal_id, first_slot):
+        self._append('prepare', proposal_id, first_slot)
+
+    def send_promise(self, to_uid, proposal_id, first_slot, accepted):
+        self._append('promise', to_uid, proposal_id, first_slot, accepted)
+
+    def send_prepare_nack(self, to_uid, proposal_id, promised_id):
+        self._append('prepare_nack', to_uid, proposal_id, promised_id)
+
+    def send_accept(self, slot, proposal_id, proposal_value):
+        self._append('accept', slot, proposal_id, proposal_value)
+
+    def send_accepted(self, slot, proposal_id, accepted_value):
+        self._append('accepted', slot, proposal_id, accepted_value)
+
+    def send_accept_nack(self, to_uid, slot, proposal_id, promised_id):
+        self._append('accept_nack', to_uid, slot, proposal_id, promised_id)
+
+    def on_resolution(self, slot, proposal_id, value):
+        self.resolutions.append( (slot, proposal_id, value) )
+
+    def on_leadership_acquired(self):
+        self.leader_acquired = True
+
+    def on_leadership_lost(self):
+        self.leader_lost = True
+
+
+
+class MultiPaxosNodeTester (MultiMessenger, unittest.TestCase):
+
+    def setUp(self):
+        super(MultiPaxosNodeTester, self).setUp()
+        self.n = multi.MultiPaxosNode(self, 'A', 2)
+
+
+    def lead(self, accepted_b=None, accepted_c=None):
+        self.n.prepare()
+        self.am('prepare', PID(1,'A'), 0)
+        self.n.recv_promise('B', PID(1,'A'), 0, accepted_b or dict())
+        self.n.recv_promise('C', PID(1,'A'), 0, accepted_c or dict())
+        self.at( self.n.leader )
+        self.at( self.leader_acquired )
+
+
+    def resolve(self, slot, pid, value):
+        self.n.recv_accepted('B', slot, pid, value)
+        self.n.recv_accepted('C', slot, pid, value)
+
+
+    # --- Proposer Tests ---
+
+    def test_queue_until_leader(self):
+        self.n.set_proposal('foo')
+        self.an()
+        self.ae( list(self.n.proposal_queue), ['foo'] )
+        self.lead()
+        self.am('accept', 0, PID(1,'A'), 'foo')
+
+
+    def test_no_prepare_for_subsequent_slots(self):
+        self.lead()
+        self.n.set_proposal('foo')
+        self.am('accept', 0, PID(1,'A'), 'foo')
+        self.resolve(0, PID(1,'A'), 'foo')
+        self.ae( self.resolutions, [(0, PID(1,'A'), 'foo')] )
+        self.n.set_proposal('bar')
+        self.am('accept', 1, PID(1,'A'), 'bar')
+        self.resolve(1, PID(1,'A'), 'bar')
+        self.ae( self.n.low_slot, 2 )
+
+
+    def test_next_value_sent_on_resolution(self):
+        self.lead()
+        self.n.set_proposal('foo')
+        self.n.set_proposal('bar')
+        self.am('accept', 0, PID(1,'A'), 'foo')
+        self.resolve(0, PID(1,'A'), 'foo')
+        self.am('accept', 1, PID(1,'A'), 'bar')
+
+
+    def test_pipeline_window(self):
+        self.n = multi.MultiPaxosNode(self, 'A', 2, pipeline_window=3)
+        self.lead()
+        for v in ['a', 'b', 'c', 'd', 'e']:
+            self.n.set_proposal(v)
+        self.amm([ ('accept', 0, PID(1,'A'), 'a'),
+                   ('accept', 1, PID(1,'A'), 'b'),
+                   ('accept', 2, PID(1,'A'), 'c') ])
+        self.resolve(1, PID(1,'A'), 'b')
+        self.am('accept', 3, PID(1,'A'), 'd')
+        self.resolve(0, PID(1,'A'), 'a')
+        self.am('accept', 4, PID(1,'A'), 'e')
+        self.ae( self.n.low_slot, 2 )
+        self.ae( sorted(self.n.in_flight), [2, 3, 4] )
+
+
+    def test_pipeline_window_includes_reproposals(self):
+        self.n = multi.MultiPaxosNode(self, 'A', 2, pipeline_window=2)
+        self.n.set_proposal('foo')
+        self.n.set_proposal('bar')
+        self.lead( {0 : (PID(1,'B'), 'x'), 1 : (PID(1,'B'), 'y')} )
+        self.amm([ ('accept', 0, PID(1,'A'), 'x'),
+                   ('accept', 1, PID(1,'A'), 'y') ])
+        self.resolve(0, PID(1,'A'), 'x')
+        self.am('accept', 2, PID(1,'A'), 'foo')
+
+
+    def test_prepare_covers_first_unresolved_slot(self):
+        self.resolve(0, PID(1,'B'), 'foo')
+        self.resolve(1, PID(1,'B'), 'bar')
+        self.n.prepare()
+        self.am('prepare', PID(1,'A'), 2)
+
+
+    def test_repropose_accepted_value(self):
+        self.n.set_proposal('foo')
+        self.lead( {0 : (PID(1,'B'), 'x')}, {0 : (PID(2,'C'), 'y')} )
+        self.am('accept', 0, PID(1,'A'), 'y')
+        self.resolve(0, PID(1,'A'), 'y')
+        self.am('accept', 1, PID(1,'A'), 'foo')
+
+
+    def test_hole_used_for_next_proposal(self):
+        self.lead( {1 : (PID(1,'B'), 'x')} )
+        self.am('accept', 1, PID(1,'A'), 'x')
+        self.ae( self.n.next_slot, 2 )
+        self.resolve(1, PID(1,'A'), 'x')
+        self.n.set_proposal('foo')
+        self.am('accept', 0, PID(1,'A'), 'foo')
+
+
+    def test_hole_filled_with_noop(self):
+        self.n.noop_value = 'noop'
+        self.lead( {1 : (PID(1,'B'), 'x')} )
+        self.amm([ ('accept', 0, PID(1,'A'), 'noop'),
+                   ('accept', 1, PID(1,'A'), 'x') ])
+
+
+    def test_falsy_values_sent(self):
+        self.n.noop_value = b''
+        self.lead( {1 : (PID(1,'B'), 0)} )
+        self.amm([ ('accept', 0, PID(1,'A'), b''),
+                   ('accept', 1, PID(1,'A'), 0) ])
+        self.n.resend_accepts()
+        self.amm([ ('accept', 0, PID(1,'A'), b''),
+                   ('accept', 1, PID(1,'A'), 0) ])
+        self.resolve(0, PID(1,'A'), b'')
+        self.resolve(1, PID(1,'A'), 0)
+        self.ae( self.n.low_slot, 2 )
+
+
+    def test_lost_slot_requeued(self):
+        self.lead()
+        self.n.set_proposal('foo')
+        self.am('accept', 0, PID(1,'A'), 'foo')
+        self.resolve(0, PID(5,'B'), 'bar')
+        self.am('accept', 1, PID(1,'A'), 'foo')
+
+
+    def test_resend_accepts(self):
+        self.lead()
+        self.n.set_proposal('foo')
+        self.am('accept', 0, PID(1,'A'), 'foo')
+        self.n.resend_accepts()
+        self.am('accept', 0, PID(1,'A'), 'foo')
+
+
+    def test_leadership_lost_on_nack_quorum(self):
+        self.lead()
+        self.n.set_proposal('foo')
+        self.am('accept', 0, PID(1,'A'), 'foo')
+        self.n.recv_accept_nack('B', 0, PID(1,'A'), PID(5,'B'))
+        self.at( self.n.leader )
+        self.n.recv_accept_nack('C', 0, PID(1,'A'), PID(5,'B'))
+        self.at( not self.n.leader )
+        self.at( self.leader_lost )
+        self.n.resend_accepts()
+        self.an()
+        self.n.prepare()
+        self.am('prepare', PID(6,'A'), 0)
+
+
+    def test_prepare_nack_observed(self):
+        self.n.recv_prepare_nack('B', PID(1,'A'), PID(5,'B'))
+        self.n.prepare()
+        self.am('prepare', PID(6,'A'), 0)
+
+
+    def test_ignore_promise_for_old_proposal(self):
+        self.n.prepare()
+        self.n.prepare()
+        self.clear_msgs()
+        self.n.recv_promise('B', PID(1,'A'), 0, dict())
+        self.n.recv_promise('C', PID(1,'A'), 0, dict())
+        self.at( not self.n.leader )
+
+
+    def test_not_active(self):
+        self.n.active = False
+        self.n.prepare()
+        self.an()
+        self.n.recv_promise('B', PID(1,'A'), 0, dict())
+        self.n.recv_promise('C', PID(1,'A'), 0, dict())
+        self.n.set_proposal('foo')
+        self.an()
+
+
+    # --- Acceptor Tests ---
+
+    def test_recv_prepare(self):
+        self.n.recv_prepare('B', PID(1,'B'), 0)
+        self.an()
+        self.at( self.n.persistance_required )
+        self.n.persisted()
+        self.am('promise', 'B', PID(1,'B'), 0, dict())
+        self.at( not self.n.persistance_required )
+
+
+    def test_recv_prepare_duplicate(self):
+        self.test_recv_prepare()
+        self.n.recv_prepare('B', PID(1,'B'), 0)
+        self.am('promise', 'B', PID(1,'B'), 0, dict())
+
+
+    def test_recv_prepare_queued_while_pending(self):
+        self.n.recv_prepare('B', PID(1,'B'), 0)
+        self.n.recv_prepare('C', PID(2,'C'), 0)
+        self.n.persisted()
+        self.am('promise', 'B', PID(1,'B'), 0, dict())
+        self.at( self.n.persistance_required )
+        self.n.persisted()
+        self.am('promise', 'C', PID(2,'C'), 0, dict())
+
+
+    def test_recv_accept_request_queued_while_pending(self):
+        self.n.recv_accept_request('B', 0, PID(1,'B'), 'foo')
+        self.n.recv_accept_request('C', 0, PID(2,'C'), 'bar')
+        self.n.persisted()
+        self.am('accepted', 0, PID(1,'B'), 'foo')
+        self.ae( self.n.pending_slots, set([0]) )
+        self.n.persisted()
+        self.am('accepted', 0, PID(2,'C'), 'bar')
+
+
+    def test_recv_prepare_nack(self):
+        self.test_recv_prepare()
+        self.n.recv_prepare('C', PID(0,'C'), 0)
+        self.am('prepare_nack', 'C', PID(0,'C'), PID(1,'B'))
+
+
+    def test_recv_prepare_reports_accepted(self):
+        self.n.recv_accept_request('B', 0, PID(1,'B'), 'foo')
+        self.n.recv_accept_request('B', 1, PID(1,'B'), 'bar')
+        self.n.persisted()
+        self.clear_msgs()
+        self.n.recv_prepare('C', PID(2,'C'), 1)
+        self.n.persisted()
+        self.am('promise', 'C', PID(2,'C'), 1, {1 : (PID(1,'B'), 'bar')})
+
+
+    def test_recv_accept_request(self):
+        self.n.recv_accept_request('B', 3, PID(1,'B'), 'foo')
+        self.an()
+        self.ae( self.n.pending_slots, set([3]) )
+        self.ae( self.n.slot_state(3), (PID(1,'B'), PID(1,'B'), 'foo') )
+        self.n.persisted()
+        self.am('accepted', 3, PID(1,'B'), 'foo')
+
+
+    def test_recv_accept_request_below_promise(self):
+        self.test_recv_prepare()
+        self.n.recv_accept_request('C', 5, PID(0,'C'), 'foo')
+        self.am('accept_nack', 'C', 5, PID(0,'C'), PID(1,'B'))
+        self.at( not self.n.persistance_required )
+
+
+    def test_recover(self):
+        self.n.recover( PID(3,'B'), {2 : (PID(3,'B'), PID(2,'B'), 'foo')} )
+        self.n.recv_prepare('C', PID(4,'C'), 0)
+        self.n.persisted()
+        self.am('promise', 'C', PID(4,'C'), 0, {2 : (PID(2,'B'), 'foo')})
+        self.n.recv_accept_request('B', 7, PID(3,'B'), 'bar')
+        self.am('accept_nack', 'B', 7, PID(3,'B'), PID(4,'C'))
+
+
+    # --- Truncation Tests ---
+
+    def test_truncate(self):
+        self.lead()
+        for v in ['a', 'b', 'c']:
+            self.n.set_proposal(v)
+            self.resolve(self.n.next_slot - 1, PID(1,'A'), v)
+        self.clear_msgs()
+        self.n.recv_accept_request('B', 3, PID(1,'A'), 'd')
+        self.n.persisted()
+        self.clear_msgs()
+        self.ae( sorted(self.n.instances), [0, 1, 2, 3] )
+        self.n.truncate(2)
+        self.ae( sorted(self.n.instances), [2, 3] )
+        self.ae( self.n.base_slot, 2 )
+        self.ae( self.n.low_slot, 3 )
+        self.ae( self.n.acceptor_state(),
+                 (None, {2 : (None, None, None), 3 : (PID(1,'A'), PID(1,'A'), 'd')}) )
+        self.n.recv_accept_request('B', 1, PID(1,'A'), 'x')
+        self.n.recv_accepted('B', 1, PID(1,'A'), 'x')
+        self.an()
+        self.ae( sorted(self.n.instances), [2, 3] )
+
+
+    def test_truncate_from_snapshot(self):
+        self.n.recover( PID(1,'B'), {12 : (PID(1,'B'), PID(1,'B'), 'foo')} )
+        self.n.truncate(10)
+        self.ae( self.n.low_slot, 10 )
+        self.n.prepare()
+        self.am('prepare', PID(2,'A'), 10)
+        self.n.recv_promise('B', PID(2,'A'), 10, {12 : (PID(1,'B'), 'foo')})
+        self.n.recv_promise('C', PID(2,'A'), 10, dict())
+        self.n.set_proposal('bar')
+        self.am('accept', 12, PID(2,'A'), 'foo')
+        self.resolve(12, PID(2,'A'), 'foo')
+        self.am('accept', 10, PID(2,'A'), 'bar')
+
+
+    def test_promise_reports_truncation(self):
+        self.n.truncate(5)
+        self.n.recv_prepare('B', PID(1,'B'), 2)
+        self.n.persisted()
+        self.am('promise', 'B', PID(1,'B'), 5, dict())
+        self.n.recv_prepare('B', PID(1,'B'), 2)
+        self.am('promise', 'B', PID(1,'B'), 5, dict())
+
+
+    def test_truncated_slots_skipped(self):
+        self.n = multi.MultiPaxosNode(self, 'A', 2, pipeline_window=2)
+        self.n.noop_value = 'noop'
+        self.n.set_proposal('foo')
+        self.n.prepare()
+        self.am('prepare', PID(1,'A'), 0)
+        self.n.recv_promise('B', PID(1,'A'), 3, {4 : (PID(1,'B'), 'x')})
+        self.n.recv_promise('C', PID(1,'A'), 0, {1 : (PID(1,'C'), 'y')})
+        self.amm([ ('accept', 3, PID(1,'A'), 'noop'),
+                   ('accept', 4, PID(1,'A'), 'x') ])
+        self.resolve(3, PID(1,'A'), 'noop')
+        self.am('accept', 5, PID(1,'A'), 'foo')
+
+
+    def test_truncated_in_flight_requeued(self):
+        self.lead()
+        self.n.set_proposal('foo')
+        self.am('accept', 0, PID(1,'A'), 'foo')
+        self.n.prepare()
+        self.am('prepare', PID(2,'A'), 0)
+        self.n.recv_promise('B', PID(2,'A'), 2, dict())
+        self.n.recv_promise('C', PID(2,'A'), 2, dict())
+        self.am('accept', 2, PID(2,'A'), 'foo')
+        self.ae( sorted(self.n.in_flight), [2] )
+
+
+    # --- Learner Tests ---
+
+    def test_resolution(self):
+        self.n.recv_accepted('B', 1, PID(1,'B'), 'bar')
+        self.n.recv_accepted('C', 1, PID(1,'B'), 'bar')
+        self.ae( self.resolutions, [(1, PID(1,'B'), 'bar')] )
+        self.ae( self.n.low_slot, 0 )
+        self.resolve(0, PID(1,'B'), 'foo')
+        self.ae( self.n.low_slot, 2 )
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -296,6 +296,32 @@ class PracticalAcceptorTests (test_essential.EssentialAcceptorTests):
         self.am('promise', 'A', PID(1,'A'), None, None)
 
 
+    def test_durable_queued_prepare_processed_after_persisted(self):
+        self.a.auto_save = False
+        self.a.recv_prepare( 'A', PID(1,'A') )
+        self.a.recv_prepare( 'B', PID(3,'B') )
+        self.a.recv_prepare( 'C', PID(2,'C') )
+        self.an()
+        self.a.persisted()
+        self.am('promise', 'A', PID(1,'A'), None, None)
+        self.at( self.a.persistance_required )
+        self.ae( self.a.promised_id, PID(3,'B') )
+        self.a.persisted()
+        self.am('promise', 'B', PID(3,'B'), None, None)
+        self.at( not self.a.persistance_required )
+
+
+    def test_durable_queued_prepare_superseded(self):
+        self.a.auto_save = False
+        self.a.recv_prepare( 'A', PID(1,'A') )
+        self.a.recv_prepare( 'B', PID(2,'B') )
+        self.a.recv_prepare( 'B', PID(1,'B') )
+        self.a.persisted()
+        self.a.persisted()
+        self.amm([ ('promise', 'A', PID(1,'A'), None, None),
+                   ('promise', 'B', PID(2,'B'), None, None) ])
+
+
     def test_durable_recv_accept_request_promised(self):
         self.a.recv_prepare( 'A', PID(1,'A') )
         self.am('promise', 'A', PID(1,'A'), None, None)
@@ -324,6 +350,22 @@ class PracticalAcceptorTests (test_essential.EssentialAcceptorTests):
         self.am('accepted', PID(5,'A'), 'foo')
 
 
+    def test_durable_queued_accept_request_processed_after_persisted(self):
+        self.a.recv_prepare( 'A', PID(1,'A') )
+        self.am('promise', 'A', PID(1,'A'), None, None)
+        self.a.auto_save = False
+        self.a.recv_accept_request('A', PID(5,'A'), 'foo')
+        self.a.recv_accept_request('A', PID(6,'A'), 'bar')
+        self.an()
+        self.a.persisted()
+        self.am('accepted', PID(5,'A'), 'foo')
+        self.at( self.a.persistance_required )
+        self.ae( self.a.accepted_value, 'bar' )
+        self.a.persisted()
+        self.am('accepted', PID(6,'A'), 'bar')
+        self.at( not self.a.persistance_required )
+
+
     def test_durable_recv_accept_request_less_than_promised(self):
         self.a.recv_prepare( 'A', PID(5,'A') )
         self.am('promise', 'A', PID(5,'A'), None, None)
@@ -0,0 +1,250 @@
+
+import sys
+import os.path
+
+import unittest
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append( os.path.dirname(this_dir) )
+
+from paxos import wire, practical, batching
+
+from test_essential import PID
+
+
+
+class Recorder (object):
+
+    def __init__(self):
+        self.received = list()
+
+    def __getattr__(self, name):
+        if not name.startswith('recv_'):
+            raise AttributeError(name)
+        return lambda *args: self.received.append( (name,) + args )
+
+
+
+class CodecTester (unittest.TestCase):
+
+    messages = [ ('prepare',                 (PID(1,'A'),)),
+                 ('promise',                 (PID(1,'A'), None, None)),
+                 ('promise',                 (PID(5,'A'), PID(4,'B'), b'foo')),
+                 ('prepare_nack',            (PID(1,'A'), PID(2,'C'))),
+                 ('accept',                  (PID(300,'A'), b'')),
+                 ('accepted',                (PID(1,'A'), b'x' * 200)),
+                 ('accept_nack',             (PID(1,'A'), PID(2,'C'))),
+                 ('heartbeat',               (PID(1,'A'),)),
+                 ('leadership_proclamation', (PID(1,'A'),)) ]
+
+    def setUp(self):
+        self.c = wire.Codec(['A', 'B', 'C'])
+
+
+    def test_varint(self):
+        for n in (0, 1, 127, 128, 300, 2**40, 2**64 - 1):
+            buf = bytearray()
+            wire.put_varint(buf, n)
+            self.assertEqual( wire.get_varint(memoryview(bytes(buf)), 0), (n, len(buf)) )
+
+        buf = bytearray()
+        wire.put_varint(buf, 127)
+        self.assertEqual( len(buf), 1 )
+        wire.put_varint(buf, 128)
+        self.assertEqual( len(buf), 3 )
+
+        self.assertRaises( ValueError, wire.put_varint, bytearray(), 2**64 )
+        self.assertRaises( ValueError, wire.put_varint, bytearray(), -1 )
+
+
+    def test_varint_limits(self):
+        self.assertEqual( wire.get_varint(memoryview(b'\xff' * 9 + b'\x01'), 0), (2**64 - 1, 10) )
+        self.assertRaises( wire.MalformedMessage, wire.get_varint, memoryview(b'\xff' * 9 + b'\x02'), 0 )
+        self.assertRaises( wire.MalformedMessage, wire.get_varint, memoryview(b'\x80' * 10 + b'\x00'), 0 )
+        self.assertRaises( wire.MessageTruncated, wire.get_varint, memoryview(b'\xff' * 9), 0 )
+        self.assertRaises( wire.MalformedMessage, self.c.decode, b'\x01' + b'\xff' * 100000 )
+
+
+    def test_round_trip(self):
+        for name, args in self.messages:
+            data = self.c.encode('B', name, args)
+            self.assertEqual( self.c.decode(data), [('B', name, args)] )
+
+
+    def test_compact(self):
+        self.assertEqual( len(self.c.encode('A', 'prepare', (PID(1,'A'),))), 4 )
+        self.assertEqual( len(self.c.encode('A', 'promise', (PID(1,'A'), None, None))), 6 )
+
+
+    def test_inline_uids(self):
+        args = ( PID(1, b'raw'), PID(2, u'n\xf6de'), PID(3, 42) )
+        data = self.c.encode(u'D', 'promise', args[:2] + (None,))
+        self.assertEqual( self.c.decode(data), [(u'D', 'promise', args[:2] + (None,))] )
+        data = self.c.encode(7, 'prepare_nack', args[1:])
+        self.assertEqual( self.c.decode(data), [(7, 'prepare_nack', args[1:])] )
+        self.assertRaises( TypeError, self.c.encode, 'A', 'prepare', (PID(1, 1.5),) )
+
+
+    def test_frame(self):
+        data = self.c.encode_frame('C', self.messages)
+        self.assertEqual( self.c.decode(bytearray(data)),
+                          [ ('C', name, args) for name, args in self.messages ] )
+
+
+    def test_dispatch(self):
+        r    = Recorder()
+        data = self.c.encode_frame('C', self.messages[:4])
+        self.assertEqual( self.c.dispatch(r, data), 4 )
+        self.assertEqual( r.received,
+                          [ ('recv_prepare',        'C', PID(1,'A')),
+                            ('recv_promise',        'C', PID(1,'A'), None, None),
+                            ('recv_promise',        'C', PID(5,'A'), PID(4,'B'), b'foo'),
+                            ('recv_prepare_nack',   'C', PID(1,'A'), PID(2,'C')) ] )
+
+
+    def test_value_codec(self):
+        class Text (object):
+            def dumps(self, value):
+                return value.encode('utf-8')
+            def loads(self, view):
+                self.view = view
+                return view.tobytes().decode('utf-8')
+
+        t    = Text()
+        c    = wire.Codec(value_codec=t)
+        data = c.encode('A', 'accept', (PID(1,'A'), u'\xe9t\xe9'))
+        self.assertEqual( c.decode(data), [('A', 'accept', (PID(1,'A'), u'\xe9t\xe9'))] )
+        self.assertTrue( isinstance(t.view, memoryview) )
+
+
+    def test_errors(self):
+        data = self.c.encode('A', 'accepted', (PID(1,'A'), b'foo'))
+        self.assertRaises( wire.MessageTruncated, self.c.decode, data[:-1] )
+        self.assertRaises( wire.MessageTruncated, self.c.decode, data[:3] )
+        self.assertRaises( wire.UnknownMessage, self.c.decode, b'\xff\x03' )
+        self.assertRaises( wire.UnknownMessage, self.c.decode, b'\x01\x10\x02\x03' )
+        self.assertRaises( wire.UnknownMessage, self.c.encode, 'A', 'bogus', () )
+        self.assertRaises( TypeError, self.c.encode, 'A', 'prepare', () )
+
+
+    def test_malformed(self):
+        r = Recorder()
+        self.assertRaises( wire.MalformedMessage, self.c.dispatch, r, b'\x01\x01\x02\xff\xfe\x01' )
+        self.assertEqual( r.received, [] )
+
+        class Strict (object):
+            def dumps(self, value):
+                return value
+            def loads(self, view):
+                raise ValueError('bad value')
+
+        c    = wire.Codec(value_codec=Strict())
+        data = c.encode('A', 'accept', (PID(1,'A'), b'foo'))
+        self.assertRaises( wire.MalformedMessage, c.decode, data )
+
+
+    def test_handler_errors_not_converted(self):
+        class Failing (object):
+            def recv_prepare(self, from_uid, proposal_id):
+                raise KeyError('handler')
+        data = self.c.encode('A', 'prepare', (PID(1,'A'),))
+        self.assertRaises( KeyError, self.c.dispatch, Failing(), data )
+
+
+    def test_multi_round_trip(self):
+        c        = wire.Codec(['A', 'B'], messages=wire.MULTI_MESSAGES)
+        accepted = { 3 : (PID(2,'A'), b'foo'), 1000 : (PID(1,'B'), None) }
+        msgs     = [ ('prepare',      (PID(3,'A'), 5)),
+                     ('promise',      (PID(3,'A'), 5, accepted)),
+                     ('promise',      (PID(3,'A'), 5, dict())),
+                     ('prepare_nack', (PID(3,'A'), PID(4,'B'))),
+                     ('accept',       (7, PID(3,'A'), b'bar')),
+                     ('accepted',     (7, PID(3,'A'), b'bar')),
+                     ('accept_nack',  (7, PID(3,'A'), PID(4,'B'))) ]
+        data     = c.encode_frame('B', msgs)
+        self.assertEqual( c.decode(data), [ ('B', name, args) for name, args in msgs ] )
+        self.assertRaises( wire.UnknownMessage, c.encode, 'B', 'heartbeat', (PID(1,'A'),) )
+
+
+    def test_batch_values(self):
+        c       = wire.MultiCodec(['A', 'B'])
+        batches = [ batching.Batch('A-1234', 7, (b'foo', b'', None)),
+                    batching.Batch(u'A', 0, ()),
+                    b'plain',
+                    None ]
+        msgs    = [ ('accept', (i, PID(1,'A'), b)) for i, b in enumerate(batches) ]
+        msgs.append( ('promise', (PID(1,'A'), 0, { 0 : (PID(1,'A'), batches[0]) })) )
+        data    = c.encode_frame('A', msgs)
+        decoded = c.decode(data)
+        self.assertEqual( decoded, [ ('A', name, args) for name, args in msgs ] )
+        self.assertTrue( isinstance(decoded[0][2][2], batching.Batch) )
+
+
+    def test_batch_command_codec(self):
+        class Text (object):
+            def dumps(self, value):
+                return value.encode('utf-8')
+            def loads(self, view):
+                return view.tobytes().decode('utf-8')
+
+        c     = wire.MultiCodec(command_codec=Text())
+        batch = batching.Batch('A', 1, (u'\xe9t\xe9', u'x'))
+        data  = c.encode('A', 'accepted', (0, PID(1,'A'), batch))
+        self.assertEqual( c.decode(data), [('A', 'accepted', (0, PID(1,'A'), batch))] )
+
+
+    def test_malformed_batches(self):
+        c      = wire.MultiCodec(['A'])
+        v      = wire.BatchCodec()
+        prefix = c.encode('A', 'accept', (0, PID(1,'A'), None))[:-1]
+
+        for value in (b'\x05', b'\x00\x01\x00', b'\x01\x03\x00', b'\x01\x00\x01A\x01\x05\x02x'):
+            buf = bytearray(prefix)
+            wire.put_varint( buf, len(value) + 1 )
+            buf.extend( value )
+            self.assertRaises( wire.WireError, c.decode, bytes(buf) )
+
+        self.assertRaises( wire.WireError, v.loads, memoryview(b'') )
+
+
+
+class WireMessengerTester (unittest.TestCase):
+
+    def setUp(self):
+        self.sent  = list()
+        self.codec = wire.Codec(['A', 'B'])
+
+
+    def send_data(self, to_uid, data):
+        self.sent.append( (to_uid, data) )
+
+
+    def test_node_exchange(self):
+        a = practical.Node(wire.WireMessenger(self, 'A', self.codec), 'A', 2)
+        b = practical.Node(wire.WireMessenger(self, 'B', self.codec), 'B', 2)
+
+        a.set_proposal(b'foo')
+        a.prepare()
+        self.assertEqual( self.sent[-1][0], None )
+        self.codec.dispatch(b, self.sent[-1][1])
+        b.persisted()
+        self.assertEqual( self.sent[-1][0], 'A' )
+        self.codec.dispatch(a, self.sent[-1][1])
+        self.assertEqual( a.promises_rcvd, set(['B']) )
+
+
+    def test_batched_frames(self):
+        m = batching.BatchingMessenger(wire.WireMessenger(self, 'A', self.codec))
+        m.send_prepare( PID(1,'A') )
+        m.send_accept( PID(1,'A'), b'foo' )
+        m.send_promise( 'B', PID(1,'B'), None, None )
+        m.flush()
+        self.assertEqual( [ to_uid for to_uid, data in self.sent ], [None, 'B'] )
+        self.assertEqual( self.codec.decode(self.sent[0][1]),
+                          [ ('A', 'prepare', (PID(1,'A'),)),
+                            ('A', 'accept',  (PID(1,'A'), b'foo')) ] )
+
+
+
+if __name__ == '__main__':
+    unittest.main()